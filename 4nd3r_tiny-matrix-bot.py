@@ -7,76 +7,1664 @@
 # pylint: disable=too-few-public-methods
 
 import asyncio
+import bisect
+import codecs
+import ctypes
+import datetime
+import functools
+import hashlib
+import importlib.util
+import json
 import os
+import random
 import re
-import subprocess
+import resource
+import signal
+import struct
 import sys
 import time
 import traceback
+from collections import OrderedDict, deque
 
 import nio
 
 
+class TriggerIndex:
+    """Pre-compiled script triggers, bucketed by the literal text their
+    top-level alternatives start with (or contain), so only the scripts
+    that can possibly match have their regex evaluated for a message."""
+
+    METACHARS = ".^$*+?{}[]\\|()"
+    MAX_PREFIXES = 8
+    # ASCII letters that re.IGNORECASE also matches with characters that
+    # str.casefold() does not fold to them, see _unfolded_letters
+    UNFOLDED = None
+
+    def __init__(self, entries, previous=None):
+        # the compiled regexes of a previous index are reused
+        self._compiled = {}
+        self._values = []
+        self._patterns = []
+        self._starts = []
+        self._contains = []
+        self._by_char = {}
+        self._always = []
+        for regex, value in entries:
+            if previous and regex in previous._compiled:
+                pattern, analysis = previous._compiled[regex]
+            else:
+                try:
+                    pattern = re.compile(regex, re.IGNORECASE)
+                except re.error as e:
+                    print(f"trigger {regex} is not a valid regex ({e}), ignored")
+                    continue
+                analysis = self._analyze(regex)
+            self._compiled[regex] = (pattern, analysis)
+            index = len(self._values)
+            self._values.append(value)
+            self._patterns.append(pattern)
+            starts, contains, always = analysis
+            self._starts.append(starts)
+            self._contains.append(contains)
+            if always or contains:
+                self._always.append(index)
+            for prefix in starts:
+                self._by_char.setdefault(prefix[0], []).append(index)
+        for char, indexes in self._by_char.items():
+            self._by_char[char] = sorted(set(indexes + self._always))
+
+    def __len__(self):
+        return len(self._values)
+
+    @staticmethod
+    def _split_alternatives(regex):
+        alternatives = []
+        depth = 0
+        in_class = False
+        start = 0
+        i = 0
+        while i < len(regex):
+            char = regex[i]
+            if char == "\\":
+                i += 2
+                continue
+            if in_class:
+                in_class = char != "]"
+            elif char == "[":
+                in_class = True
+                if regex[i + 1 : i + 2] == "^":
+                    i += 1
+                if regex[i + 1 : i + 2] == "]":
+                    i += 1
+            elif char == "(":
+                depth += 1
+            elif char == ")":
+                depth -= 1
+            elif char == "|" and not depth:
+                alternatives.append(regex[start:i])
+                start = i + 1
+            i += 1
+        alternatives.append(regex[start:])
+        return alternatives
+
+    @classmethod
+    def _unfolded_letters(cls):
+        # e.g. "i", re.IGNORECASE matches it with "ı" (U+0131), found with
+        # re's own case folding on first use
+        if cls.UNFOLDED is None:
+            others = "".join(map(chr, range(0x80, 0x10000)))
+            cls.UNFOLDED = frozenset(
+                letter
+                for letter in "abcdefghijklmnopqrstuvwxyz"
+                if any(
+                    other.casefold() != letter
+                    for other in re.findall(letter, others, re.IGNORECASE)
+                )
+            )
+        return cls.UNFOLDED
+
+    def _literal_prefixes(self, alternative, branch):
+        prefixes = [""]
+        i = 0
+        while i < len(alternative):
+            char = alternative[i]
+            if char == "\\":
+                char = alternative[i + 1 : i + 2]
+                if not char or char.isalnum():
+                    break
+                i += 2
+            elif char in self.METACHARS:
+                break
+            else:
+                i += 1
+            if not char.isascii() or char.casefold() in self._unfolded_letters():
+                break
+            char = char.casefold()
+            quantifier = alternative[i : i + 1]
+            if quantifier == "?":
+                if not branch or len(prefixes) * 2 > self.MAX_PREFIXES:
+                    break
+                prefixes += [p + char for p in prefixes]
+                i += 1
+                continue
+            if quantifier in ("*", "{"):
+                break
+            prefixes = [p + char for p in prefixes]
+            if quantifier == "+":
+                break
+        return prefixes
+
+    def _analyze(self, regex):
+        starts = set()
+        contains = set()
+        for alternative in self._split_alternatives(regex):
+            if alternative.startswith("^"):
+                prefixes = self._literal_prefixes(alternative[1:], True)
+                if "" in prefixes:
+                    return (), (), True
+                starts.update(prefixes)
+            else:
+                literal = self._literal_prefixes(alternative, False)[0]
+                if not literal:
+                    return (), (), True
+                contains.add(literal)
+        return tuple(sorted(starts)), tuple(sorted(contains)), False
+
+    def match(self, text):
+        folded = text.casefold()
+        matches = []
+        for index in self._by_char.get(folded[:1], self._always):
+            starts = self._starts[index]
+            contains = self._contains[index]
+            if starts or contains:
+                if not any(folded.startswith(p) for p in starts) and not any(
+                    c in folded for c in contains
+                ):
+                    continue
+            if self._patterns[index].search(text):
+                matches.append(self._values[index])
+        return matches
+
+
+class ResidentScript:
+    """Long-lived processes of a script that printed "mode=resident" after
+    its regex. They are started with RESIDENT set and answer one JSON line
+    (args, room_id, sender, env) on stdin with one JSON line (output and
+    optionally returncode) on stdout, instead of being started per message."""
+
+    def __init__(self, script_path, pool_size, idle_timeout):
+        self.script_path = script_path
+        self.pool_size = max(1, pool_size)
+        self.idle_timeout = idle_timeout
+        self._idle = []
+        self._count = 0
+        self._closed = False
+        self._condition = asyncio.Condition()
+
+    async def _spawn(self):
+        env = os.environ.copy()
+        env["RESIDENT"] = "1"
+        print(f"resident script {os.path.basename(self.script_path)} started")
+        return await asyncio.create_subprocess_exec(
+            self.script_path,
+            env=env,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            start_new_session=True,
+            limit=2**24,
+        )
+
+    async def _acquire(self):
+        async with self._condition:
+            while True:
+                while self._idle:
+                    process = self._idle.pop()[0]
+                    if process.returncode is None:
+                        return process
+                    self._count -= 1
+                if self._count < self.pool_size:
+                    self._count += 1
+                    break
+                await self._condition.wait()
+        try:
+            return await self._spawn()
+        except Exception:
+            await self._release(None, False)
+            raise
+
+    @staticmethod
+    async def _kill(process):
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await process.wait()
+
+    async def _release(self, process, reusable):
+        # the processes of a reloaded or removed script are not reused
+        reusable = reusable and not self._closed
+        if not reusable and process is not None:
+            await self._kill(process)
+        async with self._condition:
+            if reusable:
+                self._idle.append((process, time.monotonic()))
+            else:
+                self._count -= 1
+            self._condition.notify()
+
+    @staticmethod
+    async def _exchange(process, request):
+        process.stdin.write(request)
+        await process.stdin.drain()
+        return await process.stdout.readline()
+
+    async def request(self, script_env, timeout):
+        request = (
+            json.dumps(
+                {
+                    "args": script_env.get("TMB_BODY"),
+                    "room_id": script_env.get("TMB_ROOM_ID"),
+                    "sender": script_env.get("TMB_SENDER"),
+                    "env": script_env,
+                }
+            ).encode()
+            + b"\n"
+        )
+        # a crashed process is replaced and the request is tried once more
+        for _ in range(2):
+            process = await self._acquire()
+            try:
+                # the timeout covers writing the request as well
+                line = await asyncio.wait_for(self._exchange(process, request), timeout)
+                if not line:
+                    raise EOFError("resident script closed its output")
+                response = json.loads(line)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                await self._release(process, False)
+                raise
+            except (OSError, EOFError, ValueError) as e:
+                await self._release(process, False)
+                print(f"  resident script failed ({e}), restarting it")
+                continue
+            await self._release(process, True)
+            return response
+        raise RuntimeError("resident script failed twice")
+
+    async def close(self):
+        async with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._count -= len(idle)
+        for process, _ in idle:
+            await self._kill(process)
+
+    async def reap(self):
+        async with self._condition:
+            now = time.monotonic()
+            expired = [e for e in self._idle if now - e[1] > self.idle_timeout]
+            for entry in expired:
+                self._idle.remove(entry)
+                self._count -= 1
+        for process, _ in expired:
+            await self._kill(process)
+            print(f"resident script {os.path.basename(self.script_path)} stopped")
+
+
+class ResultCache:
+    """LRU cache of script outputs, every entry expires after the cache_ttl
+    of its script. Concurrent requests for the same key share one run."""
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self._entries = OrderedDict()
+        self._pending = {}
+
+    def _log(self, result, key):
+        print(
+            f"cache {result} for {key} (hits {self.hits} misses {self.misses}"
+            f" shared {self.shared} entries {len(self._entries)})"
+        )
+
+    async def get(self, key, ttl, loader):
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self._log("hit", key)
+            return entry[1]
+        pending = self._pending.get(key)
+        if pending is not None:
+            self.shared += 1
+            self._log("shared", key)
+            output = await asyncio.shield(pending)
+            return output if output is not None else await loader()
+        self.misses += 1
+        self._log("miss", key)
+        pending = self._pending[key] = asyncio.get_running_loop().create_future()
+        output = None
+        try:
+            output = await loader()
+        finally:
+            del self._pending[key]
+            pending.set_result(output)
+            # failed runs (False) are not cached
+            if output:
+                self._entries[key] = (time.monotonic() + ttl, output)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+        return output
+
+
+class TokenBucket:
+    """Allows rate events per second with bursts of up to burst events, a
+    rate of 0 or less means no limit. pause() holds back every taker."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = self.burst
+        self._stamp = time.monotonic()
+        self._paused_until = 0
+
+    async def take(self):
+        while True:
+            now = time.monotonic()
+            wait = self._paused_until - now
+            if wait <= 0:
+                if self.rate <= 0:
+                    return
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._stamp) * self.rate
+                )
+                self._stamp = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            await asyncio.sleep(wait)
+
+    def try_take(self):
+        now = time.monotonic()
+        if self._paused_until > now:
+            return False
+        if self.rate <= 0:
+            return True
+        self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def full(self):
+        now = time.monotonic()
+        return (
+            self._paused_until <= now
+            and self._tokens + (now - self._stamp) * self.rate >= self.burst
+        )
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class Metrics:
+    """Counters, gauges and histograms about the bot, for the Prometheus
+    endpoint and the JSON dump in run_path. When not enabled every method
+    returns right away."""
+
+    PREFIX = "tmb_"
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+    FAST_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05)
+    # name -> (type, help, histogram buckets)
+    DEFINITIONS = {
+        "events_total": ("counter", "Text messages handled.", None),
+        "event_lag_seconds": (
+            "histogram",
+            "Time between the server receiving a message and the bot handling it.",
+            BUCKETS,
+        ),
+        "dispatch_seconds": (
+            "histogram",
+            "Time spent matching a message against the script triggers.",
+            FAST_BUCKETS,
+        ),
+        "reply_latency_seconds": (
+            "histogram",
+            "Time between handling a message and sending a reply, by script.",
+            BUCKETS,
+        ),
+        "script_wall_seconds": (
+            "histogram",
+            "Wall time of script runs, by script.",
+            BUCKETS,
+        ),
+        "script_cpu_seconds_total": (
+            "counter",
+            "CPU time of script processes, by script. "
+            "Scripts finishing at the same moment can be mixed up.",
+            None,
+        ),
+        "scripts_in_flight": ("gauge", "Script runs in progress, by script.", None),
+        "outbox_queue_depth": ("gauge", "Messages waiting to be sent.", None),
+        "send_retries_total": (
+            "counter",
+            "Responses of the server asking the bot to slow down.",
+            None,
+        ),
+        "send_errors_total": ("counter", "Messages that could not be sent.", None),
+        "run_queue_depth": ("gauge", "Script runs waiting for a worker.", None),
+        "runs_rejected_total": (
+            "counter",
+            "Script runs refused, by reason (throttled or queue_full).",
+            None,
+        ),
+        "events_forwarded_total": (
+            "counter",
+            "Messages handed to a worker process, by worker.",
+            None,
+        ),
+        "worker_restarts_total": (
+            "counter",
+            "Worker processes that exited and were started again, by worker.",
+            None,
+        ),
+        "jobs_total": ("counter", "Scheduled script runs started, by script.", None),
+        "jobs_skipped_total": (
+            "counter",
+            "Scheduled script runs skipped, by script and reason (running or busy).",
+            None,
+        ),
+    }
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        # (name, labels) -> number, or [bucket counts, sum, count] for histograms
+        self._values = {}
+        self._children_cpu = 0
+
+    def add(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        buckets = self.DEFINITIONS[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._values.get(key)
+        if histogram is None:
+            histogram = self._values[key] = [[0] * (len(buckets) + 1), 0, 0]
+        histogram[0][bisect.bisect_left(buckets, value)] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    def children_cpu(self):
+        """CPU time of the child processes that ended since the last call."""
+        if not self.enabled:
+            return 0
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        total = usage.ru_utime + usage.ru_stime
+        delta = total - self._children_cpu
+        self._children_cpu = total
+        return delta
+
+    def snapshot(self):
+        metrics = {}
+        for (name, labels), value in sorted(self._values.items()):
+            sample = {"labels": dict(labels)}
+            if isinstance(value, list):
+                buckets = self.DEFINITIONS[name][2] + (float("inf"),)
+                sample["buckets"] = {
+                    str(le): count for le, count in zip(buckets, value[0])
+                }
+                sample["sum"] = value[1]
+                sample["count"] = value[2]
+            else:
+                sample["value"] = value
+            metrics.setdefault(self.PREFIX + name, []).append(sample)
+        return {"time": time.time(), "metrics": metrics}
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ""
+        escaped = (
+            (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for k, v in labels.items()
+        )
+        return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+    def render(self):
+        """The metrics in the Prometheus text format."""
+        lines = []
+        snapshot = self.snapshot()["metrics"]
+        for name, (metric_type, help_text, buckets) in self.DEFINITIONS.items():
+            name = self.PREFIX + name
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for sample in snapshot.get(name, []):
+                labels = self._format_labels(sample["labels"])
+                if "value" in sample:
+                    lines.append(f"{name}{labels} {sample['value']}")
+                    continue
+                cumulative = 0
+                for le, count in zip(
+                    buckets + (float("inf"),), sample["buckets"].values()
+                ):
+                    cumulative += count
+                    bucket_labels = self._format_labels(
+                        dict(sample["labels"], le="+Inf" if le == float("inf") else f"{le:g}")
+                    )
+                    lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+                lines.append(f"{name}_sum{labels} {sample['sum']}")
+                lines.append(f"{name}_count{labels} {sample['count']}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        try:
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(self.snapshot(), f, indent=1)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            print(f"metrics {path} not written: {e}")
+
+    async def serve(self, reader, writer):
+        # just enough HTTP for a Prometheus scraper
+        try:
+            request = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+            parts = request.decode(errors="replace").split()
+            path = parts[1].split("?")[0] if len(parts) > 1 else ""
+            if path in ("/", "/metrics"):
+                status = "200 OK"
+                body = self.render().encode()
+            else:
+                status = "404 Not Found"
+                body = b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+class Outbox:
+    """Outbound messages, one queue and sender task per room so messages
+    stay in order within a room while rooms are served in parallel. All
+    rooms share a token bucket that is paused on the server's retry hints.
+    Adjacent messages that fit into coalesce_size are sent as one."""
+
+    def __init__(self, client, bucket, coalesce_size, metrics=None):
+        self.bucket = bucket
+        self.coalesce_size = coalesce_size
+        self.metrics = metrics or Metrics()
+        self._client = client
+        # room_id -> deque of (body, script name, time the request was handled)
+        self._queues = {}
+        self._tasks = set()
+
+    def put(self, room_id, body, script=None, received=None):
+        self.metrics.add("outbox_queue_depth")
+        queue = self._queues.get(room_id)
+        if queue is not None:
+            queue.append((body, script, received))
+            return
+        self._queues[room_id] = deque([(body, script, received)])
+        task = asyncio.create_task(self._drain(room_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _drain(self, room_id):
+        queue = self._queues[room_id]
+        print(f"sending message to {room_id}")
+        try:
+            await self._typing(room_id, True)
+            while queue:
+                await self.bucket.take()
+                body, script, received = queue.popleft()
+                requests = [(script, received)]
+                while queue and len(body) + len(queue[0][0]) + 2 <= self.coalesce_size:
+                    next_body, script, received = queue.popleft()
+                    body += "\n\n" + next_body
+                    requests.append((script, received))
+                self.metrics.add("outbox_queue_depth", -len(requests))
+                try:
+                    response = await self._client.room_send(
+                        room_id=room_id,
+                        message_type="m.room.message",
+                        content={"msgtype": "m.text", "body": body},
+                    )
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    # a transport error or timeout loses this message, not
+                    # the rest of the room's queue
+                    self.metrics.add("send_errors_total")
+                    print(f"sending message to {room_id} failed:")
+                    print(traceback.format_exc().strip())
+                    continue
+                if isinstance(response, nio.RoomSendError):
+                    self.metrics.add("send_errors_total")
+                    print(f"sending message to {room_id} failed: {response}")
+                    continue
+                for script, received in requests:
+                    if received is not None:
+                        self.metrics.observe(
+                            "reply_latency_seconds",
+                            time.monotonic() - received,
+                            script=script,
+                        )
+        finally:
+            del self._queues[room_id]
+            await self._typing(room_id, False)
+
+    async def _typing(self, room_id, typing):
+        # the typing notice is only a hint, failing to send it stops nothing
+        try:
+            await self._client.room_typing(room_id, typing)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            print(f"typing notice in {room_id} failed:")
+            print(traceback.format_exc().strip())
+
+    def on_rate_limit(self, response):
+        retry_after_ms = getattr(response, "retry_after_ms", None)
+        if response.status_code == "M_LIMIT_EXCEEDED" and retry_after_ms:
+            self.metrics.add("send_retries_total")
+            print(f"rate limited by server, pausing for {retry_after_ms} ms")
+            self.bucket.pause(retry_after_ms / 1000)
+
+    async def close(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+class Scheduler:
+    """Script runs wait in a queue per room and sender. A fixed number of
+    worker tasks take them round-robin across the rooms and within a room
+    across the senders, so a busy room or sender cannot hold up everybody
+    else. A run is only taken once its script has a free slot, runs of a
+    script that is already running as often as it may stay in the queue
+    without holding up a worker. Token buckets per sender and per room
+    limit how often runs are accepted and a room can only have queue_size
+    runs waiting."""
+
+    def __init__(self, workers, queue_size, metrics=None):
+        self.queue_size = queue_size
+        self.metrics = metrics or Metrics()
+        # (scope, "sender" or "room", id) -> TokenBucket
+        self._buckets = {}
+        # room_id -> OrderedDict of sender -> deque of (run, slots)
+        self._rooms = {}
+        self._lengths = {}
+        self._ready = deque()
+        # set when a run is queued or a slot is given back
+        self._changed = asyncio.Event()
+        self._tasks = {asyncio.create_task(self._work()) for _ in range(max(1, workers))}
+
+    def admit(self, limits, room_id, sender):
+        # limits are (scope, "sender" or "room", rate, burst), the scope is
+        # None for the global limits and the script path for a script's own
+        for scope, per, rate, burst in limits:
+            if rate <= 0:
+                continue
+            key = (scope, per, sender if per == "sender" else room_id)
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(rate, burst)
+            if not bucket.try_take():
+                self.metrics.add("runs_rejected_total", reason="throttled")
+                return False
+        return True
+
+    def submit(self, room_id, sender, run, slots=None):
+        # slots is the semaphore of the run's script, it is taken before the
+        # run starts and given back when it has ended
+        length = self._lengths.get(room_id, 0)
+        if 0 < self.queue_size <= length:
+            self.metrics.add("runs_rejected_total", reason="queue_full")
+            return False
+        senders = self._rooms.get(room_id)
+        if senders is None:
+            senders = self._rooms[room_id] = OrderedDict()
+            self._ready.append(room_id)
+        senders.setdefault(sender, deque()).append((run, slots))
+        self._lengths[room_id] = length + 1
+        self.metrics.add("run_queue_depth")
+        self._changed.set()
+        return True
+
+    def _next(self):
+        # the first run whose script has a free slot, None if there is none;
+        # the rooms and within a room the senders take turns
+        for room_id in self._ready:
+            senders = self._rooms[room_id]
+            for sender, runs in senders.items():
+                for i, (run, slots) in enumerate(runs):
+                    if slots is not None and slots.locked():
+                        continue
+                    del runs[i]
+                    if runs:
+                        senders.move_to_end(sender)
+                    else:
+                        del senders[sender]
+                    self._ready.remove(room_id)
+                    if senders:
+                        self._lengths[room_id] -= 1
+                        self._ready.append(room_id)
+                    else:
+                        del self._rooms[room_id]
+                        del self._lengths[room_id]
+                    self.metrics.add("run_queue_depth", -1)
+                    return run, slots
+        return None
+
+    async def _work(self):
+        while True:
+            taken = self._next()
+            if taken is None:
+                self._changed.clear()
+                await self._changed.wait()
+                continue
+            run, slots = taken
+            if slots is not None:
+                # the slot is free, so this does not wait
+                await slots.acquire()
+            try:
+                await run()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                print(traceback.format_exc().strip())
+            finally:
+                if slots is not None:
+                    slots.release()
+                    self._changed.set()
+
+    def prune(self):
+        # buckets that have filled up are as good as new ones
+        for key in [k for k, bucket in self._buckets.items() if bucket.full()]:
+            del self._buckets[key]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+class DirectoryWatcher:
+    """Reports which files in a few directories were added, changed or
+    removed, through inotify where libc has it and otherwise by comparing
+    the files' modification times every interval seconds."""
+
+    # see inotify(7)
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    EVENT = struct.Struct("iIII")
+    # editors and cp write a file in several steps
+    SETTLE = 0.2
+
+    def __init__(self, directories, interval):
+        self.directories = [os.path.abspath(d) for d in directories]
+        self.interval = interval
+        self._fd = None
+        self._watches = {}
+        try:
+            self._start_inotify()
+        except (OSError, AttributeError) as e:
+            print(f"inotify not available ({e}), checking for changes every {interval} seconds")
+        self._snapshot = self._scan() if self._fd is None else None
+
+    def _start_inotify(self):
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        mask = (
+            self.IN_ATTRIB
+            | self.IN_CLOSE_WRITE
+            | self.IN_MOVED_FROM
+            | self.IN_MOVED_TO
+            | self.IN_CREATE
+            | self.IN_DELETE
+        )
+        for directory in self.directories:
+            watch = libc.inotify_add_watch(fd, os.fsencode(directory), mask)
+            if watch < 0:
+                os.close(fd)
+                error = ctypes.get_errno()
+                raise OSError(error, f"{directory}: {os.strerror(error)}")
+            self._watches[watch] = directory
+        self._fd = fd
+
+    def _scan(self):
+        files = {}
+        for directory in self.directories:
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files[(directory, entry.name)] = (
+                    stat.st_mtime_ns,
+                    stat.st_size,
+                    stat.st_mode,
+                )
+        return files
+
+    def _read_events(self):
+        changes = set()
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                return changes
+            offset = 0
+            while offset < len(data):
+                watch, mask, _, length = self.EVENT.unpack_from(data, offset)
+                start = offset + self.EVENT.size
+                name = data[start : start + length]
+                offset = start + length
+                if mask & self.IN_Q_OVERFLOW:
+                    # events were lost, anything may have changed
+                    changes.update((directory, None) for directory in self.directories)
+                elif watch in self._watches:
+                    changes.add((self._watches[watch], os.fsdecode(name.rstrip(b"\0"))))
+
+    async def _readable(self):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        loop.add_reader(self._fd, lambda: future.done() or future.set_result(None))
+        try:
+            await future
+        finally:
+            loop.remove_reader(self._fd)
+
+    async def wait(self):
+        """Changes as a set of (directory, file name), a file name of None
+        means that anything in the directory may have changed."""
+        if self._fd is None:
+            while True:
+                await asyncio.sleep(self.interval)
+                snapshot = self._scan()
+                changes = {
+                    key
+                    for key in set(snapshot) | set(self._snapshot)
+                    if snapshot.get(key) != self._snapshot.get(key)
+                }
+                self._snapshot = snapshot
+                if changes:
+                    return changes
+        changes = set()
+        while not changes:
+            await self._readable()
+            changes = self._read_events()
+        while True:
+            try:
+                await asyncio.wait_for(self._readable(), self.SETTLE)
+            except asyncio.TimeoutError:
+                return changes
+            changes |= self._read_events()
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class ProgressMessage:
+    """Progress message of a long running script. It is sent once the
+    script has run for interval seconds and then edited in place
+    (m.replace) every interval seconds until the script has ended."""
+
+    def __init__(self, client, bucket, room_id, name, interval):
+        self.name = name
+        self.interval = interval
+        self._bucket = bucket
+        self._client = client
+        self._event_id = None
+        self._room_id = room_id
+        self._started = time.monotonic()
+        self._task = asyncio.create_task(self._update())
+
+    async def _send(self, body):
+        content = {"msgtype": "m.notice", "body": body}
+        if self._event_id:
+            content = {
+                "msgtype": "m.notice",
+                "body": "* " + body,
+                "m.new_content": content,
+                "m.relates_to": {"rel_type": "m.replace", "event_id": self._event_id},
+            }
+        await self._bucket.take()
+        response = await self._client.room_send(
+            room_id=self._room_id,
+            message_type="m.room.message",
+            content=content,
+        )
+        if isinstance(response, nio.RoomSendError):
+            print(f"progress message of {self.name} not sent: {response}")
+        elif not self._event_id:
+            self._event_id = response.event_id
+
+    async def _update(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            elapsed = time.monotonic() - self._started
+            await self._send(f"{self.name} has been running for {elapsed:.0f} seconds ...")
+
+    async def stop(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        if self._event_id:
+            elapsed = time.monotonic() - self._started
+            await self._send(f"{self.name} finished after {elapsed:.0f} seconds.")
+
+
+class Schedule:
+    """When a scheduled script runs, either every interval seconds ("300",
+    "5m", "every 2h") or at the minutes a cron expression ("*/5 * * * *",
+    "0 12 * * 1-5", "@daily") matches in local time. Raises ValueError if
+    the expression is not valid."""
+
+    ALIASES = {
+        "@hourly": "0 * * * *",
+        "@daily": "0 0 * * *",
+        "@midnight": "0 0 * * *",
+        "@weekly": "0 0 * * 0",
+        "@monthly": "0 0 1 * *",
+        "@yearly": "0 0 1 1 *",
+        "@annually": "0 0 1 1 *",
+    }
+    INTERVAL = re.compile(r"(?:every\s+)?(\d+(?:\.\d+)?)\s*([smhd]?)", re.IGNORECASE)
+    UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400}
+    # lowest and highest value of minute, hour, day of month, month and
+    # day of week, 0 and 7 are both Sunday
+    RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.interval = None
+        expression = self.ALIASES.get(spec.strip().lower(), spec.strip())
+        match = self.INTERVAL.fullmatch(expression)
+        if match:
+            self.interval = float(match.group(1)) * self.UNITS[match.group(2).lower()]
+            if self.interval <= 0:
+                raise ValueError("interval must be positive")
+            return
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError("expected an interval or five cron fields")
+        self._minutes, self._hours, self._days, self._months, self._weekdays = [
+            self._parse_field(field, low, high)
+            for field, (low, high) in zip(fields, self.RANGES)
+        ]
+        if 7 in self._weekdays:
+            self._weekdays = (self._weekdays - {7}) | {0}
+        # as in cron, if both days are restricted either of them matches
+        self._either_day = not fields[2].startswith("*") and not fields[4].startswith("*")
+        if self.next(time.time()) is None:
+            raise ValueError("never matches")
+
+    @staticmethod
+    def _parse_field(field, low, high):
+        # "*", "1,15", "9-17", "*/10" and "5/15", every 15 from 5 on
+        values = set()
+        for part in field.split(","):
+            span, _, step = part.partition("/")
+            step = int(step) if step else 1
+            if span == "*":
+                start, end = low, high
+            elif "-" in span:
+                start, end = (int(v) for v in span.split("-", 1))
+            else:
+                start = int(span)
+                end = high if "/" in part else start
+            if not low <= start <= end <= high or step < 1:
+                raise ValueError(f"{part} is out of range {low}-{high}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _matches_day(self, day):
+        in_month = day.day in self._days
+        in_week = day.isoweekday() % 7 in self._weekdays
+        return in_month or in_week if self._either_day else in_month and in_week
+
+    def next(self, after):
+        # the first time after the given one the script is due, None if
+        # there is none in the next years; the fields are tried from the
+        # largest to the smallest, one that does not match moves on to the
+        # start of its next month, day, ...
+        if self.interval:
+            return after + self.interval
+        moment = datetime.datetime.fromtimestamp(after).replace(
+            second=0, microsecond=0
+        ) + datetime.timedelta(minutes=1)
+        last_year = moment.year + 8
+        while moment.year <= last_year:
+            if moment.month not in self._months:
+                moment = (
+                    moment.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)
+                ).replace(day=1)
+            elif not self._matches_day(moment):
+                moment = moment.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif moment.hour not in self._hours:
+                moment = moment.replace(minute=0) + datetime.timedelta(hours=1)
+            elif moment.minute not in self._minutes:
+                moment += datetime.timedelta(minutes=1)
+            else:
+                return moment.timestamp()
+        return None
+
+
+class Timetable:
+    """Timer of the scheduled scripts. A task sleeps until the next job is
+    due and hands it to start, with a random delay of up to the job's jitter
+    seconds. A job whose previous run has not finished yet skips its turn.
+    start gets the job's script path and a function to call when the run
+    has finished, and returns False if the run was refused."""
+
+    # the wall clock can be set while the task sleeps
+    MAX_SLEEP = 60
+
+    def __init__(self, start, metrics=None):
+        self.metrics = metrics or Metrics()
+        self._start = start
+        self._jobs = {}  # script path -> [job, next time, due time including the jitter]
+        self._running = set()  # script paths of the jobs with a run in progress
+        self._changed = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    def update(self, jobs):
+        # jobs is a dict of script path -> job with a Schedule and a jitter,
+        # jobs whose schedule did not change keep their due time
+        now = time.time()
+        timetable = {}
+        for script_path, job in jobs.items():
+            entry = self._jobs.get(script_path)
+            if (
+                entry
+                and entry[0]["schedule"].spec == job["schedule"].spec
+                and entry[0]["jitter"] == job["jitter"]
+            ):
+                timetable[script_path] = [job, entry[1], entry[2]]
+                continue
+            due = job["schedule"].next(now)
+            timetable[script_path] = [job, due, due + random.uniform(0, job["jitter"])]
+            due_time = datetime.datetime.fromtimestamp(timetable[script_path][2])
+            print(
+                f"script {os.path.basename(script_path)} scheduled for"
+                f" {due_time:%Y-%m-%d %H:%M:%S}"
+            )
+        self._jobs = timetable
+        self._changed.set()
+
+    async def _run(self):
+        while True:
+            now = time.time()
+            due = []
+            for script_path, entry in self._jobs.items():
+                if entry[2] > now:
+                    continue
+                job = entry[0]
+                due.append(script_path)
+                # runs that were missed, e.g. while the host was suspended,
+                # are not made up for
+                entry[1] = job["schedule"].next(entry[1])
+                if entry[1] is None or entry[1] <= now:
+                    entry[1] = job["schedule"].next(now)
+                entry[2] = entry[1] + random.uniform(0, job["jitter"])
+            for script_path in due:
+                self._fire(script_path)
+            if due:
+                continue
+            wait = min((entry[2] for entry in self._jobs.values()), default=now + self.MAX_SLEEP)
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), min(self.MAX_SLEEP, wait - now))
+            except asyncio.TimeoutError:
+                pass
+
+    def _fire(self, script_path):
+        script_name = os.path.basename(script_path)
+        if script_path in self._running:
+            print(f"scheduled run of {script_name} skipped, the previous one is still running")
+            self.metrics.add("jobs_skipped_total", script=script_name, reason="running")
+            return
+        self._running.add(script_path)
+        try:
+            started = self._start(
+                script_path, functools.partial(self._running.discard, script_path)
+            )
+        except Exception:
+            # the job gets its next turn, and the others theirs
+            print(f"scheduled run of {script_name} failed to start")
+            print(traceback.format_exc().strip())
+            self._running.discard(script_path)
+            return
+        if not started:
+            print(f"scheduled run of {script_name} skipped, busy")
+            self.metrics.add("jobs_skipped_total", script=script_name, reason="busy")
+            self._running.discard(script_path)
+            return
+        self.metrics.add("jobs_total", script=script_name)
+
+    async def close(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+
+class HashRing:
+    """Room ids assigned to workers by consistent hashing. Every worker is
+    put on a ring of hashes at a number of points, a room belongs to the
+    worker of the first point at or after the room's hash. Removing a worker
+    only moves its own rooms, adding it again moves them back."""
+
+    def __init__(self, replicas=64):
+        self._replicas = replicas
+        self._points = []  # sorted hashes
+        self._nodes = {}  # hash -> worker
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    def add(self, node):
+        for i in range(self._replicas):
+            point = self._hash(f"{node}-{i}")
+            if point not in self._nodes:
+                bisect.insort(self._points, point)
+            self._nodes[point] = node
+
+    def remove(self, node):
+        for i in range(self._replicas):
+            point = self._hash(f"{node}-{i}")
+            if self._nodes.get(point) == node:
+                del self._nodes[point]
+                del self._points[bisect.bisect_left(self._points, point)]
+
+    def lookup(self, key):
+        # None if the ring is empty
+        if not self._points:
+            return None
+        i = bisect.bisect_left(self._points, self._hash(key)) % len(self._points)
+        return self._nodes[self._points[i]]
+
+
+class ShardSupervisor:
+    """Worker processes of a sharded bot. The supervisor alone syncs, every
+    room belongs to one worker (see HashRing) and its messages are handed to
+    that worker as JSON lines on its stdin. A worker that exits is taken off
+    the ring, so its rooms go to the other workers meanwhile, and is started
+    again after a delay that doubles up to a minute while it keeps exiting."""
+
+    def __init__(self, command, count, metrics=None):
+        self.metrics = metrics or Metrics()
+        self._command = command
+        self._ring = HashRing()
+        self._processes = [None] * count
+        self._tasks = set()
+
+    def start(self):
+        for index in range(len(self._processes)):
+            task = asyncio.create_task(self._run(index))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, index):
+        delay = 1
+        while True:
+            started = time.monotonic()
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *self._command,
+                    stdin=asyncio.subprocess.PIPE,
+                    env=dict(os.environ, TMB_WORKER=str(index)),
+                )
+                self._processes[index] = process
+                self._ring.add(index)
+                print(f"worker {index} started with pid {process.pid}")
+                await process.wait()
+                print(f"worker {index} exited with {process.returncode}")
+            except OSError as e:
+                print(f"worker {index} not started: {e}")
+            finally:
+                self._ring.remove(index)
+            self._processes[index] = None
+            self.metrics.add("worker_restarts_total", worker=str(index))
+            # a worker that ran for a while gets the short delay again
+            if time.monotonic() - started > 60:
+                delay = 1
+            print(
+                f"worker {index} stopped, its rooms go to the other workers,"
+                f" restart in {delay} seconds"
+            )
+            await asyncio.sleep(delay)
+            delay = min(60, delay * 2)
+
+    async def send(self, room_id, request):
+        # False if no worker is running
+        line = json.dumps(request).encode() + b"\n"
+        while True:
+            index = self._ring.lookup(room_id)
+            if index is None:
+                print(f"no worker running, message for {room_id} dropped")
+                return False
+            try:
+                self._processes[index].stdin.write(line)
+                # a worker that does not keep up holds up the sync loop
+                await self._processes[index].stdin.drain()
+            except (AttributeError, ConnectionError):
+                self._ring.remove(index)
+                continue
+            self.metrics.add("events_forwarded_total", worker=str(index))
+            return True
+
+    async def close(self):
+        processes = [p for p in self._processes if p]
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        # the workers exit when their stdin is closed
+        for process in processes:
+            process.stdin.close()
+        await asyncio.gather(*(p.wait() for p in processes))
+
+
 class TinyMatrixBot:
     accept_invites = None
     access_token = None
+    busy_interval = 60
+    busy_message = "Busy, please try again later."
+    cache_size = 256
+    coalesce_size = 0
+    event_window = 1024
     homeserver = None
+    max_script_runs = 4
+    max_scripts = 16
+    metrics_address = "127.0.0.1"
+    metrics_interval = 0
+    metrics_port = 0
     proxy = None
+    queue_size = 50
+    receipt_interval = 2
+    reload = "1"
+    reload_interval = 2
+    room_burst = 10
+    room_rate = 0
+    run_path = None
+    save_sync_token = "1"
+    schedule_rooms = ""
+    script_cache = "1"
+    script_timeout = 300
     scripts_path = None
+    send_burst = 10
+    send_rate = 5
+    sender_burst = 5
+    sender_rate = 0
+    sync_filter = "1"
+    timeline_limit = 20
     user_id = None
+    worker = None
+    worker_processes = 1
 
+    _busy_sent = None
+    _cache = None
     _client = None
     _initial_sync_done = False
-    _last_event_timestamp = time.time() * 1000
+    _jobs = None
+    _limits = None
+    _metrics = None
+    _outbox = None
+    _plugins = None
+    _receipts = None
+    _resident = None
+    _scheduler = None
+    _script_limits = None
+    _script_options = None
+    _script_runs = None
     _scripts = None
+    _seen_events = None
+    _start_timestamp = None
+    _supervisor = None
+    _sync_token_saved = 0
+    _tasks = None
+    _timetable = None
+    _triggers = None
+
+    @staticmethod
+    async def _stream_output(run, deliver):
+        # every finished message is passed on while the script still runs
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        output = ""
+        while True:
+            data = await run.stdout.read(65536)
+            if not data:
+                break
+            output += decoder.decode(data)
+            if "\n\n" in output:
+                messages, output = output.rsplit("\n\n", 1)
+                deliver(messages)
+        await run.wait()
+        return output + decoder.decode(b"", True)
 
-    def _run_script(self, script_path, script_env=None):
+    async def _run_script(self, script_path, script_env=None, deliver=None):
         script_name = os.path.basename(script_path)
         print(f"running script {script_name} with env {script_env}")
         env = os.environ.copy()
         if script_env:
             env.update(script_env)
         try:
-            run = subprocess.run(
-                [script_path],
+            run = await asyncio.create_subprocess_exec(
+                script_path,
                 env=env,
-                stdout=subprocess.PIPE,
-                check=False,
-                universal_newlines=True,
+                stdout=asyncio.subprocess.PIPE,
+                start_new_session=True,
             )
         except Exception:
             print(traceback.format_exc().strip())
             return False
+        try:
+            timeout = float(self.script_timeout)
+            if deliver:
+                output = await asyncio.wait_for(
+                    self._stream_output(run, deliver), timeout if timeout > 0 else None
+                )
+            else:
+                stdout, _ = await asyncio.wait_for(
+                    run.communicate(), timeout if timeout > 0 else None
+                )
+                output = stdout.decode(errors="replace")
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            # the script's children are in its process group, kill them too
+            try:
+                os.killpg(run.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            await run.wait()
+            if isinstance(e, asyncio.CancelledError):
+                print(f"  script {script_name} cancelled")
+                raise
+            print(f"  script {script_name} killed after {timeout:g} seconds")
+            return False
         if run.returncode != 0:
             print("  non-zero exit code")
             return False
-        output = run.stdout.strip()
+        output = output.strip()
         if not output:
             print("  no output")
             return False
         return output
 
-    def _load_scripts(self, scripts_path):
-        scripts = {}
-        for file in os.listdir(scripts_path):
+    def _read_limits(self, options, scope):
+        # sender and room limits of a script's options, see Scheduler.admit
+        limits = []
+        for per in ("sender", "room"):
+            rate = options.get(f"{per}_rate")
+            if rate is None:
+                continue
+            burst = options.get(f"{per}_burst", getattr(self, f"{per}_burst"))
+            limits.append((scope, per, float(rate), int(burst)))
+        return limits
+
+    def _manifest_path(self, scripts_path):
+        if self.script_cache in ("", "0"):
+            return None
+        return os.path.join(
+            self.run_path,
+            os.path.basename(os.path.normpath(scripts_path)) + ".manifest.json",
+        )
+
+    @staticmethod
+    def _fingerprint(script_path):
+        stat = os.stat(script_path)
+        with open(script_path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        return {"mtime": stat.st_mtime_ns, "size": stat.st_size, "sha256": digest}
+
+    async def _probe_scripts(self, scripts_path, script_paths, unchanged=()):
+        # scripts that are unchanged since the last start are not run again,
+        # the others are probed in parallel; the manifest entries of the
+        # unchanged paths are kept as they are
+        manifest_path = self._manifest_path(scripts_path)
+        manifest = {}
+        if manifest_path:
+            try:
+                with open(manifest_path, encoding="utf-8") as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                print(f"no usable script manifest {manifest_path}")
+        entries = {}
+        misses = []
+        for script_path in script_paths:
+            entry = self._fingerprint(script_path)
+            cached = manifest.get(script_path, {})
+            if "config" in cached and all(cached.get(k) == v for k, v in entry.items()):
+                entry["config"] = cached.get("config")
+            else:
+                misses.append(script_path)
+            entries[script_path] = entry
+        print(f"script manifest hits {len(entries) - len(misses)} misses {len(misses)}")
+        slots = asyncio.Semaphore(int(self.max_scripts))
+
+        async def probe(script_path):
+            async with slots:
+                return await self._run_script(script_path, {"CONFIG": "1"})
+
+        results = await asyncio.gather(*(probe(p) for p in misses))
+        failed = set()
+        for script_path, script_config in zip(misses, results):
+            entries[script_path]["config"] = script_config or ""
+            # a failed probe is retried on the next start
+            if script_config is False:
+                failed.add(script_path)
+        kept = {k: manifest[k] for k in unchanged if k in manifest and k not in entries}
+        if manifest_path and (misses or set(manifest) != set(entries) | set(kept)):
+            try:
+                with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+                    json.dump(
+                        dict(kept, **{k: v for k, v in entries.items() if k not in failed}),
+                        f,
+                        indent=1,
+                        sort_keys=True,
+                    )
+                os.replace(manifest_path + ".tmp", manifest_path)
+            except OSError as e:
+                print(f"script manifest {manifest_path} not written: {e}")
+        return {k: v["config"] for k, v in entries.items()}
+
+    def _list_scripts(self, scripts_path, names=None):
+        script_paths = []
+        for file in os.listdir(scripts_path) if names is None else sorted(names):
             script_path = os.path.join(self.scripts_path, file)
             script_name = os.path.basename(script_path)
             if script_name[0] == ".":
                 continue
+            if not os.path.isfile(script_path):
+                continue
             if not os.access(script_path, os.R_OK):
                 print(f"script {script_name} is not readable")
                 continue
-            if not os.access(script_path, os.X_OK):
+            # Python modules are plugins, see _load_plugin
+            if not os.access(script_path, os.X_OK) and not script_name.endswith(".py"):
                 print(f"script {script_name} is not executable")
                 continue
-            script_regex = self._run_script(script_path, {"CONFIG": "1"})
-            if not script_regex:
-                print(f"script {script_name} loading failed")
-                continue
-            print(f"script {script_name} loaded with regex {script_regex}")
-            scripts.update({script_path: script_regex})
+            script_paths.append(script_path)
+        return script_paths
+
+    def _load_plugin(self, script_path):
+        # a plugin is a Python module with a TRIGGER regex and a handle
+        # function or coroutine function that gets the room id, the sender,
+        # the message and the plugin's options and returns the reply; its
+        # OPTIONS dict holds what scripts print after their regex
+        script_name = os.path.basename(script_path)
+        self._plugins.pop(script_path, None)
+        try:
+            spec = importlib.util.spec_from_file_location(
+                "tiny_matrix_bot_plugin_" + script_name[:-3], script_path
+            )
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            self._plugins[script_path] = module.handle
+            return "\n".join(
+                [module.TRIGGER]
+                + [f"{k}={v}" for k, v in getattr(module, "OPTIONS", {}).items()]
+            )
+        except Exception:
+            print(f"plugin {script_name} not loaded")
+            print(traceback.format_exc().strip())
+            return ""
+
+    async def _read_script_configs(self, scripts_path, script_paths, unchanged=()):
+        # plugins are imported instead of probed
+        script_configs = {p: self._load_plugin(p) for p in script_paths if p.endswith(".py")}
+        script_configs.update(
+            await self._probe_scripts(
+                scripts_path,
+                [p for p in script_paths if p not in script_configs],
+                unchanged,
+            )
+        )
+        return script_configs
+
+    def _add_script(self, script_path, script_config):
+        script_name = os.path.basename(script_path)
+        # the regex is on the first line, "key=value" options may follow
+        lines = script_config.splitlines()
+        script_regex = lines[0].strip() if lines else ""
+        if not script_regex:
+            print(f"script {script_name} loading failed")
+            return None
+        options = dict(
+            line.split("=", 1) for line in lines[1:] if "=" in line
+        )
+        options = {k.strip(): v.strip() for k, v in options.items()}
+        self._script_options[script_path] = options
+        self._script_limits[script_path] = self._read_limits(options, script_path)
+        if options.get("mode") == "resident" and script_path not in self._plugins:
+            print(f"script {script_name} is resident")
+            self._resident[script_path] = ResidentScript(
+                script_path,
+                int(options.get("pool", 1)),
+                float(options.get("idle", 300)),
+            )
+        schedule = options.get("schedule")
+        if schedule:
+            # the rooms the output of scheduled runs goes to, by default
+            # those of TMB_SCHEDULE_ROOMS
+            rooms = options.get("schedule_rooms", self.schedule_rooms).replace(",", " ").split()
+            try:
+                if not rooms:
+                    raise ValueError("no schedule_rooms")
+                self._jobs[script_path] = {
+                    "schedule": Schedule(schedule),
+                    "rooms": rooms,
+                    # the message a scheduled run gets, as if it was sent
+                    "args": options.get("schedule_args", ""),
+                    # seconds a run is delayed by at most, so scripts that
+                    # are due at the same time do not all start at once
+                    "jitter": float(options.get("schedule_jitter", 0)),
+                }
+            except ValueError as e:
+                print(f"script {script_name} has an invalid schedule ({e}), not scheduling it")
+        print(f"script {script_name} loaded with regex {script_regex}")
+        return script_regex
+
+    async def _load_scripts(self, scripts_path):
+        scripts = {}
+        script_paths = self._list_scripts(scripts_path)
+        script_configs = await self._read_script_configs(scripts_path, script_paths)
+        for script_path in script_paths:
+            script_regex = self._add_script(script_path, script_configs[script_path])
+            if script_regex:
+                scripts[script_path] = script_regex
         return scripts
 
+    async def _reload_scripts(self, names):
+        # only the added, changed and removed scripts are probed
+        started = time.monotonic()
+        script_paths = {os.path.join(self.scripts_path, name) for name in names}
+        candidates = self._list_scripts(self.scripts_path, names)
+        script_configs = await self._read_script_configs(
+            self.scripts_path,
+            candidates,
+            [p for p in self._scripts if p not in script_paths],
+        )
+        # nothing is awaited from here until the new triggers are in place,
+        # runs in progress keep the options they were started with
+        scripts = dict(self._scripts)
+        closed = []
+        for script_path in sorted(script_paths):
+            if script_path not in scripts and script_path not in candidates:
+                continue
+            scripts.pop(script_path, None)
+            self._script_options.pop(script_path, None)
+            self._script_limits.pop(script_path, None)
+            self._jobs.pop(script_path, None)
+            if script_path in self._resident:
+                closed.append(self._resident.pop(script_path))
+            script_regex = None
+            if script_path in candidates:
+                script_regex = self._add_script(script_path, script_configs[script_path])
+            if script_regex:
+                scripts[script_path] = script_regex
+            else:
+                print(f"script {os.path.basename(script_path)} removed")
+        self._scripts = scripts
+        self._triggers = TriggerIndex(
+            ((script_regex, script_path) for script_path, script_regex in scripts.items()),
+            self._triggers,
+        )
+        if self._timetable:
+            self._timetable.update(self._jobs)
+        for resident in closed:
+            await resident.close()
+        self._metrics.children_cpu()
+        print(
+            f"reload probed {len(candidates)} scripts and took"
+            f" {(time.monotonic() - started) * 1000:.0f} ms, {len(scripts)} scripts loaded"
+        )
+
+    async def _watch_scripts(self):
+        watcher = DirectoryWatcher([self.scripts_path], float(self.reload_interval))
+        try:
+            while True:
+                names = {name for _, name in await watcher.wait()}
+                if None in names:
+                    names = set(os.listdir(self.scripts_path)) | {
+                        os.path.basename(p) for p in self._scripts
+                    }
+                try:
+                    await self._reload_scripts(names)
+                except Exception:
+                    print(traceback.format_exc().strip())
+        finally:
+            watcher.close()
+
     def __init__(self):
         required_env_vars = ["TMB_HOMESERVER", "TMB_ACCESS_TOKEN", "TMB_USER_ID"]
         for env_var in os.environ:
@@ -94,10 +1682,136 @@ class TinyMatrixBot:
                 os.path.dirname(os.path.realpath(__file__)),
                 "scripts-enabled"
             )
-        if os.path.isdir(self.scripts_path):
-            self._scripts = self._load_scripts(self.scripts_path)
+        if self.run_path is None:
+            self.run_path = os.path.join(
+                os.path.dirname(os.path.realpath(__file__)), "run"
+            )
+        # with more than one worker process the rooms are split between them,
+        # see ShardSupervisor, each worker serves its metrics on a port of its own
+        if self.worker is not None and int(self.metrics_port) > 0:
+            self.metrics_port = int(self.metrics_port) + 1 + int(self.worker)
+        self._start_timestamp = time.time() * 1000
+        self._jobs = {}
+        self._plugins = {}
+        self._receipts = {}
+        self._resident = {}
+        self._seen_events = OrderedDict()
+        self._cache = ResultCache(int(self.cache_size))
+        # metrics are only collected if they are served or dumped
+        self._metrics = Metrics(
+            int(self.metrics_port) > 0 or float(self.metrics_interval) > 0
+        )
+        self._busy_sent = {}
+        self._limits = self._read_limits(
+            {"sender_rate": self.sender_rate, "room_rate": self.room_rate}, None
+        )
+        self._script_limits = {}
+        self._script_options = {}
+        self._script_runs = {}
+        self._tasks = set()
+
+    async def _setup_scripts(self):
+        if not os.path.isdir(self.scripts_path):
+            return
+        self._scripts = await self._load_scripts(self.scripts_path)
+        self._triggers = TriggerIndex(
+            (script_regex, script_path)
+            for script_path, script_regex in self._scripts.items()
+        )
+
+    def _sync_filter(self):
+        # the server only sends what the bot reads, messages and membership
+        # changes, and the members of a room only as far as they sent them
+        if self.sync_filter in ("", "0"):
+            return None
+        return {
+            "presence": {"types": []},
+            "account_data": {"types": []},
+            "room": {
+                "state": {"lazy_load_members": True},
+                "timeline": {
+                    "limit": int(self.timeline_limit),
+                    "types": ["m.room.message", "m.room.member"],
+                },
+                "ephemeral": {"types": []},
+                "account_data": {"types": []},
+            },
+        }
+
+    def _sync_token_path(self):
+        if self.save_sync_token in ("", "0"):
+            return None
+        return os.path.join(self.run_path, "sync_token.json")
+
+    def _load_sync_token(self):
+        sync_token_path = self._sync_token_path()
+        if not sync_token_path:
+            return ""
+        try:
+            with open(sync_token_path, encoding="utf-8") as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return ""
+        # a token of another account or server is of no use
+        if saved.get("homeserver") != self.homeserver:
+            return ""
+        if saved.get("user_id") != self.user_id:
+            return ""
+        return saved.get("next_batch", "")
+
+    def _save_sync_token(self):
+        sync_token_path = self._sync_token_path()
+        if not sync_token_path or not self._client.next_batch:
+            return
+        self._sync_token_saved = time.monotonic()
+        try:
+            with open(sync_token_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(
+                    {
+                        "homeserver": self.homeserver,
+                        "user_id": self.user_id,
+                        "next_batch": self._client.next_batch,
+                    },
+                    f,
+                )
+            os.replace(sync_token_path + ".tmp", sync_token_path)
+        except OSError as e:
+            print(f"sync token {sync_token_path} not written: {e}")
+
+    def _seen(self, event_id):
+        # remembers the last event_window event ids
+        if event_id in self._seen_events:
+            return True
+        self._seen_events[event_id] = None
+        if len(self._seen_events) > int(self.event_window):
+            self._seen_events.popitem(last=False)
+        return False
+
+    async def _send_receipts(self):
+        # only the newest event of every room gets a read receipt
+        receipts, self._receipts = self._receipts, {}
+        await asyncio.gather(
+            *(
+                self._client.update_receipt_marker(room_id, event_id)
+                for room_id, event_id in receipts.items()
+            )
+        )
+
+    async def _flush_receipts(self):
+        while True:
+            await asyncio.sleep(float(self.receipt_interval))
+            if self._receipts:
+                await self._send_receipts()
 
     async def _on_error(self, response):
+        # nio waits and retries on rate limits by itself
+        if response.status_code == "M_LIMIT_EXCEEDED":
+            return
+        if not self._initial_sync_done and self._client.loaded_sync_token:
+            # the saved token may have expired, sync from scratch instead
+            print(f"sync with saved token failed ({response}), doing a full sync")
+            self._client.loaded_sync_token = ""
+            return
         if self._client:
             await self._client.close()
         raise Exception(response)
@@ -108,6 +1822,9 @@ class TinyMatrixBot:
             for room_id in self._client.rooms:
                 print(f"joined room {room_id}")
             print("initial sync done, ready for work")
+            self._save_sync_token()
+        elif time.monotonic() - self._sync_token_saved >= 5:
+            self._save_sync_token()
 
     async def _on_invite(self, room, event):
         if not re.search(self.accept_invites, event.sender, re.IGNORECASE):
@@ -118,52 +1835,372 @@ class TinyMatrixBot:
             await self._client.join(room.room_id)
 
     async def _on_message(self, room, event):
-        await self._client.update_receipt_marker(room.room_id, event.event_id)
+        self._receipts[room.room_id] = event.event_id
+        if float(self.receipt_interval) <= 0:
+            await self._send_receipts()
         if event.sender == self._client.user_id:
             return
-        if event.server_timestamp <= self._last_event_timestamp:
+        # messages sent while the bot was not running are not answered
+        if event.server_timestamp <= self._start_timestamp:
             return
-        self._last_event_timestamp = event.server_timestamp
+        if self._seen(event.event_id):
+            return
+        if self._supervisor:
+            await self._supervisor.send(
+                room.room_id, {"room_id": room.room_id, "event": event.source}
+            )
+            return
+        self._dispatch(room, event)
+
+    def _dispatch(self, room, event):
+        received = time.monotonic()
+        self._metrics.add("events_total")
+        self._metrics.observe(
+            "event_lag_seconds", time.time() - event.server_timestamp / 1000
+        )
         if not self._scripts:
             print("no scripts")
             return
-        for script_path, script_regex in self._scripts.items():
-            if not re.search(script_regex, event.body, re.IGNORECASE):
+        script_paths = self._triggers.match(event.body)
+        self._metrics.observe("dispatch_seconds", time.monotonic() - received)
+        # triggered scripts are run by the scheduler's workers, so the sync
+        # loop never waits for a script and the rooms take turns
+        for script_path in script_paths:
+            limits = self._limits + self._script_limits.get(script_path, [])
+            if self._scheduler.admit(
+                limits, room.room_id, event.sender
+            ) and self._scheduler.submit(
+                room.room_id,
+                event.sender,
+                functools.partial(
+                    self._handle_script,
+                    [room.room_id],
+                    event.sender,
+                    event.body,
+                    script_path,
+                    received,
+                ),
+                self._slots(script_path),
+            ):
                 continue
-            script_name = os.path.basename(script_path)
-            print(f"script {script_name} triggered in {room.room_id}")
-            script_output = self._run_script(
-                script_path,
-                {
-                    "TMB_ROOM_ID": room.room_id,
-                    "TMB_SENDER": event.sender,
-                    "TMB_BODY": event.body,
-                },
-            )
-            if not script_output:
-                continue
-            print(f"sending message to {room.room_id}")
-            await self._client.room_typing(room.room_id, True)
-            for message_body in script_output.split("\n\n"):
-                time.sleep(0.8)
-                await self._client.room_send(
-                    room_id=room.room_id,
-                    message_type="m.room.message",
-                    content={"msgtype": "m.text", "body": message_body},
+            print(f"script {os.path.basename(script_path)} refused in {room.room_id}, busy")
+            self._reply_busy(room.room_id, event.sender)
+
+    def _slots(self, script_path):
+        # at most max_script_runs runs of a script at the same time, the
+        # scheduler takes a slot before it starts a run
+        return self._script_runs.setdefault(
+            script_path, asyncio.Semaphore(int(self.max_script_runs))
+        )
+
+    def _reply_busy(self, room_id, sender):
+        # at most one busy reply per busy_interval for a sender in a room
+        if not self.busy_message:
+            return
+        now = time.monotonic()
+        interval = float(self.busy_interval)
+        if now - self._busy_sent.get((room_id, sender), -interval) < interval:
+            return
+        if len(self._busy_sent) > 1024:
+            self._busy_sent = {
+                k: v for k, v in self._busy_sent.items() if now - v < interval
+            }
+        self._busy_sent[(room_id, sender)] = now
+        self._outbox.put(room_id, self.busy_message)
+
+    async def _handle_script(self, room_ids, sender, body, script_path, received=None):
+        # the output goes to every room, a triggered run has one, a
+        # scheduled run those of its schedule
+        script_name = os.path.basename(script_path)
+        print(f"script {script_name} triggered in {', '.join(room_ids)}")
+        script_env = {
+            "TMB_ROOM_ID": room_ids[0],
+            "TMB_SENDER": sender,
+            "TMB_BODY": body,
+        }
+        # scripts can ask for their output to be reused for cache_ttl seconds,
+        # otherwise to have it sent while they run and to show their progress
+        options = self._script_options.get(script_path, {})
+        cache_ttl = float(options.get("cache_ttl", 0))
+        stream = cache_ttl <= 0 and options.get("stream") in ("1", "true", "yes")
+        progress_interval = float(options.get("progress", 0)) if cache_ttl <= 0 else 0
+
+        def deliver(output):
+            for message_body in output.split("\n\n"):
+                if message_body.strip():
+                    for room_id in room_ids:
+                        self._outbox.put(room_id, message_body, script_name, received)
+
+        async def run():
+            self._metrics.add("scripts_in_flight", script=script_name)
+            started = time.monotonic()
+            progress = None
+            if progress_interval > 0:
+                progress = ProgressMessage(
+                    self._client,
+                    self._outbox.bucket,
+                    room_ids[0],
+                    script_name,
+                    progress_interval,
+                )
+            try:
+                # plugins and static replies run nothing
+                if script_path in self._plugins:
+                    return await self._run_plugin(script_path, script_env)
+                if options.get("mode") == "static":
+                    return options.get("reply", "")
+                if script_path in self._resident:
+                    return await self._run_resident_script(script_path, script_env)
+                output = await self._run_script(
+                    script_path, script_env, deliver if stream else None
+                )
+                self._metrics.add(
+                    "script_cpu_seconds_total",
+                    self._metrics.children_cpu(),
+                    script=script_name,
                 )
-            await self._client.room_typing(room.room_id, False)
+                return output
+            finally:
+                self._metrics.add("scripts_in_flight", -1, script=script_name)
+                self._metrics.observe(
+                    "script_wall_seconds",
+                    time.monotonic() - started,
+                    script=script_name,
+                )
+                if progress:
+                    await progress.stop()
+
+        try:
+            if cache_ttl > 0:
+                key = (script_path, " ".join(body.split()))
+                if options.get("cache_per_room") in ("1", "true", "yes"):
+                    key += (room_ids[0],)
+                script_output = await self._cache.get(key, cache_ttl, run)
+            else:
+                script_output = await run()
+            if not script_output:
+                return
+            deliver(script_output)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            print(traceback.format_exc().strip())
+
+    def _start_job(self, script_path, done):
+        # a scheduled run waits in the run queue of its first room like a
+        # triggered run, but the sender and room limits do not apply;
+        # False if it was refused, see Timetable
+        job = self._jobs.get(script_path)
+        if job is None:
+            return False
+
+        async def run():
+            try:
+                await self._handle_script(job["rooms"], self.user_id, job["args"], script_path)
+            finally:
+                done()
+
+        return self._scheduler.submit(
+            job["rooms"][0], self.user_id, run, self._slots(script_path)
+        )
+
+    async def _run_plugin(self, script_path, script_env):
+        # a plain function runs on the event loop and must not block, slow
+        # plugins should be coroutine functions
+        try:
+            output = self._plugins[script_path](
+                script_env["TMB_ROOM_ID"],
+                script_env["TMB_SENDER"],
+                script_env["TMB_BODY"],
+                self._script_options.get(script_path, {}),
+            )
+            if asyncio.iscoroutine(output):
+                timeout = float(self.script_timeout)
+                output = await asyncio.wait_for(output, timeout if timeout > 0 else None)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            print(traceback.format_exc().strip())
+            return False
+        return "" if output is None else str(output).strip()
+
+    async def _run_resident_script(self, script_path, script_env):
+        script_name = os.path.basename(script_path)
+        print(f"requesting resident script {script_name} with env {script_env}")
+        timeout = float(self.script_timeout)
+        try:
+            response = await self._resident[script_path].request(
+                script_env, timeout if timeout > 0 else None
+            )
+        except asyncio.TimeoutError:
+            print(f"  script {script_name} killed after {timeout:g} seconds")
+            return False
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            print(traceback.format_exc().strip())
+            return False
+        if response.get("returncode", 0) != 0:
+            print("  non-zero exit code")
+            return False
+        output = str(response.get("output", "")).strip()
+        if not output:
+            print("  no output")
+            return False
+        return output
+
+    async def _read_supervisor(self):
+        # the supervisor hands this worker the messages of its rooms on
+        # stdin, one JSON line with room_id and event each
+        reader = asyncio.StreamReader(limit=2**20)
+        await asyncio.get_running_loop().connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), sys.stdin
+        )
+        rooms = {}  # room_id -> MatrixRoom
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line)
+                room = rooms.get(request["room_id"])
+                if room is None:
+                    room = rooms[request["room_id"]] = nio.MatrixRoom(
+                        request["room_id"], self.user_id
+                    )
+                event = nio.Event.parse_event(request["event"])
+                if isinstance(event, nio.RoomMessageText):
+                    self._dispatch(room, event)
+            except Exception:
+                print(traceback.format_exc().strip())
+        print("supervisor is gone, exiting")
+
+    async def _dump_metrics(self):
+        metrics_path = os.path.join(self.run_path, "metrics.json")
+        if self.worker is not None:
+            metrics_path = os.path.join(self.run_path, f"metrics-{self.worker}.json")
+        while True:
+            await asyncio.sleep(float(self.metrics_interval))
+            self._metrics.dump(metrics_path)
+
+    async def _prune_buckets(self):
+        while True:
+            await asyncio.sleep(60)
+            self._scheduler.prune()
+
+    async def _reap_resident_scripts(self):
+        while True:
+            await asyncio.sleep(5)
+            for resident in self._resident.values():
+                await resident.reap()
 
     async def run(self):
+        # max_scripts workers run the scripts
+        self._scheduler = Scheduler(
+            int(self.max_scripts), int(self.queue_size), self._metrics
+        )
+        await self._setup_scripts()
+        # the CPU time of the probes does not belong to any script run
+        self._metrics.children_cpu()
+        metrics_server = None
+        if int(self.metrics_port) > 0:
+            try:
+                metrics_server = await asyncio.start_server(
+                    self._metrics.serve, self.metrics_address, int(self.metrics_port)
+                )
+                print(
+                    f"metrics on http://{self.metrics_address}:{self.metrics_port}/metrics"
+                )
+            except OSError as e:
+                print(f"metrics endpoint not available: {e}")
+        if float(self.metrics_interval) > 0:
+            task = asyncio.create_task(self._dump_metrics())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        # a reload can add resident scripts
+        if self._resident or (self._scripts is not None and self.reload not in ("", "0")):
+            task = asyncio.create_task(self._reap_resident_scripts())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        # the supervisor of a sharded bot only probes the scripts, so the
+        # workers find them in the manifest
+        sharded = self.worker is None and int(self.worker_processes) > 1
+        # added, changed and removed scripts are picked up without a restart
+        if self._scripts is not None and self.reload not in ("", "0") and not sharded:
+            task = asyncio.create_task(self._watch_scripts())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        task = asyncio.create_task(self._prune_buckets())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        if float(self.receipt_interval) > 0:
+            task = asyncio.create_task(self._flush_receipts())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
         print(f"connecting to {self.homeserver}")
         self._client = nio.AsyncClient(self.homeserver, proxy=self.proxy)
         self._client.access_token = self.access_token
         self._client.device_id = "TinyMatrixBot"
         self._client.user_id = self.user_id
+        # continue where the last run stopped instead of a full initial sync
+        self._client.loaded_sync_token = self._load_sync_token()
+        if self._client.loaded_sync_token:
+            print("resuming sync from saved token")
+        self._outbox = Outbox(
+            self._client,
+            TokenBucket(float(self.send_rate), int(self.send_burst)),
+            int(self.coalesce_size),
+            self._metrics,
+        )
+        # scripts with a schedule are run by the bot itself instead of cron,
+        # by the first worker of a sharded bot
+        if self._scripts is not None and not sharded and self.worker in (None, "0"):
+            self._timetable = Timetable(self._start_job, self._metrics)
+            self._timetable.update(self._jobs)
+        if self.worker is not None:
+            try:
+                await self._read_supervisor()
+            finally:
+                await self._close(metrics_server)
+            return
+        if sharded:
+            self._supervisor = ShardSupervisor(
+                [sys.executable, os.path.realpath(__file__)],
+                int(self.worker_processes),
+                self._metrics,
+            )
+            self._supervisor.start()
         self._client.add_response_callback(self._on_error, nio.SyncError)
+        # nio passes rate limited responses to the callbacks before it
+        # sleeps and retries, the outbox holds back all rooms meanwhile
+        self._client.add_response_callback(
+            self._outbox.on_rate_limit, nio.ErrorResponse
+        )
         self._client.add_response_callback(self._on_sync, nio.SyncResponse)
         self._client.add_event_callback(self._on_invite, nio.InviteMemberEvent)
         self._client.add_event_callback(self._on_message, nio.RoomMessageText)
-        await self._client.sync_forever(timeout=30000)
+        try:
+            await self._client.sync_forever(
+                timeout=30000, sync_filter=self._sync_filter()
+            )
+        finally:
+            await self._close(metrics_server)
+
+    async def _close(self, metrics_server):
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._supervisor:
+            await self._supervisor.close()
+        if self._timetable:
+            await self._timetable.close()
+        await self._scheduler.close()
+        await self._outbox.close()
+        if self._receipts:
+            await self._send_receipts()
+        self._save_sync_token()
+        if metrics_server:
+            metrics_server.close()
         await self._client.close()
 
 
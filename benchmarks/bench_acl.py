@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""Per-message cost of the legacy bot when most scripts are restricted to admin rooms.
+
+The scripts get a whitelist of two admin rooms, except for a few public
+ones (or none). Messages, a mix of chatter and commands, arrive in the
+admin rooms and in many other rooms. Measured is on_room_event up to the
+point where a run is handed to the scheduler, once with every room
+matching against all triggers and checking the ACL afterwards (the old
+behaviour) and once with the per-room trigger sets.
+
+    python3 benchmarks/bench_acl.py [scripts] [rooms]
+"""
+
+import logging
+import random
+import shutil
+import sys
+import tempfile
+
+import common
+
+ADMIN_ROOMS = ["!admin0:localhost", "!admin1:localhost"]
+WHITELIST = "|".join(room.replace("!", "\\!") for room in ADMIN_ROOMS)
+
+
+class Room():
+
+    def __init__(self, room_id):
+        self.room_id = room_id
+
+
+class Client():
+    user_id = "@bot:localhost"
+
+
+class Scheduler():
+    """Accepts every run without running it."""
+
+    def admit(self, limits, room_id, sender):
+        return True
+
+    def submit(self, room_id, sender, run, slots=None):
+        return True
+
+
+def make_bot(module, scripts_path, count, public):
+    config = "[tiny-matrix-bot]\n"
+    for i in range(public, count):
+        config += "[cmd{}]\nwhitelist = {}\n".format(i, WHITELIST)
+    bot = common.make_legacy_bot(module, config)
+    bot.index_triggers(bot.load_scripts(scripts_path, None))
+    bot.client = Client()
+    bot.scheduler = Scheduler()
+    bot.limits = []
+    return bot
+
+
+def events(count, rooms, number, seed=42):
+    rng = random.Random(seed)
+    room_ids = ADMIN_ROOMS + ["!room{}:localhost".format(i) for i in range(rooms)]
+    texts = ["hi all", "what do you think about the release?", "ok", "lol"] + [
+        "cmd{} foo".format(i) for i in range(count)]
+    return [(Room(room_id), {
+        "type": "m.room.message",
+        "room_id": room_id,
+        "sender": "@user{}:localhost".format(rng.randrange(20)),
+        "content": {"msgtype": "m.text", "body": rng.choice(texts)},
+    }) for room_id in (rng.choice(room_ids) for _ in range(number))]
+
+
+def per_event(bot, batch, prefilter):
+    bot.room_triggers = {}
+    if not prefilter:
+        bot.room_triggers = {room.room_id: bot.triggers for room, _ in batch}
+
+    def run():
+        for room, event in batch:
+            bot.on_room_event(room, event)
+    return common.timeit(run) / len(batch)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    rooms = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    logging.disable(logging.INFO)
+    module = common.legacy_bot()
+    scripts_path = tempfile.mkdtemp()
+    try:
+        common.write_scripts(scripts_path, count, probes=0)
+        batch = events(count, rooms, 20000)
+        print("{} scripts, {} rooms besides the 2 admin rooms".format(count, rooms))
+        print("public scripts   all triggers + ACL   per-room triggers")
+        for public in (5, 0):
+            bot = make_bot(module, scripts_path, count, public)
+            before = per_event(bot, batch, False)
+            after = per_event(bot, batch, True)
+            print("{:>14} {:>17.2f} us {:>17.2f} us".format(
+                public, before * 1e6, after * 1e6))
+    finally:
+        shutil.rmtree(scripts_path)
+
+
+if __name__ == "__main__":
+    main()
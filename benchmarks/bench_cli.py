@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Latency of sending one message from the CLI of the legacy bot.
+
+Compares, against a local fake homeserver with many rooms:
+
+- full client: connect and initial sync, then send (the old CLI path)
+- direct: a single send request without syncing (the new CLI fallback)
+- socket: hand the message to a running bot over its delivery socket
+
+and the same for whole "tiny-matrix-bot.py -r ROOM -m MESSAGE" processes,
+which additionally pay for the interpreter start and the imports.
+
+    python3 benchmarks/bench_cli.py [rooms] [members per room] [delay in ms]
+"""
+
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+
+import common
+from fakeserver import FakeHomeserver
+from matrix_client.client import MatrixClient
+
+ROOM = "!room0:localhost"
+
+
+def main():
+    rooms = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    members = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    delay = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 10 / 1000
+    logging.basicConfig(level=logging.WARNING)
+    module = common.legacy_bot()
+    hs = FakeHomeserver(rooms=rooms, members=members, delay=delay).start()
+    run_path = tempfile.mkdtemp()
+    socket_path = os.path.join(run_path, "bench.sock")
+    config_path = os.path.join(run_path, "bench.cfg")
+    with open(config_path, "w") as f:
+        f.write("[tiny-matrix-bot]\nbase_url = {}\ntoken = token\n"
+                "run_path = {}\nsocket_path = {}\n".format(hs.url, run_path, socket_path))
+
+    def sent(func):
+        # time until the homeserver has received the message
+        def measure():
+            count = len(hs.sent)
+            func()
+            hs.wait_sent(count + 1)
+        return measure
+
+    client_bot = common.make_legacy_bot(module, base_url=hs.url, token="token",
+                                        socket_path=None)
+    running_bot = common.make_legacy_bot(
+        module, base_url=hs.url, token="token", socket_path=socket_path,
+        outbox=module.Outbox(module.TokenBucket(1000, 1000), 0))
+    running_bot.connect()
+    running_bot.start_socket_server()
+    cli_bot = common.make_legacy_bot(module, socket_path=socket_path)
+
+    def full_client():
+        MatrixClient(hs.url, token="token").rooms[ROOM].send_text("ping")
+
+    timings = [
+        ("full client", common.timeit(sent(full_client), repeat=5)),
+        ("direct", common.timeit(sent(lambda: client_bot.send_direct(ROOM, "text", "ping")),
+                                 repeat=20)),
+        ("socket", common.timeit(sent(lambda: cli_bot.send_via_socket(ROOM, "text", "ping")),
+                                 repeat=20)),
+    ]
+
+    env = dict(os.environ, CONFIG=config_path)
+    command = [sys.executable, os.path.join(common.ROOT_PATH, "tiny-matrix-bot.py"),
+               "-r", ROOM, "-m", "ping"]
+
+    def process():
+        subprocess.run(command, env=env, check=True)
+
+    timings.append(("process, socket", common.timeit(sent(process), repeat=5)))
+    with open(config_path, "a") as f:
+        f.write("socket = false\n")
+    timings.append(("process, direct", common.timeit(sent(process), repeat=5)))
+
+    print("{} rooms with {} members, {:.0f} ms per request".format(
+        rooms, members, delay * 1000))
+    for name, seconds in timings:
+        print("{:<18}{:>10.1f} ms".format(name, seconds * 1000))
+    hs.stop()
+
+
+if __name__ == "__main__":
+    main()
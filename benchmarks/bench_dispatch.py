@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""Micro-benchmark of the per-message trigger dispatch cost.
+
+Compares the old linear re.search() loop over all scripts with the
+TriggerIndex of both bots while the number of scripts grows from the
+30-odd sample scripts to 5,000 synthetic ones.
+
+    python3 benchmarks/bench_dispatch.py [counts ...]
+"""
+
+import random
+import re
+import string
+import sys
+
+import common
+
+SHAPES = [
+    "^{w}$|^{w} .*$",
+    "^!?{w}(!|\\?)?$",
+    "^{w}$|^{v}$|^{w} .*$|^{v} .*$",
+    "^{w}|^{w} .*",
+    "{w}|^{w} .*$",
+]
+MESSAGES = [
+    "ping",
+    "!ping?",
+    "rss pine 2",
+    "weather Lima",
+    "what do you all think about the new release?",
+    "lol",
+    "Has anyone seen the twitter thread about tesla",
+    "help",
+    "ok thanks, see you tomorrow",
+    "date",
+]
+
+
+def word(rng):
+    return "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 9)))
+
+
+def synthetic_triggers(count, seed=42):
+    rng = random.Random(seed)
+    triggers = common.sample_triggers()
+    while len(triggers) < count:
+        shape = rng.choice(SHAPES)
+        triggers.append(shape.format(w=word(rng), v=word(rng)))
+    return triggers[:count]
+
+
+def naive_match(triggers, text):
+    return [t for t in triggers if re.search(t, text, re.IGNORECASE)]
+
+
+def main():
+    counts = [int(c) for c in sys.argv[1:]] or [30, 100, 300, 1000, 5000]
+    legacy = common.legacy_bot()
+    nio = common.nio_bot()
+    print("{:>6} {:>14} {:>14} {:>14} {:>9}".format(
+        "scripts", "linear us/msg", "legacy us/msg", "nio us/msg", "speed-up"))
+    for count in counts:
+        triggers = synthetic_triggers(count)
+        legacy_index = legacy.TriggerIndex([(t, t) for t in triggers])
+        nio_index = nio.TriggerIndex([(t, t) for t in triggers])
+        for text in MESSAGES:
+            expected = naive_match(triggers, text)
+            assert legacy_index.match(text) == expected, text
+            assert nio_index.match(text) == expected, text
+
+        def run(match):
+            def dispatch():
+                for text in MESSAGES:
+                    match(text)
+            return dispatch
+
+        number = max(1, 2000 // count)
+        per_message = 1e6 / (number * len(MESSAGES))
+        linear = common.timeit(run(lambda text: naive_match(triggers, text)), number=number) * per_message
+        indexed = common.timeit(run(legacy_index.match), number=number) * per_message
+        nio_indexed = common.timeit(run(nio_index.match), number=number) * per_message
+        print("{:>7} {:>14.1f} {:>14.1f} {:>14.1f} {:>8.0f}x".format(
+            count, linear, indexed, nio_indexed, linear / indexed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""Latency of other rooms while one sender floods a bot with a CPU heavy command.
+
+One sender sends a burst of "slow" messages to the first room, the script
+behind it keeps a CPU busy for a moment, like top or ps on a small host.
+Meanwhile a sender of its own in every other room sends "ping" a few
+times. Reported are the 50th and 99th percentile of the ping reply
+latency, how many slow runs were answered and refused, and how busy the
+host's CPUs were until the last ping was answered, once without limits
+and once with a sender limit and a queue cap.
+
+    python3 benchmarks/bench_fairness.py [--bots legacy nio] [--rooms 10]
+        [--flood 100] [--pings 5]
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from bench_load import percentile, start_bot, wait_ready
+from fakeserver import FakeHomeserver
+
+ABUSER = "@abuser:localhost"
+BUSY = "Busy, please try again later."
+WORKERS = 4
+
+SLOW = """#!/bin/bash
+if [ -n "$CONFIG" ]; then
+    echo '^slow$'
+    exit 0
+fi
+timeout 0.3 bash -c 'while :; do :; done'
+echo "slow done"
+"""
+
+PING = """#!/bin/bash
+if [ -n "$CONFIG" ]; then
+    echo '^ping$'
+    exit 0
+fi
+echo "pong"
+"""
+
+# (name, legacy config, nio environment)
+SETTINGS = [
+    ("unlimited", "queue_size = 0\n", {"TMB_QUEUE_SIZE": "0"}),
+    ("limited", "queue_size = 20\nsender_rate = 1\nsender_burst = 5\n",
+     {"TMB_QUEUE_SIZE": "20", "TMB_SENDER_RATE": "1", "TMB_SENDER_BURST": "5"}),
+]
+
+
+def cpu_times():
+    # busy and total jiffies of all CPUs
+    with open("/proc/stat") as f:
+        values = [int(v) for v in f.readline().split()[1:]]
+    idle = values[3] + values[4]
+    return sum(values) - idle, sum(values)
+
+
+def run(bot, rooms, flood, pings, config, bot_env):
+    hs = FakeHomeserver(rooms=rooms + 1, members=3).start()
+    run_path = tempfile.mkdtemp()
+    scripts_path = os.path.join(run_path, "scripts")
+    os.mkdir(scripts_path)
+    for name, script in (("slow", SLOW), ("ping", PING)):
+        with open(os.path.join(scripts_path, name), "w") as f:
+            f.write(script)
+        os.chmod(os.path.join(scripts_path, name), 0o755)
+    process = start_bot(
+        bot, hs, run_path, scripts_path,
+        config="max_workers = {}\n".format(WORKERS) + config,
+        TMB_MAX_SCRIPTS=str(WORKERS), **bot_env)
+    try:
+        wait_ready(hs, process)
+        flooded = "!room0:localhost"
+        room_ids = sorted(r for r in hs.rooms if r != flooded)
+        busy_before, total_before = cpu_times()
+        for _ in range(flood):
+            hs.inject(flooded, ABUSER, "slow")
+        injected = {}  # room_id -> injection times, in order
+        for _ in range(pings):
+            time.sleep(0.2)
+            for i, room_id in enumerate(room_ids):
+                injected.setdefault(room_id, []).append(time.monotonic())
+                hs.inject(room_id, "@user{}:localhost".format(i), "ping")
+        deadline = time.monotonic() + 300
+        while True:
+            replies = {}
+            for sent_time, room_id, content in list(hs.sent):
+                if content.get("body") == "pong":
+                    replies.setdefault(room_id, []).append(sent_time)
+            if all(len(replies.get(r, [])) >= pings for r in room_ids):
+                break
+            if time.monotonic() > deadline:
+                raise RuntimeError("not every ping was answered")
+            time.sleep(0.01)
+        busy_after, total_after = cpu_times()
+        latencies = []
+        for room_id, times in injected.items():
+            for n, injected_time in enumerate(times):
+                latencies.append(replies[room_id][n] - injected_time)
+        bodies = [content.get("body") for _, room_id, content in list(hs.sent)
+                  if room_id == flooded]
+        return (percentile(latencies, 0.5), percentile(latencies, 0.99),
+                bodies.count("slow done"), bodies.count(BUSY),
+                (busy_after - busy_before) / max(1, total_after - total_before))
+    finally:
+        process.terminate()
+        process.wait()
+        hs.stop()
+        shutil.rmtree(run_path)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--bots", nargs="+", default=["legacy", "nio"], choices=["legacy", "nio"])
+    ap.add_argument("--rooms", type=int, default=10, help="rooms besides the flooded one")
+    ap.add_argument("--flood", type=int, default=100, help="slow messages of the flooding sender")
+    ap.add_argument("--pings", type=int, default=5,
+                    help="pings per room, more than 5 are throttled when limited")
+    args = ap.parse_args()
+    print("{} slow messages, {} pings in each of {} rooms, {} workers".format(
+        args.flood, args.pings, args.rooms, WORKERS))
+    print("bot     settings    ping p50 ms  ping p99 ms  slow runs  busy  host CPU")
+    for bot in args.bots:
+        for name, config, bot_env in SETTINGS:
+            p50, p99, runs, busy, cpu = run(
+                bot, args.rooms, args.flood, args.pings, config, bot_env)
+            print("{:<7} {:<10} {:>12.1f} {:>12.1f} {:>10} {:>5} {:>8.0%}".format(
+                bot, name, p50 * 1000, p99 * 1000, runs, busy, cpu))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""Sync payload, start up time and memory of both bots with and without
+the sync filter.
+
+Every bot is started against a fake homeserver with many rooms of many
+members that also sends presence, typing and read receipts, like a busy
+server does. Then a storm of pings spread over the rooms is answered.
+Reported are the bytes of the initial sync, the time until the bot is
+ready, the sync bytes per message during the storm, messages per second
+and the peak RSS of the bot process.
+
+    python3 benchmarks/bench_filter.py [--bots legacy nio] [--rooms 200]
+        [--members 200] [--messages 500]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import common
+from bench_load import SENDER, peak_rss, start_bot, wait_ready
+from fakeserver import FakeHomeserver
+
+# (name, legacy config, nio environment)
+SETTINGS = [
+    ("unfiltered", "sync_filter = false\n", {"TMB_SYNC_FILTER": "0"}),
+    ("filtered", "", {}),
+]
+
+
+def run(bot, rooms, members, messages, config, bot_env):
+    hs = FakeHomeserver(rooms=rooms, members=members, chatter=True).start()
+    run_path = tempfile.mkdtemp()
+    scripts_path = os.path.join(run_path, "scripts")
+    os.mkdir(scripts_path)
+    shutil.copy(os.path.join(common.SCRIPTS_PATH, "ping"), scripts_path)
+    os.chmod(os.path.join(scripts_path, "ping"), 0o755)
+    started = time.monotonic()
+    process = start_bot(bot, hs, run_path, scripts_path, config, **bot_env)
+    try:
+        wait_ready(hs, process)
+        ready = time.monotonic() - started
+        initial = hs.bytes.get("GET sync", 0)
+        room_ids = sorted(hs.rooms)
+        storm_started = time.monotonic()
+        for i in range(messages):
+            hs.inject(room_ids[i % len(room_ids)], SENDER, "ping")
+        sent = hs.wait_sent(messages, timeout=600)
+        if len(sent) < messages:
+            raise RuntimeError("only {} of {} replies arrived".format(len(sent), messages))
+        elapsed = max(sent_time for sent_time, _, _ in sent) - storm_started
+        # the replies come back through the sync, too
+        time.sleep(1)
+        storm = hs.bytes.get("GET sync", 0) - initial
+        return initial, ready, storm / messages, messages / elapsed, peak_rss(process.pid)
+    finally:
+        process.terminate()
+        process.wait()
+        hs.stop()
+        shutil.rmtree(run_path)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--bots", nargs="+", default=["legacy", "nio"], choices=["legacy", "nio"])
+    ap.add_argument("--rooms", type=int, default=200)
+    ap.add_argument("--members", type=int, default=200)
+    ap.add_argument("--messages", type=int, default=500)
+    args = ap.parse_args()
+    print("{} rooms of {} members, {} messages".format(args.rooms, args.members, args.messages))
+    print("bot     sync        initial MB  ready s  sync KB/msg   msgs/s  RSS MB")
+    for bot in args.bots:
+        for name, config, bot_env in SETTINGS:
+            initial, ready, per_message, rate, rss = run(
+                bot, args.rooms, args.members, args.messages, config, bot_env)
+            print("{:<7} {:<10} {:>11.1f} {:>8.2f} {:>12.1f} {:>8.1f} {:>7.1f}".format(
+                bot, name, initial / 2**20, ready, per_message / 1024, rate, rss))
+            sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
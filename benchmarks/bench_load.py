@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""End-to-end load benchmark of both bots against a local fake homeserver.
+
+Every bot is started as its own process with the sample scripts ping,
+help and datetime, against a fake homeserver with 1, 50 and 500 rooms.
+A storm of messages spread round-robin over the rooms is injected and
+the replies are timed. Reported are messages per second, the 50th and
+99th percentile of the time from injecting a message until its (last)
+reply arrived, and the peak RSS of the bot process.
+
+    python3 benchmarks/bench_load.py [--bots legacy nio] [--rooms 1 50 500]
+        [--workloads ping help datetime] [--messages 200] [--json results.json]
+
+With --json the results are also written to a file, to compare runs
+before and after a change.
+"""
+
+import argparse
+import configparser
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import common
+from fakeserver import FakeHomeserver
+
+WORKLOAD_MESSAGES = {"ping": "ping", "help": "help", "datetime": "date"}
+# the sample script of a workload, ping is a static reply, datetime the
+# opt-in plugin
+WORKLOAD_SCRIPTS = {"ping": "ping", "help": "help", "datetime": "unused/datetime.py"}
+SENDER = "@user0:localhost"
+KICKED = "!kicked:localhost"
+
+
+def start_bot(bot, hs, run_path, scripts_path, config="", **bot_env):
+    """Start a bot process, config is added to the legacy bot's config
+    file, where it overrides the defaults, and bot_env to the nio bot's
+    environment."""
+    env = dict(os.environ)
+    if bot == "legacy":
+        parser = configparser.ConfigParser(interpolation=None)
+        parser.read_dict({"tiny-matrix-bot": {
+            "base_url": hs.url,
+            "token": "token",
+            "run_path": run_path,
+            "scripts_path": scripts_path,
+            "send_rate": "0",
+            "socket": "false",
+            "queue_size": "0",
+        }})
+        parser.read_string("[tiny-matrix-bot]\n" + config)
+        config_path = os.path.join(run_path, "bench.cfg")
+        with open(config_path, "w") as f:
+            parser.write(f)
+        env["CONFIG"] = config_path
+        command = [sys.executable, os.path.join(common.ROOT_PATH, "tiny-matrix-bot.py")]
+    else:
+        env.update({
+            "TMB_HOMESERVER": hs.url,
+            "TMB_ACCESS_TOKEN": "token",
+            "TMB_USER_ID": hs.user_id,
+            "TMB_RUN_PATH": run_path,
+            "TMB_SCRIPTS_PATH": scripts_path,
+            "TMB_SEND_RATE": "0",
+            "TMB_QUEUE_SIZE": "0",
+        })
+        env.update(bot_env)
+        command = [sys.executable, os.path.join(common.ROOT_PATH, "4nd3r_tiny-matrix-bot.py")]
+    return subprocess.Popen(
+        command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_ready(hs, process, timeout=120):
+    # the second sync request means the bot handled the first one
+    deadline = time.monotonic() + timeout
+    while hs.requests.get("GET sync", 0) < 2:
+        if process.poll() is not None:
+            raise RuntimeError("bot exited with {}".format(process.returncode))
+        if time.monotonic() > deadline:
+            raise RuntimeError("bot did not start within {} seconds".format(timeout))
+        time.sleep(0.05)
+
+
+def peak_rss(pid):
+    with open("/proc/{}/status".format(pid)) as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return 0
+
+
+def replies_per_message(hs, room_id, body):
+    """Send one message and count the replies it gets."""
+    before = len(hs.sent)
+    hs.inject(room_id, SENDER, body)
+    replies = hs.wait_sent(before + 1, timeout=60)
+    if len(replies) <= before:
+        raise RuntimeError("no reply to {}".format(body))
+    while True:
+        count = len(hs.sent)
+        time.sleep(0.5)
+        if len(hs.sent) == count:
+            return count - before
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run(bot, rooms, workload, messages, config="", kick=False, **bot_env):
+    """With kick the bot is kicked from a room of its own before the
+    storm, it has to go on answering in the others."""
+    hs = FakeHomeserver(rooms=rooms, members=5)
+    if kick:
+        hs.add_room(KICKED, 5)
+    hs.start()
+    run_path = tempfile.mkdtemp()
+    scripts_path = os.path.join(run_path, "scripts")
+    os.mkdir(scripts_path)
+    for script_name in WORKLOAD_SCRIPTS.values():
+        shutil.copy(os.path.join(common.SCRIPTS_PATH, script_name), scripts_path)
+        os.chmod(os.path.join(scripts_path, os.path.basename(script_name)), 0o755)
+    process = start_bot(bot, hs, run_path, scripts_path, config, **bot_env)
+    try:
+        wait_ready(hs, process)
+        if kick:
+            syncs = hs.requests.get("GET sync", 0)
+            initial = hs.initial_syncs
+            hs.kick(KICKED, SENDER)
+            # the sync after the one with the leave means it was handled
+            while hs.requests.get("GET sync", 0) < syncs + 2:
+                if process.poll() is not None:
+                    raise RuntimeError("bot exited with {}".format(process.returncode))
+                time.sleep(0.05)
+            # an exception in a listener makes the legacy bot connect again
+            if hs.initial_syncs != initial:
+                raise RuntimeError("bot connected again after the leave")
+        room_ids = sorted(hs.joined)
+        body = WORKLOAD_MESSAGES[workload]
+        per_message = replies_per_message(hs, room_ids[0], body)
+        before = len(hs.sent)
+        injected = {}  # room_id -> injection times, in order
+        started = time.monotonic()
+        for i in range(messages):
+            room_id = room_ids[i % len(room_ids)]
+            injected.setdefault(room_id, []).append(time.monotonic())
+            hs.inject(room_id, SENDER, body)
+        sent = hs.wait_sent(before + messages * per_message, timeout=600)[before:]
+        if len(sent) < messages * per_message:
+            raise RuntimeError("only {} of {} replies arrived".format(
+                len(sent), messages * per_message))
+        # replies leave a room in order, so the n-th group of replies in a
+        # room answers the n-th message sent to it
+        replies = {}
+        for sent_time, room_id, _ in sent:
+            replies.setdefault(room_id, []).append(sent_time)
+        latencies = []
+        for room_id, times in injected.items():
+            for n, injected_time in enumerate(times):
+                latencies.append(replies[room_id][(n + 1) * per_message - 1] - injected_time)
+        elapsed = max(sent_time for sent_time, _, _ in sent) - started
+        return messages / elapsed, percentile(latencies, 0.5), percentile(latencies, 0.99), \
+            peak_rss(process.pid)
+    finally:
+        process.terminate()
+        process.wait()
+        hs.stop()
+        shutil.rmtree(run_path)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--bots", nargs="+", default=["legacy", "nio"], choices=["legacy", "nio"])
+    ap.add_argument("--rooms", nargs="+", type=int, default=[1, 50, 500])
+    ap.add_argument("--workloads", nargs="+", default=list(WORKLOAD_MESSAGES),
+                    choices=list(WORKLOAD_MESSAGES))
+    ap.add_argument("--messages", type=int, default=200)
+    ap.add_argument("--json", help="also write the results to this file")
+    args = ap.parse_args()
+    results = []
+    print("{} messages per run".format(args.messages))
+    print("bot     rooms  workload   msgs/s   p50 ms   p99 ms  RSS MB")
+    for bot in args.bots:
+        for rooms in args.rooms:
+            for workload in args.workloads:
+                rate, p50, p99, rss = run(bot, rooms, workload, args.messages)
+                results.append({
+                    "bot": bot, "rooms": rooms, "workload": workload,
+                    "messages": args.messages, "messages_per_second": rate,
+                    "p50_seconds": p50, "p99_seconds": p99, "peak_rss_mb": rss,
+                })
+                print("{:<7} {:>5}  {:<9} {:>7.1f} {:>8.1f} {:>8.1f} {:>7.1f}".format(
+                    bot, rooms, workload, rate, p50 * 1000, p99 * 1000, rss))
+                sys.stdout.flush()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""Cost of the metrics calls made for every message, disabled and enabled.
+
+Per handled message the bots make about half a dozen metrics calls
+(events, lag, dispatch, in-flight, wall time, queue depth, reply latency).
+
+    python3 benchmarks/bench_metrics.py
+"""
+
+import common
+
+CALLS = 100000
+
+
+def per_message(metrics):
+    def run():
+        for _ in range(CALLS):
+            metrics.add("events_total")
+            metrics.observe("event_lag_seconds", 0.02)
+            metrics.observe("dispatch_seconds", 0.00002)
+            metrics.add("scripts_in_flight", script="ping")
+            metrics.add("scripts_in_flight", -1, script="ping")
+            metrics.observe("script_wall_seconds", 0.01, script="ping")
+            metrics.add("outbox_queue_depth")
+            metrics.add("outbox_queue_depth", -1)
+            metrics.observe("reply_latency_seconds", 0.05, script="ping")
+    return run
+
+
+def main():
+    print("bot     metrics   ns per message")
+    for name, module in (("legacy", common.legacy_bot()), ("nio", common.nio_bot())):
+        for enabled in (False, True):
+            seconds = common.timeit(per_message(module.Metrics(enabled)), repeat=3)
+            print("{:<7} {:<9} {:>14.0f}".format(
+                name, "enabled" if enabled else "disabled", seconds / CALLS * 1e9))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""Cost of answering ping and date in-process against running a script.
+
+ping is answered by the sample script run as a process and as a static
+reply from the config, date by the datetime script and by the
+datetime.py plugin from scripts/unused. Reported is the median time of one answer without
+sending it, for both bots; the nio bot's static reply is a lookup in
+the options of the script and is not measured.
+
+    python3 benchmarks/bench_plugins.py [--number 200]
+"""
+
+import argparse
+import asyncio
+import contextlib
+import logging
+import os
+import shutil
+import tempfile
+
+import common
+
+
+def write_scripts(path):
+    # ping-process is ping without mode=static
+    with open(os.path.join(common.SCRIPTS_PATH, "ping")) as f:
+        ping = f.read()
+    with open(os.path.join(path, "ping-process"), "w") as f:
+        f.write(ping.replace("echo 'mode=static'", ":"))
+    shutil.copy(os.path.join(common.SCRIPTS_PATH, "ping"), path)
+    shutil.copy(os.path.join(common.SCRIPTS_PATH, "datetime"), path)
+    shutil.copy(os.path.join(common.SCRIPTS_PATH, "unused", "datetime.py"), path)
+    for name in ("ping-process", "ping", "datetime"):
+        os.chmod(os.path.join(path, name), 0o755)
+
+
+def legacy(scripts_path, number):
+    module = common.legacy_bot()
+    bot = common.make_legacy_bot(module)
+    scripts = {script["name"]: script for script in bot.load_scripts(scripts_path, None)}
+    results = []
+    for label, name, args in (("ping, process", "ping-process", "ping"),
+                              ("ping, static reply", "ping", "ping"),
+                              ("date, process", "datetime", "date"),
+                              ("date, plugin", "datetime.py", "date")):
+        script = scripts[name]
+        env = dict(script["env"], __room_id="!room0:localhost", __sender="@user0:localhost")
+        seconds = common.timeit(lambda: bot.call_script(script, args, env),
+                                repeat=5, number=number)
+        results.append(("legacy", label, seconds / number))
+    return results
+
+
+def nio(scripts_path, run_path, number):
+    module = common.nio_bot()
+    bot = common.make_nio_bot(module, TMB_SCRIPTS_PATH=scripts_path, TMB_RUN_PATH=run_path,
+                              TMB_SCRIPT_CACHE="0")
+    results = []
+
+    async def measure():
+        await bot._load_scripts(scripts_path)
+        for label, name, run in (("ping, process", "ping-process", bot._run_script),
+                                 ("date, process", "datetime", bot._run_script),
+                                 ("date, plugin", "datetime.py", bot._run_plugin)):
+            script_path = os.path.join(scripts_path, name)
+            env = {"TMB_ROOM_ID": "!room0:localhost", "TMB_SENDER": "@user0:localhost",
+                   "TMB_BODY": "date"}
+            timings = []
+            for _ in range(5):
+                started = asyncio.get_running_loop().time()
+                for _ in range(number):
+                    await run(script_path, env)
+                timings.append(asyncio.get_running_loop().time() - started)
+            results.append(("nio", label, sorted(timings)[2] / number))
+
+    asyncio.run(measure())
+    return results
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--number", type=int, default=200, help="answers per timing")
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    run_path = tempfile.mkdtemp()
+    scripts_path = os.path.join(run_path, "scripts")
+    os.mkdir(scripts_path)
+    write_scripts(scripts_path)
+    try:
+        results = legacy(scripts_path, args.number)
+        # the nio bot prints every run
+        with open(os.devnull, "w") as devnull:
+            with contextlib.redirect_stdout(devnull):
+                results += nio(scripts_path, run_path, args.number)
+    finally:
+        shutil.rmtree(run_path)
+    print("bot     answer                   µs")
+    for bot, label, seconds in results:
+        print("{:<7} {:<20} {:>10.1f}".format(bot, label, seconds * 1e6))
+
+
+if __name__ == "__main__":
+    main()
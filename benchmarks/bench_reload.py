@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""Reload benchmark: one script of many is edited while the bot runs.
+
+Measures for both bots how long it takes until the edited script is in
+the dispatch table, with a hot reload of just that script and with what a
+restart does to the scripts, i.e. loading all of them with a manifest that
+is up to date for all but the edited one. The reconnect and initial sync of
+a restart come on top of that.
+
+    python3 benchmarks/bench_reload.py [counts ...]
+"""
+
+import asyncio
+import contextlib
+import io
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+import common
+
+
+def edit(scripts_path, n):
+    # a changed answer, and a changed fingerprint with it
+    script_path = os.path.join(scripts_path, "cmd0")
+    with open(script_path) as f:
+        lines = f.read().splitlines(True)
+    with open(script_path, "w") as f:
+        f.writelines(lines[:-1] + ["echo \"edit {} $1\"\n".format(n)])
+
+
+def legacy_timings(module, scripts_path, run_path):
+    manifest_path = os.path.join(run_path, "legacy.manifest.json")
+    bot = common.make_legacy_bot(module, manifest_path=manifest_path)
+    bot.index_triggers(bot.load_scripts(scripts_path, None))
+    edits = iter(range(1000000))
+
+    def restart():
+        edit(scripts_path, next(edits))
+        restarted = common.make_legacy_bot(module, manifest_path=manifest_path)
+        restarted.index_triggers(restarted.load_scripts(scripts_path, None))
+
+    def reload():
+        edit(scripts_path, next(edits))
+        bot.reload(scripts_path, {"cmd0"}, False)
+
+    return common.timeit(restart, repeat=5), common.timeit(reload, repeat=5)
+
+
+def nio_timings(module, scripts_path, run_path):
+    env = {"TMB_SCRIPTS_PATH": scripts_path, "TMB_RUN_PATH": run_path}
+    edits = iter(range(1000000))
+
+    async def setup(bot):
+        bot._scheduler = None
+        await bot._setup_scripts()
+
+    bot = common.make_nio_bot(module, **env)
+    with contextlib.redirect_stdout(io.StringIO()):
+        asyncio.run(setup(bot))
+
+    def restart():
+        edit(scripts_path, next(edits))
+        restarted = common.make_nio_bot(module, **env)
+        with contextlib.redirect_stdout(io.StringIO()):
+            asyncio.run(setup(restarted))
+
+    def reload():
+        edit(scripts_path, next(edits))
+        with contextlib.redirect_stdout(io.StringIO()):
+            asyncio.run(bot._reload_scripts({"cmd0"}))
+
+    return common.timeit(restart, repeat=5), common.timeit(reload, repeat=5)
+
+
+def main():
+    counts = [int(c) for c in sys.argv[1:]] or [30, 300, 1000]
+    logging.basicConfig(level=logging.WARNING)
+    legacy = common.legacy_bot()
+    nio = common.nio_bot()
+    print("{:>6} {:>7} {:>15} {:>11}".format("bot", "scripts", "restart ms", "reload ms"))
+    for count in counts:
+        tmp = tempfile.mkdtemp()
+        try:
+            scripts_path = os.path.join(tmp, "scripts")
+            common.write_scripts(scripts_path, count)
+            for name, timings in (("legacy", legacy_timings(legacy, scripts_path, tmp)),
+                                  ("nio", nio_timings(nio, scripts_path, tmp))):
+                print("{:>6} {:>7} {:>15.1f} {:>11.1f}".format(
+                    name, count, *(t * 1000 for t in timings)))
+        finally:
+            shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main()
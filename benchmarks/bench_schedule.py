@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""Cost of a periodic status message sent by cron versus the bot's own
+timetable.
+
+A fake homeserver with many rooms of many members stands in for a busy
+account. A small status script is run and its output sent to one room:
+
+- cron, full client: the script's output handed to a new process that
+  logs in with a full client and syncs before it sends, what the CLI
+  did before it could send directly
+- cron, CLI: the same with "tiny-matrix-bot.py -r ROOM -m MESSAGE",
+  which sends without a sync
+- timetable: a running bot runs the script every second itself
+
+Reported are the CPU time spent per message, by the bot process and
+all the processes it or cron started, and the requests the homeserver
+had to answer per message.
+
+    python3 benchmarks/bench_schedule.py [--bots legacy nio] [--rooms 200]
+        [--members 50] [--messages 10]
+"""
+
+import argparse
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import common
+from bench_load import start_bot, wait_ready
+from fakeserver import FakeHomeserver
+
+ROOM = "!room0:localhost"
+
+STATUS = """#!/bin/bash
+if [ -n "$CONFIG" ]; then
+    echo '^status$'
+    echo 'schedule=1'
+    echo 'schedule_rooms={}'
+    exit 0
+fi
+cat /proc/loadavg
+""".format(ROOM)
+
+FULL_CLIENT = """import sys
+from matrix_client.client import MatrixClient
+MatrixClient(sys.argv[1], token="token").rooms[sys.argv[2]].send_text(sys.stdin.read())
+"""
+
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def process_cpu(pid):
+    # CPU time of a process and its waited for children, in seconds
+    with open("/proc/{}/stat".format(pid)) as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return sum(int(v) for v in fields[11:15]) / os.sysconf("SC_CLK_TCK")
+
+
+def requests(hs):
+    return sum(hs.requests.values())
+
+
+def run_cron(hs, run_path, script_path, command, messages):
+    config_path = os.path.join(run_path, "cron.cfg")
+    with open(config_path, "w") as f:
+        f.write("[tiny-matrix-bot]\nbase_url = {}\ntoken = token\n"
+                "run_path = {}\nsocket = false\n".format(hs.url, run_path))
+    env = dict(os.environ, CONFIG=config_path)
+    cpu_before, requests_before = children_cpu(), requests(hs)
+    for _ in range(messages):
+        count = len(hs.sent)
+        # what a crontab line like "* * * * * status | send" does
+        subprocess.run(
+            "{} | {}".format(script_path, command), shell=True, env=env, check=True)
+        hs.wait_sent(count + 1)
+    return ((children_cpu() - cpu_before) / messages,
+            (requests(hs) - requests_before) / messages)
+
+
+def run_timetable(bot, hs, run_path, scripts_path, messages):
+    process = start_bot(bot, hs, run_path, scripts_path)
+    try:
+        wait_ready(hs, process)
+        # the first tick after the start up is left out
+        hs.wait_sent(len(hs.sent) + 1, timeout=10)
+        count = len(hs.sent)
+        cpu_before, requests_before = process_cpu(process.pid), requests(hs)
+        hs.wait_sent(count + messages, timeout=messages * 3)
+        sent = len(hs.sent) - count
+        return ((process_cpu(process.pid) - cpu_before) / sent,
+                (requests(hs) - requests_before) / sent)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--bots", nargs="+", default=["legacy", "nio"], choices=["legacy", "nio"])
+    ap.add_argument("--rooms", type=int, default=200)
+    ap.add_argument("--members", type=int, default=50)
+    ap.add_argument("--messages", type=int, default=10)
+    args = ap.parse_args()
+    hs = FakeHomeserver(rooms=args.rooms, members=args.members).start()
+    run_path = tempfile.mkdtemp()
+    scripts_path = os.path.join(run_path, "scripts")
+    os.mkdir(scripts_path)
+    script_path = os.path.join(scripts_path, "status")
+    with open(script_path, "w") as f:
+        f.write(STATUS)
+    os.chmod(script_path, 0o755)
+    full_client_path = os.path.join(run_path, "full_client.py")
+    with open(full_client_path, "w") as f:
+        f.write(FULL_CLIENT)
+    results = [
+        ("cron, full client", run_cron(
+            hs, run_path, script_path,
+            "{} {} {} {}".format(sys.executable, full_client_path, hs.url, ROOM), args.messages)),
+        ("cron, CLI", run_cron(
+            hs, run_path, script_path, "{} {} -r {}".format(
+                sys.executable, os.path.join(common.ROOT_PATH, "tiny-matrix-bot.py"), ROOM),
+            args.messages)),
+    ]
+    for bot in args.bots:
+        results.append(("timetable, " + bot, run_timetable(
+            bot, hs, run_path, scripts_path, args.messages)))
+    hs.stop()
+    shutil.rmtree(run_path)
+    print("{} rooms with {} members, {} messages".format(args.rooms, args.members, args.messages))
+    print("path                 CPU ms/message  requests/message")
+    for name, (cpu, per_message) in results:
+        print("{:<20} {:>14.1f} {:>17.1f}".format(name, cpu * 1000, per_message))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""Throughput of both bots with 1, 2 and 4 worker processes.
+
+The load of bench_load.py, a storm of messages spread round-robin over
+many rooms, is run against bots sharded into a number of worker
+processes. The supervisor syncs and hands every room's messages to its
+worker, the workers run the scripts and send the replies. Reported are
+messages per second, the speedup over one process and the 50th and 99th
+percentile of the reply latency. The speedup is bounded by the CPUs of
+the host, it is printed first. Before the storm the bot is kicked from
+a room, which the supervisor has to pass on to the room's worker.
+
+    python3 benchmarks/bench_shard.py [--bots legacy nio] [--workers 1 2 4]
+        [--rooms 100] [--workload ping] [--messages 1000]
+"""
+
+import argparse
+import os
+import sys
+
+from bench_load import WORKLOAD_MESSAGES, run
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--bots", nargs="+", default=["legacy", "nio"], choices=["legacy", "nio"])
+    ap.add_argument("--workers", nargs="+", type=int, default=[1, 2, 4])
+    ap.add_argument("--rooms", type=int, default=100)
+    ap.add_argument("--workload", default="ping", choices=list(WORKLOAD_MESSAGES))
+    ap.add_argument("--messages", type=int, default=1000)
+    args = ap.parse_args()
+    print("{} CPUs, {} messages in {} rooms".format(
+        os.cpu_count(), args.messages, args.rooms))
+    print("bot     workers   msgs/s  speedup   p50 ms   p99 ms")
+    for bot in args.bots:
+        base = None
+        for workers in args.workers:
+            rate, p50, p99, _ = run(
+                bot, args.rooms, args.workload, args.messages,
+                config="worker_processes = {}\n".format(workers), kick=True,
+                TMB_WORKER_PROCESSES=str(workers))
+            base = base or rate
+            print("{:<7} {:>7} {:>8.1f} {:>7.2f}x {:>8.1f} {:>8.1f}".format(
+                bot, workers, rate, rate / base, p50 * 1000, p99 * 1000))
+            sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""Startup benchmark of the script discovery.
+
+Measures how long loading 30 and 300 scripts takes for both bots:
+sequential without the manifest (the old behaviour), cold start with
+an empty manifest (parallel probing) and warm start with a manifest
+that covers every script.
+
+    python3 benchmarks/bench_startup.py [counts ...]
+"""
+
+import asyncio
+import contextlib
+import io
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+import common
+
+
+def legacy_timings(module, scripts_path, run_path):
+    manifest_path = os.path.join(run_path, "legacy.manifest.json")
+
+    def load(**attributes):
+        bot = common.make_legacy_bot(module, **attributes)
+        return lambda: bot.load_scripts(scripts_path, None)
+
+    def cold():
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        load(manifest_path=manifest_path)()
+
+    def sequential():
+        # the old behaviour: every script is probed, one after another
+        bot = common.make_legacy_bot(module)
+        bot.probe_scripts = lambda paths, unchanged=(): {
+            p: bot.probe_script(p) or "" for p in paths}
+        bot.load_scripts(scripts_path, None)
+
+    sequential = common.timeit(sequential, repeat=3)
+    cold_time = common.timeit(cold, repeat=3)
+    warm = common.timeit(load(manifest_path=manifest_path), repeat=3)
+    return sequential, cold_time, warm
+
+
+def nio_timings(module, scripts_path, run_path):
+    def load(**env):
+        bot = common.make_nio_bot(
+            module, TMB_SCRIPTS_PATH=scripts_path, TMB_RUN_PATH=run_path, **env)
+
+        def run():
+            with contextlib.redirect_stdout(io.StringIO()):
+                asyncio.run(bot._load_scripts(scripts_path))
+        return run
+
+    manifest_path = os.path.join(
+        run_path, os.path.basename(scripts_path) + ".manifest.json")
+
+    def cold():
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        load()()
+
+    sequential = common.timeit(load(TMB_SCRIPT_CACHE="0", TMB_MAX_SCRIPTS="1"), repeat=3)
+    cold_time = common.timeit(cold, repeat=3)
+    warm = common.timeit(load(), repeat=3)
+    return sequential, cold_time, warm
+
+
+def main():
+    counts = [int(c) for c in sys.argv[1:]] or [30, 300]
+    logging.basicConfig(level=logging.WARNING)
+    legacy = common.legacy_bot()
+    nio = common.nio_bot()
+    print("{:>6} {:>7} {:>13} {:>10} {:>10}".format(
+        "bot", "scripts", "sequential s", "cold s", "warm s"))
+    for count in counts:
+        tmp = tempfile.mkdtemp()
+        try:
+            scripts_path = os.path.join(tmp, "scripts")
+            common.write_scripts(scripts_path, count)
+            for name, timings in (("legacy", legacy_timings(legacy, scripts_path, tmp)),
+                                  ("nio", nio_timings(nio, scripts_path, tmp))):
+                print("{:>6} {:>7} {:>13.3f} {:>10.3f} {:>10.3f}".format(name, count, *timings))
+        finally:
+            shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main()
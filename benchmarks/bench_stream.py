@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""Time to the first message of a script that produces its messages slowly.
+
+The script prints a number of items with a pause before each, like the
+rss script fetching feeds. Without streaming the first item is only sent
+when the script has ended, with streaming as soon as it is complete.
+
+    python3 benchmarks/bench_stream.py [items] [seconds per item]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from bench_load import SENDER, start_bot, wait_ready
+from fakeserver import FakeHomeserver
+
+SCRIPT = """#!/bin/bash
+if [ -n "$CONFIG" ]; then
+    echo '^feed$'
+    exit 0
+fi
+for i in $(seq {items}); do
+    sleep {delay}
+    printf 'item %s\\n\\n\\n' $i
+done
+"""
+
+
+def first_and_last(bot, items, delay, stream):
+    hs = FakeHomeserver(rooms=1).start()
+    run_path = tempfile.mkdtemp()
+    scripts_path = os.path.join(run_path, "scripts")
+    os.mkdir(scripts_path)
+    script = SCRIPT.format(items=items, delay=delay)
+    if bot == "nio":
+        # the nio bot splits messages on two newlines and takes its
+        # options from the script itself
+        script = script.replace("\\n\\n\\n", "\\n\\n")
+        if stream:
+            script = script.replace("echo '^feed$'", "echo '^feed$'\n    echo stream=1")
+    with open(os.path.join(scripts_path, "feed"), "w") as f:
+        f.write(script)
+    os.chmod(os.path.join(scripts_path, "feed"), 0o755)
+    process = start_bot(bot, hs, run_path, scripts_path,
+                        config="[feed]\nstream = {}\n".format(stream))
+    try:
+        wait_ready(hs, process)
+        started = time.monotonic()
+        hs.inject("!room0:localhost", SENDER, "feed")
+        sent = hs.wait_sent(items, timeout=items * delay + 30)
+        return sent[0][0] - started, sent[-1][0] - started
+    finally:
+        process.terminate()
+        process.wait()
+        hs.stop()
+        shutil.rmtree(run_path)
+
+
+def main():
+    items = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    delay = float(sys.argv[2]) if len(sys.argv) > 2 else 1
+    print("{} items, {:g} seconds each".format(items, delay))
+    print("bot     streaming   first message   last message")
+    for bot in ("legacy", "nio"):
+        for stream in (False, True):
+            first, last = first_and_last(bot, items, delay, stream)
+            print("{:<7} {:<9} {:>13.2f}s {:>13.2f}s".format(
+                bot, "yes" if stream else "no", first, last))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""Start up cost and request volume of the nio bot against many rooms.
+
+For every room count the bot is started twice against a local fake
+homeserver: once from scratch (full initial sync) and once resuming from
+the sync token saved by the first run. Then messages are sent to the
+rooms and the requests the bot makes for them are counted.
+
+    python3 benchmarks/bench_sync.py [room counts ...]
+"""
+
+import asyncio
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import common
+from fakeserver import FakeHomeserver
+
+MESSAGES = 200
+
+
+async def start(module, hs, run_path, scripts_path, **env):
+    bot = common.make_nio_bot(
+        module,
+        TMB_HOMESERVER=hs.url,
+        TMB_RUN_PATH=run_path,
+        TMB_SCRIPTS_PATH=scripts_path,
+        **env,
+    )
+    started = time.perf_counter()
+    task = asyncio.create_task(bot.run())
+    while not bot._initial_sync_done:
+        await asyncio.sleep(0.001)
+    return bot, task, time.perf_counter() - started
+
+
+async def stop(task):
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+
+async def measure(module, rooms, receipt_interval):
+    hs = FakeHomeserver(rooms=rooms, members=20).start()
+    run_path = tempfile.mkdtemp()
+    scripts_path = os.path.join(run_path, "scripts")
+    common.write_scripts(scripts_path, 1, probes=0)
+    try:
+        env = {
+            "TMB_RECEIPT_INTERVAL": receipt_interval,
+            "TMB_SEND_RATE": "10000",
+            "TMB_SEND_BURST": "10000",
+        }
+        _, task, full = await start(module, hs, run_path, scripts_path, **env)
+        await stop(task)
+        hs.requests.clear()
+        _, task, resumed = await start(module, hs, run_path, scripts_path, **env)
+        sync_requests = hs.requests.get("GET sync", 0)
+        hs.requests.clear()
+        room_ids = sorted(hs.rooms)
+        for i in range(MESSAGES):
+            hs.inject(room_ids[i % len(room_ids)], "@user0:localhost", "cmd0")
+        await asyncio.to_thread(hs.wait_sent, MESSAGES)
+        await asyncio.sleep(float(receipt_interval) + 0.5)
+        receipts = hs.requests.get("POST rooms/receipt", 0)
+        await stop(task)
+        return full, resumed, sync_requests, receipts
+    finally:
+        hs.stop()
+        shutil.rmtree(run_path)
+
+
+def main():
+    counts = [int(c) for c in sys.argv[1:]] or [10, 100, 1000]
+    module = common.nio_bot()
+    print(f"{MESSAGES} messages spread over the rooms")
+    print("rooms  full sync  resumed  receipts (immediate)  receipts (debounced)")
+    for rooms in counts:
+        # the bot prints every message it handles
+        with contextlib.redirect_stdout(io.StringIO()):
+            full, resumed, _, immediate = asyncio.run(measure(module, rooms, "0"))
+            _, _, _, debounced = asyncio.run(measure(module, rooms, "2"))
+        print(f"{rooms:>5} {full * 1000:>8.0f}ms {resumed * 1000:>6.0f}ms"
+              f" {immediate:>21} {debounced:>21}")
+
+
+if __name__ == "__main__":
+    main()
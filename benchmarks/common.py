@@ -0,0 +1,114 @@
+"""Helpers shared by the benchmarks in this directory."""
+
+import importlib.util
+import os
+import statistics
+import threading
+import time
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+SCRIPTS_PATH = os.path.join(ROOT_PATH, "scripts")
+
+
+def load_bot(file_name):
+    """Import one of the bot files (their names are not valid module names)."""
+    module_name = os.path.splitext(file_name)[0].replace("-", "_")
+    spec = importlib.util.spec_from_file_location(
+        module_name, os.path.join(ROOT_PATH, file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def legacy_bot():
+    return load_bot("tiny-matrix-bot.py")
+
+
+def nio_bot():
+    return load_bot("4nd3r_tiny-matrix-bot.py")
+
+
+def sample_triggers():
+    """Return the trigger regexes of the sample scripts without running them."""
+    triggers = []
+    for script_name in sorted(os.listdir(SCRIPTS_PATH)):
+        script_path = os.path.join(SCRIPTS_PATH, script_name)
+        if not os.path.isfile(script_path):
+            continue
+        with open(script_path) as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith("echo '") and line.count("'") >= 2:
+                    triggers.append(line.split("'")[1])
+                    break
+                if line.startswith("regex = '") or line.startswith("TRIGGER = '"):
+                    triggers.append(line.split("'")[1])
+                    break
+    return triggers
+
+
+def timeit(func, repeat=5, number=1):
+    """Return the median wall time of number calls of func in seconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def make_legacy_bot(module, config_text="", **attributes):
+    """Create a TinyMatrixtBot without connecting to a homeserver."""
+    import configparser
+    bot = module.TinyMatrixtBot.__new__(module.TinyMatrixtBot)
+    bot.config = configparser.ConfigParser()
+    bot.config.read_string(config_text)
+    bot.max_workers = os.cpu_count() or 1
+    bot.script_timeout = 300
+    bot.script_concurrency = bot.max_workers
+    bot.manifest_path = None
+    bot.metrics = module.Metrics()
+    bot.triggers = None
+    bot.room_triggers = {}
+    bot.dispatch_lock = threading.Lock()
+    bot.supervisor = None
+    bot.sync_filter = None
+    bot.plugins = {}
+    bot.timetable = None
+    for key, value in attributes.items():
+        setattr(bot, key, value)
+    return bot
+
+
+def make_nio_bot(module, **env):
+    """Create a nio TinyMatrixBot without connecting to a homeserver."""
+    os.environ.update({
+        "TMB_HOMESERVER": "http://127.0.0.1:1",
+        "TMB_ACCESS_TOKEN": "token",
+        "TMB_USER_ID": "@bot:localhost",
+    })
+    os.environ.update(env)
+    try:
+        return module.TinyMatrixBot()
+    finally:
+        for key in env:
+            del os.environ[key]
+
+
+def write_scripts(path, count, body="", probes=2):
+    """Write count executable bash scripts that check for some tools
+    before answering the CONFIG probe, like the sample scripts do.
+    """
+    os.makedirs(path, exist_ok=True)
+    for i in range(count):
+        script_path = os.path.join(path, "cmd{}".format(i))
+        with open(script_path, "w") as f:
+            f.write("#!/bin/bash\n")
+            for tool in ("curl", "jq", "torify", "rsstail")[:probes]:
+                f.write("type {} >/dev/null 2>&1 || true\n".format(tool))
+            f.write("if [ -n \"$CONFIG\" ]; then\n")
+            f.write("    echo '^cmd{0}$|^cmd{0} .*$'\n".format(i))
+            f.write("    exit 0\nfi\n")
+            f.write(body or "echo \"cmd{} $1\"\n".format(i))
+        os.chmod(script_path, 0o755)
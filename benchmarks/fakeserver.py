@@ -0,0 +1,377 @@
+"""A local stand-in for a Matrix homeserver.
+
+It implements just enough of the client-server API (whoami, sync, join,
+invites, send, typing, receipts, filters) to drive both bots without
+network access. Rooms, members and incoming messages are synthetic; the
+messages the bots send are recorded with their arrival time.
+
+Sync filters, uploaded or inline, are applied to the event types of the
+timeline, ephemeral and presence sections and to lazy loading of members.
+Timeline limits are not, a storm of messages to one room would be cut.
+"""
+
+import fnmatch
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+PREFIX = re.compile(r"^/_matrix/client/(?:r0|v3|unstable)")
+
+
+class FakeHomeserver:
+
+    def __init__(self, rooms=1, members=2, user_id="@bot:localhost", delay=0, chatter=False):
+        self.user_id = user_id
+        self.delay = delay  # seconds added to every request, like a network round trip
+        # presence, typing and read receipts of the members with every sync,
+        # like a busy server sends them
+        self.chatter = chatter
+        self.filters = {}  # filter id -> filter
+        self.rooms = {}  # room_id -> list of member ids
+        self.joined = set()
+        self.invites = {}  # room_id -> inviter
+        self.kicks = {}  # room_id -> who kicked the bot
+        self.timeline = []  # (room_id, event), the batch token is the index
+        self.sent = []  # (time, room_id, content)
+        self.requests = {}  # endpoint -> number of requests
+        self.bytes = {}  # endpoint -> bytes of the responses
+        self.initial_syncs = 0  # syncs without a since token, i.e. (re)connects
+        self.condition = threading.Condition()
+        for i in range(rooms):
+            self.add_room("!room{}:localhost".format(i), members)
+        self.httpd = None
+        self.url = None
+
+    def add_room(self, room_id, members=2, joined=True):
+        self.rooms[room_id] = [self.user_id] + [
+            "@user{}:localhost".format(i) for i in range(members - 1)]
+        if joined:
+            self.joined.add(room_id)
+
+    def start(self):
+        server = self
+
+        class Handler(RequestHandler):
+            homeserver = server
+
+        self.httpd = HTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{}".format(self.httpd.server_address[1])
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+        with self.condition:
+            self.condition.notify_all()
+
+    def inject(self, room_id, sender, body):
+        """Add a text message to a room's timeline, return its event id."""
+        event = {
+            "type": "m.room.message",
+            "event_id": "$" + uuid.uuid4().hex,
+            "sender": sender,
+            "origin_server_ts": int(time.time() * 1000),
+            "content": {"msgtype": "m.text", "body": body},
+        }
+        with self.condition:
+            self.timeline.append((room_id, event))
+            self.condition.notify_all()
+        return event["event_id"]
+
+    def invite(self, room_id, inviter, members=2):
+        with self.condition:
+            self.add_room(room_id, members, joined=False)
+            self.invites[room_id] = inviter
+            self.timeline.append((room_id, None))
+            self.condition.notify_all()
+
+    def kick(self, room_id, kicker):
+        """Remove the bot from a room, the next sync tells it who did."""
+        with self.condition:
+            self.joined.discard(room_id)
+            self.kicks[room_id] = kicker
+            self.timeline.append((room_id, None))
+            self.condition.notify_all()
+
+    def count(self, endpoint, size=None):
+        with self.condition:
+            if size is None:
+                self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            else:
+                self.bytes[endpoint] = self.bytes.get(endpoint, 0) + size
+
+    def member_event(self, room_id, user_id):
+        return {
+            "type": "m.room.member",
+            "event_id": "$" + uuid.uuid4().hex,
+            "sender": user_id,
+            "state_key": user_id,
+            "origin_server_ts": int(time.time() * 1000),
+            "content": {"membership": "join", "displayname": user_id[1:].split(":")[0]},
+        }
+
+    @staticmethod
+    def allowed(event_filter, event_type):
+        types = event_filter.get("types")
+        if types is not None and not any(fnmatch.fnmatchcase(event_type, t) for t in types):
+            return False
+        return not any(fnmatch.fnmatchcase(event_type, t)
+                       for t in event_filter.get("not_types", []))
+
+    def chatter_events(self, room_id, events):
+        # everybody in the room is typing and has read the new messages
+        members = self.rooms[room_id][1:]
+        receipts = {event["event_id"]: {"m.read": {
+            member: {"ts": event["origin_server_ts"]} for member in members}}
+            for event in events}
+        return [
+            {"type": "m.typing", "content": {"user_ids": members}},
+            {"type": "m.receipt", "content": receipts},
+        ]
+
+    def joined_room(self, room_id, events, full_state, sync_filter=None):
+        room_filter = (sync_filter or {}).get("room", {})
+        timeline_filter = room_filter.get("timeline", {})
+        state_filter = room_filter.get("state", {})
+        events = [e for e in events if self.allowed(timeline_filter, e["type"])]
+        state = []
+        if full_state:
+            state.append({
+                "type": "m.room.create",
+                "event_id": "$create" + room_id,
+                "sender": self.user_id,
+                "state_key": "",
+                "origin_server_ts": 0,
+                "content": {"creator": self.user_id},
+            })
+            members = self.rooms[room_id]
+            # only the members that sent something are sent along
+            if state_filter.get("lazy_load_members"):
+                senders = {e["sender"] for e in events}
+                members = [m for m in members if m in senders]
+            state += [self.member_event(room_id, m) for m in members]
+            state = [e for e in state if self.allowed(state_filter, e["type"])]
+        ephemeral = []
+        if self.chatter:
+            ephemeral = [e for e in self.chatter_events(room_id, events)
+                         if self.allowed(room_filter.get("ephemeral", {}), e["type"])]
+        return {
+            "state": {"events": state},
+            "timeline": {"events": events, "limited": False, "prev_batch": "p0"},
+            "ephemeral": {"events": ephemeral},
+            "account_data": {"events": []},
+            "unread_notifications": {},
+            "summary": {},
+        }
+
+    def presence(self, room_ids, sync_filter=None):
+        if not self.chatter or not self.allowed(
+                (sync_filter or {}).get("presence", {}), "m.presence"):
+            return []
+        members = sorted({m for room_id in room_ids for m in self.rooms[room_id][1:]})
+        return [{"type": "m.presence", "sender": member,
+                 "content": {"presence": "online", "last_active_ago": 1000,
+                             "currently_active": True}} for member in members]
+
+    def sync(self, since, timeout_ms, full_state=False, sync_filter=None):
+        deadline = time.monotonic() + timeout_ms / 1000
+        with self.condition:
+            if since is None:
+                self.initial_syncs += 1
+                position = len(self.timeline)
+                rooms = {room_id: self.joined_room(room_id, [], True, sync_filter)
+                         for room_id in self.joined}
+                invites = dict(self.invites)
+                kicks = {}
+            else:
+                start = int(since)
+                while len(self.timeline) <= start and self.httpd:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                position = len(self.timeline)
+                new = self.timeline[start:position]
+                events = {}
+                for room_id, event in new:
+                    if event is not None and room_id in self.joined:
+                        events.setdefault(room_id, []).append(event)
+                rooms = {room_id: self.joined_room(room_id, e, full_state, sync_filter)
+                         for room_id, e in events.items()}
+                invites = {room_id: self.invites[room_id] for room_id, event in new
+                           if event is None and room_id in self.invites}
+                kicks = {room_id: self.kicks[room_id] for room_id, event in new
+                         if event is None and room_id in self.kicks}
+        invite_rooms = {}
+        for room_id, inviter in invites.items():
+            invite_rooms[room_id] = {"invite_state": {"events": [
+                {"type": "m.room.join_rules", "sender": inviter, "state_key": "",
+                 "content": {"join_rule": "invite"}},
+                {"type": "m.room.member", "sender": inviter, "state_key": self.user_id,
+                 "content": {"membership": "invite"}},
+            ]}}
+        leave_rooms = {}
+        for room_id, kicker in kicks.items():
+            leave_rooms[room_id] = {"state": {"events": []}, "timeline": {"events": [
+                # older servers repeat the membership outside of the content
+                {"type": "m.room.member", "event_id": "$" + uuid.uuid4().hex,
+                 "sender": kicker, "state_key": self.user_id,
+                 "origin_server_ts": int(time.time() * 1000), "membership": "leave",
+                 "content": {"membership": "leave"}},
+            ], "limited": False}}
+        return {
+            "next_batch": str(position),
+            "rooms": {"join": rooms, "invite": invite_rooms, "leave": leave_rooms},
+            "presence": {"events": self.presence(rooms, sync_filter)},
+            "account_data": {"events": []},
+            "to_device": {"events": []},
+            "device_lists": {"changed": [], "left": []},
+            "device_one_time_keys_count": {},
+        }
+
+    def join(self, room_id):
+        with self.condition:
+            if room_id not in self.rooms:
+                return None
+            self.joined.add(room_id)
+            self.invites.pop(room_id, None)
+            return room_id
+
+    def send(self, room_id, content):
+        with self.condition:
+            if room_id not in self.joined:
+                return None
+            self.sent.append((time.monotonic(), room_id, content))
+            self.condition.notify_all()
+        # like a real server, the bot sees its own messages again
+        event = {
+            "type": "m.room.message",
+            "event_id": "$" + uuid.uuid4().hex,
+            "sender": self.user_id,
+            "origin_server_ts": int(time.time() * 1000),
+            "content": content,
+        }
+        with self.condition:
+            self.timeline.append((room_id, event))
+            self.condition.notify_all()
+        return event["event_id"]
+
+    def wait_sent(self, count, timeout=60):
+        """Wait until count messages have been sent, return them."""
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while len(self.sent) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return list(self.sent)
+
+
+class HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # with many rooms answering at once the default backlog of 5 overflows,
+    # the dropped connections are only retried after a second
+    request_queue_size = 128
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    homeserver = None
+    endpoint = None
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def handle(self):
+        try:
+            super().handle()
+        except ConnectionError:
+            pass  # a bot that was stopped
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.homeserver.count(self.endpoint, len(data))
+        try:
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # e.g. a long polling sync of a bot that was stopped
+
+    def body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        data = self.rfile.read(length) if length else b""
+        return json.loads(data) if data else {}
+
+    def route(self, method):
+        if self.homeserver.delay:
+            time.sleep(self.homeserver.delay)
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        path = PREFIX.sub("", url.path)
+        hs = self.homeserver
+        content = self.body() if method in ("PUT", "POST") else {}
+        parts = [unquote(p) for p in path.strip("/").split("/")]
+        endpoint = parts[0]
+        if endpoint == "rooms" and len(parts) > 2:
+            endpoint = "rooms/" + parts[2]
+        self.endpoint = "{} {}".format(method, endpoint)
+        hs.count(self.endpoint)
+        if path == "/account/whoami":
+            return self.reply(200, {"user_id": hs.user_id, "device_id": "FAKE"})
+        if path == "/sync":
+            since = query.get("since", [None])[0]
+            timeout = int(query.get("timeout", ["0"])[0])
+            full_state = query.get("full_state", ["false"])[0] == "true"
+            sync_filter = query.get("filter", [None])[0]
+            if sync_filter is not None:
+                if sync_filter.startswith("{"):
+                    sync_filter = json.loads(sync_filter)
+                else:
+                    sync_filter = hs.filters.get(sync_filter)
+            if since is not None and not (since.isdigit() and int(since) <= len(hs.timeline)):
+                return self.reply(400, {"errcode": "M_UNKNOWN", "error": "invalid stream token"})
+            return self.reply(200, hs.sync(since, timeout, full_state, sync_filter))
+        if parts[0] == "user" and parts[-1] == "filter":
+            with hs.condition:
+                filter_id = str(len(hs.filters))
+                hs.filters[filter_id] = content
+            return self.reply(200, {"filter_id": filter_id})
+        if parts[0] == "join" or (parts[0] == "rooms" and parts[-1] == "join"):
+            room_id = parts[1]
+            if hs.join(room_id) is None:
+                return self.reply(404, {"errcode": "M_NOT_FOUND", "error": "unknown room"})
+            return self.reply(200, {"room_id": room_id})
+        if parts[0] == "rooms" and len(parts) >= 4 and parts[2] == "send":
+            event_id = hs.send(parts[1], content)
+            if event_id is None:
+                return self.reply(403, {"errcode": "M_FORBIDDEN", "error": "not in room"})
+            return self.reply(200, {"event_id": event_id})
+        if parts[0] == "rooms" and len(parts) >= 3 and parts[2] == "leave":
+            with hs.condition:
+                hs.joined.discard(parts[1])
+                hs.invites.pop(parts[1], None)
+            return self.reply(200, {})
+        if parts[0] == "rooms" and len(parts) >= 3 and parts[2] in (
+                "typing", "receipt", "read_markers"):
+            return self.reply(200, {})
+        return self.reply(404, {"errcode": "M_UNRECOGNIZED", "error": "not implemented"})
+
+    def do_GET(self):
+        self.route("GET")
+
+    def do_PUT(self):
+        self.route("PUT")
+
+    def do_POST(self):
+        self.route("POST")
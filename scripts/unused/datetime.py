@@ -0,0 +1,27 @@
+# A plugin: the bot imports this module and calls handle for every message
+# that matches TRIGGER, nothing is started. It has a config section
+# [datetime.py] of its own. It answers like the datetime script without
+# starting a process; copy it into the scripts directory and disable or
+# remove datetime there, as both answer the same messages.
+
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+TRIGGER = '^date$|^time$|^tiempo$|^hora$|^temps$|^heure$|^heures$|^datum$|^zeit$'
+
+PLACES = [
+    ('Server time:  ', None),
+    ('Los Angeles:  ', 'America/Los_Angeles'),
+    ('Paris/Madrid: ', 'Europe/Madrid'),
+    ('Lima:         ', 'America/Lima'),
+    ('Melbourne:    ', 'Australia/Melbourne'),
+]
+
+
+def handle(room_id, sender, args, config):
+    lines = []
+    for label, zone in PLACES:
+        now = datetime.now(ZoneInfo(zone)) if zone else datetime.now().astimezone()
+        # like date(1)
+        lines.append(label + now.strftime('%a %b %e %H:%M:%S %Z %Y'))
+    return '\n'.join(lines)
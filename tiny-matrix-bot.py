@@ -4,16 +4,1415 @@
 # Ignore long lines
 # pylama:format=pep8:linters=pep8:ignore=E501
 
+import io
 import os
 import re
 import sys
+import json
+import codecs
+import ctypes
+import random
+import asyncio
+import inspect
+import struct
+import select
+import bisect
+import signal
+import socket
+import hashlib
 import logging
+import threading
 import traceback
 import argparse
+import resource
+import importlib.util
 import subprocess
 import configparser
-from time import sleep
-from matrix_client.client import MatrixClient
+import socketserver
+from time import sleep, monotonic, time
+from datetime import datetime, timedelta
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+# matrix_client is imported where it is needed, handing a message from the
+# CLI to a running bot over its socket does not need it and its import
+# takes longer than the rest of the handoff
+
+logger = logging.getLogger("tiny-matrix-bot")
+
+
+class TriggerIndex():
+    """This class implements a pre-compiled index over the script triggers.
+    Each trigger is split into its top-level alternatives and the literal
+    text every alternative has to start with (or contain) is extracted once,
+    so that for an incoming message only the few scripts that can possibly
+    match have their regex evaluated.
+    """
+
+    # characters that have a special meaning in a regex outside of a class
+    METACHARS = ".^$*+?{}[]\\|()"
+    # upper bound of literal prefixes generated from optional characters,
+    # e.g. "^!?ping" gives "!ping" and "ping"
+    MAX_PREFIXES = 8
+    # ASCII letters that re.IGNORECASE also matches with characters that
+    # str.casefold() does not fold to them, see unfolded_letters
+    UNFOLDED = None
+
+    def __init__(self, entries, previous=None):
+        # entries is an ordered list of (regex, value) pairs, the compiled
+        # regexes of a previous index are reused
+        self.compiled = {}  # regex -> (pattern, analysis)
+        self.values = []
+        self.patterns = []
+        self.starts = []  # per entry: literal prefixes of anchored alternatives
+        self.contains = []  # per entry: literals of unanchored alternatives
+        self.by_char = {}  # first character of a prefix -> entry indexes
+        self.always = []  # entries that have to be tried for every message
+        for regex, value in entries:
+            if previous and regex in previous.compiled:
+                pattern, analysis = previous.compiled[regex]
+            else:
+                try:
+                    pattern = re.compile(regex, re.IGNORECASE)
+                except re.error as e:
+                    logger.warning(
+                        "trigger {} is not a valid regex ({}), ignoring it".format(regex, e))
+                    continue
+                analysis = self.analyze(regex)
+            self.compiled[regex] = (pattern, analysis)
+            index = len(self.values)
+            self.values.append(value)
+            self.patterns.append(pattern)
+            starts, contains, always = analysis
+            self.starts.append(starts)
+            self.contains.append(contains)
+            if always:
+                self.always.append(index)
+                continue
+            for prefix in starts:
+                self.by_char.setdefault(prefix[0], []).append(index)
+            if contains:
+                self.always.append(index)
+        # merge the always-tried entries into every bucket once, so dispatch
+        # is a single dict lookup and the original script order is kept
+        for char, indexes in self.by_char.items():
+            self.by_char[char] = sorted(set(indexes + self.always))
+        logger.debug("trigger index with {} entries, {} first characters, {} always tried".format(
+            len(self.values), len(self.by_char), len(self.always)))
+
+    def __len__(self):
+        return len(self.values)
+
+    @classmethod
+    def split_alternatives(cls, regex):
+        """Split a regex on its top-level "|" characters."""
+        alternatives = []
+        depth = 0
+        in_class = False
+        start = 0
+        i = 0
+        while i < len(regex):
+            char = regex[i]
+            if char == "\\":
+                i += 2
+                continue
+            if in_class:
+                if char == "]":
+                    in_class = False
+            elif char == "[":
+                in_class = True
+                # a "]" right after "[" or "[^" is a literal
+                if regex[i + 1:i + 2] == "^":
+                    i += 1
+                if regex[i + 1:i + 2] == "]":
+                    i += 1
+            elif char == "(":
+                depth += 1
+            elif char == ")":
+                depth -= 1
+            elif char == "|" and depth == 0:
+                alternatives.append(regex[start:i])
+                start = i + 1
+            i += 1
+        alternatives.append(regex[start:])
+        return alternatives
+
+    @classmethod
+    def unfolded_letters(cls):
+        """Return the ASCII letters that re.IGNORECASE matches with a
+        character whose casefold() is not the letter, e.g. "i" with "ı"
+        (U+0131). They are found with re's own case folding on first use,
+        sending from the CLI does not need them.
+        """
+        if cls.UNFOLDED is None:
+            others = "".join(map(chr, range(0x80, 0x10000)))
+            cls.UNFOLDED = frozenset(
+                letter for letter in "abcdefghijklmnopqrstuvwxyz"
+                if any(other.casefold() != letter
+                       for other in re.findall(letter, others, re.IGNORECASE)))
+        return cls.UNFOLDED
+
+    @classmethod
+    def literal_prefixes(cls, alternative, branch):
+        """Return the literal strings a match of the alternative must start with.
+        If branch is set, optional characters ("x?") fork the prefix,
+        otherwise the prefix ends in front of them.
+        """
+        prefixes = [""]
+        i = 0
+        while i < len(alternative):
+            char = alternative[i]
+            if char == "\\":
+                char = alternative[i + 1:i + 2]
+                # \d, \w, \b, \A, ... are not literals
+                if not char or char.isalnum():
+                    break
+                i += 2
+            elif char in cls.METACHARS:
+                break
+            else:
+                i += 1
+            # only ASCII is folded in a way that str.casefold() mirrors,
+            # and not even all of it
+            if not char.isascii() or char.casefold() in cls.unfolded_letters():
+                break
+            char = char.casefold()
+            quantifier = alternative[i:i + 1]
+            if quantifier == "?":
+                if not branch or len(prefixes) * 2 > cls.MAX_PREFIXES:
+                    break
+                prefixes = prefixes + [p + char for p in prefixes]
+                i += 1
+                continue
+            if quantifier in ("*", "{"):
+                break
+            prefixes = [p + char for p in prefixes]
+            if quantifier == "+":
+                break
+        return prefixes
+
+    @classmethod
+    def analyze(cls, regex):
+        """Return (starts, contains, always) for a trigger regex."""
+        starts = set()
+        contains = set()
+        for alternative in cls.split_alternatives(regex):
+            if alternative.startswith("^"):
+                prefixes = cls.literal_prefixes(alternative[1:], branch=True)
+                if "" in prefixes:
+                    return (), (), True
+                starts.update(prefixes)
+            else:
+                literal = cls.literal_prefixes(alternative, branch=False)[0]
+                if not literal:
+                    return (), (), True
+                contains.add(literal)
+        return tuple(sorted(starts)), tuple(sorted(contains)), False
+
+    def match(self, text):
+        """Return the values of all entries whose regex matches text,
+        in the order the entries were given.
+        """
+        folded = text.casefold()
+        matches = []
+        for index in self.by_char.get(folded[:1], self.always):
+            if self.starts[index] or self.contains[index]:
+                if not (any(folded.startswith(p) for p in self.starts[index]) or
+                        any(c in folded for c in self.contains[index])):
+                    continue
+            if self.patterns[index].search(text):
+                matches.append(self.values[index])
+        return matches
+
+
+class ScriptAcl():
+    """This class implements the whitelist and blacklist of a script, both
+    compiled once when the scripts are loaded. They are regexes that are
+    searched in the room id followed by the sender. Top-level alternatives
+    that are a plain piece of a room id (starting with "!", user ids do not
+    contain it) are also kept as literals, so it is known without a sender
+    whether a room can use the script at all.
+    """
+
+    def __init__(self, whitelist, blacklist):
+        self.whitelist = re.compile(whitelist) if whitelist else None
+        self.blacklist = re.compile(blacklist) if blacklist else None
+        # (anchored, literal) per alternative, None if it is not a room literal
+        self.whitelist_rooms = self.room_literals(whitelist) if whitelist else []
+        self.blacklist_rooms = self.room_literals(blacklist) if blacklist else []
+
+    @staticmethod
+    def unescape(regex):
+        """Return the text a regex matches if it is a plain literal, else None."""
+        literal = ""
+        i = 0
+        while i < len(regex):
+            char = regex[i]
+            if char == "\\":
+                char = regex[i + 1:i + 2]
+                if not char or char.isalnum():
+                    return None
+                i += 1
+            elif char in TriggerIndex.METACHARS:
+                return None
+            literal += char
+            i += 1
+        return literal
+
+    @classmethod
+    def room_literals(cls, regex):
+        literals = []
+        for alternative in TriggerIndex.split_alternatives(regex):
+            anchored = alternative.startswith("^")
+            literal = cls.unescape(alternative[1:] if anchored else alternative)
+            # a literal with "@" can reach into the sender
+            if literal and literal.startswith("!") and "@" not in literal:
+                literals.append((anchored, literal))
+            else:
+                literals.append(None)
+        return literals
+
+    @staticmethod
+    def matches_room(literal, room_id):
+        anchored, text = literal
+        return room_id.startswith(text) if anchored else text in room_id
+
+    def allows_room(self, room_id):
+        """Return False if nobody in the room can pass the lists."""
+        for literal in self.blacklist_rooms:
+            if literal and self.matches_room(literal, room_id):
+                return False
+        if not self.whitelist_rooms or None in self.whitelist_rooms:
+            return True
+        return any(self.matches_room(literal, room_id) for literal in self.whitelist_rooms)
+
+    def allows(self, room_id, sender):
+        if self.whitelist and not self.whitelist.search(room_id + sender):
+            return False
+        if self.blacklist and self.blacklist.search(room_id + sender):
+            return False
+        return True
+
+
+class ResidentScript():
+    """This class implements a pool of long-lived processes of a script.
+    A script opts in by printing "mode=resident" on the line after its regex
+    when it is called with CONFIG set. It is then started with RESIDENT set
+    and kept running. For every message it reads one JSON line with args,
+    room_id, sender and env (the variables a one-shot run gets) from stdin,
+    and answers with one JSON line with output and optionally returncode
+    and stderr on stdout.
+    """
+
+    def __init__(self, script, pool_size, idle_timeout):
+        self.script = script
+        self.pool_size = max(1, pool_size)
+        self.idle_timeout = idle_timeout
+        self.idle = []  # (process, time it became idle)
+        self.count = 0  # processes that are running, idle or busy
+        self.closed = False  # the script was reloaded or removed
+        self.condition = threading.Condition()
+
+    def spawn(self):
+        env = self.script["env"].copy()
+        env["RESIDENT"] = "1"
+        logger.debug("resident script {} started".format(self.script["name"]))
+        process = subprocess.Popen(
+            [self.script["path"]],
+            env=env,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            bufsize=0,
+            start_new_session=True
+        )
+        # requests are written without blocking, see write_request
+        os.set_blocking(process.stdin.fileno(), False)
+        process.buffer = b""
+        return process
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                while self.idle:
+                    process = self.idle.pop()[0]
+                    if process.poll() is None:
+                        return process
+                    logger.warning("resident script {} exited with return code {}".format(
+                        self.script["name"], process.returncode))
+                    self.count -= 1
+                if self.count < self.pool_size:
+                    self.count += 1
+                    break
+                self.condition.wait()
+        try:
+            return self.spawn()
+        except Exception:
+            self.release(None, False)
+            raise
+
+    def release(self, process, reusable):
+        with self.condition:
+            if reusable and not self.closed:
+                self.idle.append((process, monotonic()))
+            else:
+                if process is not None:
+                    self.kill(process)
+                self.count -= 1
+            self.condition.notify()
+
+    def kill(self, process):
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        process.wait()
+
+    def write_request(self, process, request, deadline, timeout):
+        fd = process.stdin.fileno()
+        request = memoryview(request)
+        while request:
+            remaining = None if deadline is None else deadline - monotonic()
+            if remaining is not None and remaining <= 0:
+                raise subprocess.TimeoutExpired(self.script["path"], timeout)
+            if not select.select([], [fd], [], remaining)[1]:
+                raise subprocess.TimeoutExpired(self.script["path"], timeout)
+            try:
+                request = request[os.write(fd, request):]
+            except BlockingIOError:
+                continue
+
+    def read_line(self, process, deadline, timeout):
+        fd = process.stdout.fileno()
+        while b"\n" not in process.buffer:
+            remaining = None if deadline is None else deadline - monotonic()
+            if remaining is not None and remaining <= 0:
+                raise subprocess.TimeoutExpired(self.script["path"], timeout)
+            if not select.select([fd], [], [], remaining)[0]:
+                raise subprocess.TimeoutExpired(self.script["path"], timeout)
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise EOFError("resident script closed its output")
+            process.buffer += chunk
+        line, process.buffer = process.buffer.split(b"\n", 1)
+        return line
+
+    def request(self, args, env, timeout):
+        """Send one request to a process of the pool and return the response.
+        A process that crashed is replaced and the request is tried once more.
+        The timeout covers writing the request and reading the response.
+        """
+        request = json.dumps({
+            "args": args,
+            "room_id": env.get("__room_id"),
+            "sender": env.get("__sender"),
+            "env": {k: v for k, v in env.items() if k.startswith("__")}
+        }).encode() + b"\n"
+        for attempt in range(2):
+            process = self.acquire()
+            deadline = monotonic() + timeout if timeout > 0 else None
+            try:
+                self.write_request(process, request, deadline, timeout)
+                response = json.loads(self.read_line(process, deadline, timeout))
+            except subprocess.TimeoutExpired:
+                self.release(process, False)
+                raise
+            except (OSError, EOFError, ValueError) as e:
+                self.release(process, False)
+                logger.warning("resident script {} failed ({}), restarting it".format(
+                    self.script["name"], e))
+                continue
+            self.release(process, True)
+            return response
+        raise RuntimeError("resident script {} failed twice".format(self.script["name"]))
+
+    def close(self):
+        """Stop the idle processes, busy ones are stopped when they are released."""
+        with self.condition:
+            self.closed = True
+            for process, _ in self.idle:
+                self.kill(process)
+                self.count -= 1
+            self.idle = []
+
+    def reap(self):
+        """Stop the processes that have been idle for longer than idle_timeout."""
+        with self.condition:
+            now = monotonic()
+            for entry in [e for e in self.idle if now - e[1] > self.idle_timeout]:
+                self.idle.remove(entry)
+                self.kill(entry[0])
+                self.count -= 1
+                logger.debug("resident script {} stopped after being idle".format(
+                    self.script["name"]))
+
+
+class ResultCache():
+    """This class implements a small LRU cache of script outputs where every
+    entry expires after the cache_ttl of its script. Concurrent requests for
+    the same key share a single run of the script (single-flight).
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()  # key -> (expiry time, output)
+        self.pending = {}  # key -> [threading.Event, output] of a running script
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+
+    def get(self, key, ttl, loader):
+        """Return the cached output for key or call loader to produce it.
+        loader returns (output, cacheable).
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                self.log("hit", key)
+                return entry[1]
+            pending = self.pending.get(key)
+            leader = pending is None
+            if leader:
+                self.misses += 1
+                pending = self.pending[key] = [threading.Event(), None]
+            else:
+                self.shared += 1
+            self.log("miss" if leader else "shared", key)
+        if not leader:
+            pending[0].wait()
+            if pending[1] is not None:
+                return pending[1]
+            return loader()[0]
+        output, cacheable = None, False
+        try:
+            output, cacheable = loader()
+            pending[1] = output
+        finally:
+            with self.lock:
+                del self.pending[key]
+                if cacheable and ttl > 0:
+                    self.entries[key] = (monotonic() + ttl, output)
+                    self.entries.move_to_end(key)
+                    while len(self.entries) > self.size:
+                        self.entries.popitem(last=False)
+            pending[0].set()
+        return output
+
+    def log(self, result, key):
+        logger.debug("cache {} for {} (hits {} misses {} shared {} entries {})".format(
+            result, key, self.hits, self.misses, self.shared, len(self.entries)))
+
+
+class TokenBucket():
+    """This class implements a thread-safe token bucket that allows rate
+    events per second with bursts of up to burst events. A rate of 0 or less
+    means no limit. pause() blocks all takers, e.g. for a server's retry hint.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.stamp = monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Take a token, wait until one is available if necessary."""
+        while True:
+            with self.lock:
+                now = monotonic()
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.rate <= 0:
+                        return
+                    self.tokens = min(
+                        self.burst, self.tokens + (now - self.stamp) * self.rate)
+                    self.stamp = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+    def try_take(self):
+        """Take a token if one is available, return False instead of waiting."""
+        with self.lock:
+            now = monotonic()
+            if self.paused_until > now:
+                return False
+            if self.rate <= 0:
+                return True
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def full(self):
+        """Return whether the bucket has refilled up to its burst."""
+        with self.lock:
+            return (self.paused_until <= monotonic() and
+                    self.tokens + (monotonic() - self.stamp) * self.rate >= self.burst)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, monotonic() + seconds)
+
+
+class Metrics():
+    """This class collects counters, gauges and histograms about the bot
+    for the Prometheus endpoint and the JSON dump in run_path.
+    When it is not enabled every method returns right away.
+    """
+
+    PREFIX = "tmb_"
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+    FAST_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05)
+    # name -> (type, help, histogram buckets)
+    DEFINITIONS = {
+        "events_total": (
+            "counter", "Text messages handled.", None),
+        "event_lag_seconds": (
+            "histogram", "Time between the server receiving a message and the bot handling it.",
+            BUCKETS),
+        "dispatch_seconds": (
+            "histogram", "Time spent matching a message against the script triggers.",
+            FAST_BUCKETS),
+        "reply_latency_seconds": (
+            "histogram", "Time between handling a message and sending a reply, by script.",
+            BUCKETS),
+        "script_wall_seconds": (
+            "histogram", "Wall time of script runs, by script.", BUCKETS),
+        "script_cpu_seconds_total": (
+            "counter", "CPU time of script processes, by script. " +
+            "Scripts finishing at the same moment can be mixed up.", None),
+        "scripts_in_flight": (
+            "gauge", "Script runs in progress, by script.", None),
+        "outbox_queue_depth": (
+            "gauge", "Messages waiting to be sent.", None),
+        "send_retries_total": (
+            "counter", "Responses of the server asking the bot to slow down.", None),
+        "send_errors_total": (
+            "counter", "Messages that could not be sent.", None),
+        "run_queue_depth": (
+            "gauge", "Script runs waiting for a worker.", None),
+        "runs_rejected_total": (
+            "counter", "Script runs refused, by reason (throttled or queue_full).", None),
+        "events_forwarded_total": (
+            "counter", "Messages handed to a worker process, by worker.", None),
+        "worker_restarts_total": (
+            "counter", "Worker processes that exited and were started again, by worker.", None),
+        "jobs_total": (
+            "counter", "Scheduled script runs started, by script.", None),
+        "jobs_skipped_total": (
+            "counter", "Scheduled script runs skipped, by script and reason (running or busy).", None),
+    }
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        # (name, labels) -> number, or [bucket counts, sum, count] for histograms
+        self.values = {}
+        self.lock = threading.Lock()
+        self.children_cpu_total = 0
+
+    def add(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        buckets = self.DEFINITIONS[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = [[0] * (len(buckets) + 1), 0, 0]
+            histogram[0][bisect.bisect_left(buckets, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def children_cpu(self):
+        """Return the CPU time of the child processes that ended since the last call."""
+        if not self.enabled:
+            return 0
+        with self.lock:
+            usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            total = usage.ru_utime + usage.ru_stime
+            delta = total - self.children_cpu_total
+            self.children_cpu_total = total
+        return delta
+
+    def snapshot(self):
+        """Return the metrics as a dict, e.g. for the JSON dump."""
+        with self.lock:
+            values = [(key, value if not isinstance(value, list) else
+                       [list(value[0]), value[1], value[2]])
+                      for key, value in self.values.items()]
+        metrics = {}
+        for (name, labels), value in sorted(values):
+            sample = {"labels": dict(labels)}
+            if isinstance(value, list):
+                buckets = self.DEFINITIONS[name][2] + (float("inf"),)
+                sample["buckets"] = {str(le): count for le, count in zip(buckets, value[0])}
+                sample["sum"] = value[1]
+                sample["count"] = value[2]
+            else:
+                sample["value"] = value
+            metrics.setdefault(self.PREFIX + name, []).append(sample)
+        return {"time": time(), "metrics": metrics}
+
+    @staticmethod
+    def format_labels(labels):
+        if not labels:
+            return ""
+        return "{" + ",".join("{}=\"{}\"".format(k, str(v).replace("\\", "\\\\").replace(
+            "\"", "\\\"").replace("\n", "\\n")) for k, v in labels.items()) + "}"
+
+    def render(self):
+        """Return the metrics in the Prometheus text format."""
+        lines = []
+        snapshot = self.snapshot()["metrics"]
+        for name, (metric_type, help_text, buckets) in self.DEFINITIONS.items():
+            name = self.PREFIX + name
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, metric_type))
+            for sample in snapshot.get(name, []):
+                labels = self.format_labels(sample["labels"])
+                if "value" in sample:
+                    lines.append("{}{} {}".format(name, labels, sample["value"]))
+                    continue
+                cumulative = 0
+                for le, count in zip(buckets + (float("inf"),), sample["buckets"].values()):
+                    cumulative += count
+                    bucket_labels = dict(
+                        sample["labels"], le="+Inf" if le == float("inf") else "{:g}".format(le))
+                    lines.append("{}_bucket{} {}".format(
+                        name, self.format_labels(bucket_labels), cumulative))
+                lines.append("{}_sum{} {}".format(name, labels, sample["sum"]))
+                lines.append("{}_count{} {}".format(name, labels, sample["count"]))
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        try:
+            with open(path + ".tmp", "w") as f:
+                json.dump(self.snapshot(), f, indent=1)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logger.warning("metrics {} not written: {}".format(path, e))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """This class serves the metrics in the Prometheus text format."""
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("metrics request " + format % args)
+
+
+class Outbox():
+    """This class implements the outbound message queue.
+    Every room has its own queue that is drained by its own thread, so
+    messages stay in order within a room while rooms are sent to in parallel.
+    All rooms share a token bucket that follows the server's rate limits.
+    Adjacent small messages of the same format can be coalesced into one.
+    """
+
+    # what is put between coalesced messages, by format
+    SEPARATORS = {"text": "\n\n", "html": "<br><br>", "code": "\n\n"}
+
+    def __init__(self, bucket, coalesce_size, metrics=None):
+        self.bucket = bucket
+        self.coalesce_size = coalesce_size
+        self.metrics = metrics or Metrics()
+        # room_id -> deque of (format, body, script name, time the request was handled)
+        self.queues = {}
+        self.lock = threading.Lock()
+
+    def put(self, room, message_format, body, script=None, received=None):
+        self.metrics.add("outbox_queue_depth")
+        with self.lock:
+            queue = self.queues.get(room.room_id)
+            if queue is not None:
+                queue.append((message_format, body, script, received))
+                return
+            self.queues[room.room_id] = deque([(message_format, body, script, received)])
+        threading.Thread(
+            target=self.drain, args=(room,), daemon=True,
+            name="send-{}".format(room.room_id)).start()
+
+    def drain(self, room):
+        while True:
+            with self.lock:
+                queue = self.queues[room.room_id]
+                if not queue:
+                    del self.queues[room.room_id]
+                    return
+            self.bucket.take()
+            # only this thread takes from the queue, it is still not empty
+            with self.lock:
+                message_format, body, script, received = queue.popleft()
+                requests = [(script, received)]
+                while (queue and queue[0][0] == message_format and
+                       len(body) + len(queue[0][1]) + 2 <= self.coalesce_size):
+                    _, next_body, script, received = queue.popleft()
+                    body += self.SEPARATORS[message_format] + next_body
+                    requests.append((script, received))
+            self.metrics.add("outbox_queue_depth", -len(requests))
+            try:
+                if message_format == "code":
+                    room.send_html("<pre><code>" + body + "</code></pre>")
+                elif message_format == "html":
+                    room.send_html(body)
+                else:
+                    room.send_text(body)
+            except Exception:
+                self.metrics.add("send_errors_total")
+                logger.exception("sending message to {} failed".format(room.room_id))
+                continue
+            for script, received in requests:
+                if received is not None:
+                    self.metrics.observe(
+                        "reply_latency_seconds", monotonic() - received, script=script)
+
+    def on_response(self, response, *args, **kwargs):
+        """requests response hook, pauses sending when the server asks for it."""
+        if response.status_code != 429:
+            return
+        self.metrics.add("send_retries_total")
+        try:
+            retry_after_ms = response.json()["retry_after_ms"]
+        except (ValueError, KeyError, TypeError):
+            retry_after_ms = 5000
+        logger.info("rate limited by server, pausing for {} ms".format(retry_after_ms))
+        self.bucket.pause(retry_after_ms / 1000)
+
+
+class Scheduler():
+    """This class implements the queue between dispatch and the script runs.
+    Runs wait in a queue per room and sender. A fixed number of worker
+    threads take them round-robin across the rooms, and within a room
+    round-robin across the senders, so a busy room or sender cannot hold up
+    everybody else. A run is only taken once its script has a free slot,
+    runs of a script that is already running as often as it may stay in
+    the queue without holding up a worker. Token buckets per sender and
+    per room limit how often runs are accepted and a room can only have
+    queue_size runs waiting.
+    """
+
+    def __init__(self, workers, queue_size, metrics=None):
+        self.queue_size = queue_size  # 0 or less means no limit
+        self.metrics = metrics or Metrics()
+        self.rooms = {}  # room_id -> OrderedDict of sender -> deque of (run, slots)
+        self.lengths = {}  # room_id -> number of runs waiting in the room
+        self.ready = deque()  # room ids with waiting runs, in serving order
+        self.buckets = {}  # (scope, "sender" or "room", id) -> TokenBucket
+        self.condition = threading.Condition()
+        for i in range(max(1, workers)):
+            threading.Thread(target=self.work, daemon=True,
+                             name="script-{}".format(i)).start()
+
+    def admit(self, limits, room_id, sender):
+        """Take a token from every bucket a run is limited by. limits is a
+        list of (scope, "sender" or "room", rate, burst), the scope is None
+        for the global limits and the script name for a script's own.
+        Returns False if one of the buckets is empty.
+        """
+        for scope, per, rate, burst in limits:
+            if rate <= 0:
+                continue
+            key = (scope, per, sender if per == "sender" else room_id)
+            with self.condition:
+                bucket = self.buckets.get(key)
+                if bucket is None:
+                    bucket = self.buckets[key] = TokenBucket(rate, burst)
+            if not bucket.try_take():
+                self.metrics.add("runs_rejected_total", reason="throttled")
+                return False
+        return True
+
+    def submit(self, room_id, sender, run, slots=None):
+        """Queue a run, returns False if the room's queue is full. slots is
+        the semaphore of the run's script, it is taken before the run starts
+        and given back when it has ended.
+        """
+        with self.condition:
+            length = self.lengths.get(room_id, 0)
+            if self.queue_size > 0 and length >= self.queue_size:
+                self.metrics.add("runs_rejected_total", reason="queue_full")
+                return False
+            senders = self.rooms.get(room_id)
+            if senders is None:
+                senders = self.rooms[room_id] = OrderedDict()
+                self.ready.append(room_id)
+            senders.setdefault(sender, deque()).append((run, slots))
+            self.lengths[room_id] = length + 1
+            self.condition.notify()
+        self.metrics.add("run_queue_depth")
+        return True
+
+    def take(self):
+        """Take the first run whose script has a free slot, the rooms and
+        their senders take turns. Returns None if there is none.
+        """
+        for room_id in self.ready:
+            senders = self.rooms[room_id]
+            for sender, runs in senders.items():
+                for i, (run, slots) in enumerate(runs):
+                    if slots is not None and not slots.acquire(blocking=False):
+                        continue
+                    del runs[i]
+                    if runs:
+                        senders.move_to_end(sender)
+                    else:
+                        del senders[sender]
+                    self.ready.remove(room_id)
+                    if senders:
+                        self.lengths[room_id] -= 1
+                        self.ready.append(room_id)
+                    else:
+                        del self.rooms[room_id]
+                        del self.lengths[room_id]
+                    return run, slots
+        return None
+
+    def next(self):
+        """Wait for the next run that can start, see take."""
+        with self.condition:
+            taken = self.take()
+            while taken is None:
+                self.condition.wait()
+                taken = self.take()
+        self.metrics.add("run_queue_depth", -1)
+        return taken
+
+    def work(self):
+        while True:
+            run, slots = self.next()
+            try:
+                run()
+            except Exception:
+                logger.exception("scheduled run failed")
+            finally:
+                if slots is not None:
+                    slots.release()
+                    # runs of the script may be waiting for the slot
+                    with self.condition:
+                        self.condition.notify()
+
+    def prune(self):
+        """Forget the buckets that have filled up, they are as good as new."""
+        with self.condition:
+            for key in [k for k, bucket in self.buckets.items() if bucket.full()]:
+                del self.buckets[key]
+
+
+class DirectoryWatcher():
+    """This class reports which files in a few directories were added,
+    changed or removed. It uses inotify through libc where that is available
+    and otherwise compares the files' modification times every interval
+    seconds.
+    """
+
+    # see inotify(7)
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    EVENT = struct.Struct("iIII")
+    # changes that follow each other this closely are reported together,
+    # editors and cp write a file in several steps
+    SETTLE = 0.2
+
+    def __init__(self, directories, interval):
+        self.directories = [os.path.abspath(d) for d in directories]
+        self.interval = interval
+        self.fd = None
+        self.watches = {}  # watch descriptor -> directory
+        try:
+            self.start_inotify()
+        except (OSError, AttributeError) as e:
+            logger.info("inotify not available ({}), checking for changes every {} seconds".format(
+                e, interval))
+        self.snapshot = self.scan() if self.fd is None else None
+
+    def start_inotify(self):
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        mask = (self.IN_ATTRIB | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM |
+                self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE)
+        for directory in self.directories:
+            watch = libc.inotify_add_watch(fd, os.fsencode(directory), mask)
+            if watch < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), "{}: {}".format(
+                    directory, os.strerror(ctypes.get_errno())))
+            self.watches[watch] = directory
+        self.fd = fd
+
+    def scan(self):
+        files = {}
+        for directory in self.directories:
+            try:
+                for entry in os.scandir(directory):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    files[(directory, entry.name)] = (stat.st_mtime_ns, stat.st_size, stat.st_mode)
+            except OSError:
+                continue
+        return files
+
+    def read_events(self):
+        changes = set()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return changes
+            offset = 0
+            while offset < len(data):
+                watch, mask, _, length = self.EVENT.unpack_from(data, offset)
+                name = data[offset + self.EVENT.size:offset + self.EVENT.size + length]
+                offset += self.EVENT.size + length
+                if mask & self.IN_Q_OVERFLOW:
+                    # events were lost, anything may have changed
+                    changes.update((directory, None) for directory in self.directories)
+                elif watch in self.watches:
+                    changes.add((self.watches[watch], os.fsdecode(name.rstrip(b"\0"))))
+
+    def wait(self):
+        """Wait for changes and return them as a set of (directory, file name)
+        pairs. A file name of None means that anything in the directory may
+        have changed.
+        """
+        if self.fd is None:
+            while True:
+                sleep(self.interval)
+                snapshot = self.scan()
+                changes = {key for key in set(snapshot) | set(self.snapshot)
+                           if snapshot.get(key) != self.snapshot.get(key)}
+                self.snapshot = snapshot
+                if changes:
+                    return changes
+        changes = set()
+        while not changes:
+            select.select([self.fd], [], [])
+            changes = self.read_events()
+        while select.select([self.fd], [], [], self.SETTLE)[0]:
+            changes |= self.read_events()
+        return changes
+
+
+class ProgressMessage():
+    """This class implements the progress message of a long running script.
+    It is sent once the script has run for interval seconds and then edited
+    in place (m.replace) every interval seconds until the script has ended.
+    """
+
+    def __init__(self, room, bucket, name, interval):
+        self.room = room
+        self.bucket = bucket
+        self.name = name
+        self.interval = interval
+        self.due = monotonic() + interval
+        self.event_id = None
+
+    def send(self, body):
+        content = {"msgtype": "m.notice", "body": body}
+        if self.event_id:
+            content = {
+                "msgtype": "m.notice",
+                "body": "* " + body,
+                "m.new_content": content,
+                "m.relates_to": {"rel_type": "m.replace", "event_id": self.event_id}
+            }
+        self.bucket.take()
+        try:
+            response = self.room.client.api.send_message_event(
+                self.room.room_id, "m.room.message", content)
+        except Exception:
+            logger.exception("progress message of {} not sent".format(self.name))
+            return
+        if not self.event_id:
+            self.event_id = response.get("event_id")
+
+    def update(self, elapsed):
+        self.due = monotonic() + self.interval
+        self.send("{} has been running for {:.0f} seconds ...".format(self.name, elapsed))
+
+    def finish(self, elapsed):
+        if self.event_id:
+            self.send("{} finished after {:.0f} seconds.".format(self.name, elapsed))
+
+
+class Schedule():
+    """This class implements when a scheduled script runs, either every
+    interval seconds ("300", "5m", "every 2h") or at the minutes a cron
+    expression ("*/5 * * * *", "0 12 * * 1-5", "@daily") matches in local
+    time. Raises ValueError if the expression is not valid.
+    """
+
+    ALIASES = {
+        "@hourly": "0 * * * *",
+        "@daily": "0 0 * * *",
+        "@midnight": "0 0 * * *",
+        "@weekly": "0 0 * * 0",
+        "@monthly": "0 0 1 * *",
+        "@yearly": "0 0 1 1 *",
+        "@annually": "0 0 1 1 *",
+    }
+    INTERVAL = re.compile(r"(?:every\s+)?(\d+(?:\.\d+)?)\s*([smhd]?)", re.IGNORECASE)
+    UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400}
+    # lowest and highest value of minute, hour, day of month, month and
+    # day of week, 0 and 7 are both Sunday
+    RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.interval = None
+        expression = self.ALIASES.get(spec.strip().lower(), spec.strip())
+        match = self.INTERVAL.fullmatch(expression)
+        if match:
+            self.interval = float(match.group(1)) * self.UNITS[match.group(2).lower()]
+            if self.interval <= 0:
+                raise ValueError("interval must be positive")
+            return
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError("expected an interval or five cron fields")
+        self.minutes, self.hours, self.days, self.months, self.weekdays = [
+            self.parse_field(field, low, high) for field, (low, high) in zip(fields, self.RANGES)]
+        if 7 in self.weekdays:
+            self.weekdays = (self.weekdays - {7}) | {0}
+        # as in cron, if both days are restricted either of them matches
+        self.either_day = not fields[2].startswith("*") and not fields[4].startswith("*")
+        if self.next(time()) is None:
+            raise ValueError("never matches")
+
+    @staticmethod
+    def parse_field(field, low, high):
+        """Return the values a cron field ("*", "1,15", "9-17", "*/10", "5/15") matches."""
+        values = set()
+        for part in field.split(","):
+            span, _, step = part.partition("/")
+            step = int(step) if step else 1
+            if span == "*":
+                start, end = low, high
+            elif "-" in span:
+                start, end = (int(v) for v in span.split("-", 1))
+            else:
+                start = int(span)
+                # "5/15" is every 15 from 5 on
+                end = high if "/" in part else start
+            if not low <= start <= end <= high or step < 1:
+                raise ValueError("{} is out of range {}-{}".format(part, low, high))
+            values.update(range(start, end + 1, step))
+        return values
+
+    def matches_day(self, day):
+        in_month = day.day in self.days
+        in_week = day.isoweekday() % 7 in self.weekdays
+        return in_month or in_week if self.either_day else in_month and in_week
+
+    def next(self, after):
+        """Return the first time after the given one (seconds since the
+        epoch) the script is due, None if there is none in the next years.
+        """
+        if self.interval:
+            return after + self.interval
+        # the fields are tried from the largest to the smallest, a field that
+        # does not match moves on to the start of its next month, day, ...
+        moment = datetime.fromtimestamp(after).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        last_year = moment.year + 8
+        while moment.year <= last_year:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self.matches_day(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment.timestamp()
+        return None
+
+
+class Timetable():
+    """This class implements the timer of the scheduled scripts. A thread
+    sleeps until the next job is due and hands it to start, with a random
+    delay of up to the job's jitter seconds. A job whose previous run has
+    not finished yet skips its turn. start gets the job's name and a
+    function to call when the run has finished, and returns False if the
+    run was refused.
+    """
+
+    # the wall clock can be set while the thread sleeps
+    MAX_SLEEP = 60
+
+    def __init__(self, start, metrics=None):
+        self.start = start
+        self.metrics = metrics or Metrics()
+        self.jobs = {}  # name -> [job, next time, due time including the jitter]
+        self.running = set()  # names of the jobs with a run in progress
+        self.condition = threading.Condition()
+        threading.Thread(target=self.run, daemon=True, name="timetable").start()
+
+    def update(self, jobs):
+        """Take over the jobs, a dict of name -> job with a Schedule and a
+        jitter. Jobs whose schedule did not change keep their due time.
+        """
+        now = time()
+        with self.condition:
+            timetable = {}
+            for name, job in jobs.items():
+                entry = self.jobs.get(name)
+                if (entry and entry[0]["schedule"].spec == job["schedule"].spec and
+                        entry[0]["jitter"] == job["jitter"]):
+                    timetable[name] = [job, entry[1], entry[2]]
+                    continue
+                due = job["schedule"].next(now)
+                timetable[name] = [job, due, due + random.uniform(0, job["jitter"])]
+                logger.info("script {} scheduled for {}".format(
+                    name, datetime.fromtimestamp(timetable[name][2]).strftime("%Y-%m-%d %H:%M:%S")))
+            self.jobs = timetable
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                now = time()
+                due = []
+                for name, entry in self.jobs.items():
+                    if entry[2] > now:
+                        continue
+                    job = entry[0]
+                    due.append(name)
+                    # runs that were missed, e.g. while the host was
+                    # suspended, are not made up for
+                    entry[1] = job["schedule"].next(entry[1])
+                    if entry[1] is None or entry[1] <= now:
+                        entry[1] = job["schedule"].next(now)
+                    entry[2] = entry[1] + random.uniform(0, job["jitter"])
+                if not due:
+                    wait = min([entry[2] for entry in self.jobs.values()], default=now + self.MAX_SLEEP)
+                    self.condition.wait(min(self.MAX_SLEEP, wait - now))
+                    continue
+            for name in due:
+                self.fire(name)
+
+    def fire(self, name):
+        with self.condition:
+            if name in self.running:
+                logger.info("scheduled run of {} skipped, the previous one is still running".format(name))
+                self.metrics.add("jobs_skipped_total", script=name, reason="running")
+                return
+            self.running.add(name)
+        try:
+            started = self.start(name, lambda: self.finished(name))
+        except Exception:
+            # the job gets its next turn, and the others theirs
+            logger.exception("scheduled run of {} failed to start".format(name))
+            self.finished(name)
+            return
+        if not started:
+            logger.info("scheduled run of {} skipped, busy".format(name))
+            self.metrics.add("jobs_skipped_total", script=name, reason="busy")
+            self.finished(name)
+            return
+        self.metrics.add("jobs_total", script=name)
+
+    def finished(self, name):
+        with self.condition:
+            self.running.discard(name)
+
+
+class HashRing():
+    """This class assigns room ids to workers by consistent hashing.
+    Every worker is put on a ring of hashes at a number of points, a room
+    belongs to the worker of the first point at or after the room's hash.
+    When a worker is removed only its own rooms move, to the workers next on
+    the ring, and when it is added again they move back.
+    """
+
+    def __init__(self, replicas=64):
+        self.replicas = replicas
+        self.points = []  # sorted hashes
+        self.nodes = {}  # hash -> worker
+        self.members = set()
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    def __contains__(self, node):
+        return node in self.members
+
+    def add(self, node):
+        self.members.add(node)
+        for i in range(self.replicas):
+            point = self.hash("{}-{}".format(node, i))
+            if point not in self.nodes:
+                bisect.insort(self.points, point)
+            self.nodes[point] = node
+
+    def remove(self, node):
+        self.members.discard(node)
+        for i in range(self.replicas):
+            point = self.hash("{}-{}".format(node, i))
+            if self.nodes.get(point) == node:
+                del self.nodes[point]
+                del self.points[bisect.bisect_left(self.points, point)]
+
+    def lookup(self, key):
+        """Return the worker of key, or None if the ring is empty."""
+        if not self.points:
+            return None
+        i = bisect.bisect_left(self.points, self.hash(key)) % len(self.points)
+        return self.nodes[self.points[i]]
+
+
+class ShardSupervisor():
+    """This class runs the worker processes of a sharded bot.
+    The supervisor is the only process syncing with the server. Every room
+    belongs to one worker, see HashRing, and the room's events are handed to
+    that worker as JSON lines on its stdin. The workers dispatch, run
+    scripts and send for their rooms over their own connection. A worker
+    that exits is taken off the ring, so its rooms go to the other workers
+    meanwhile, and is started again after a delay that doubles up to a
+    minute while it keeps exiting.
+    """
+
+    def __init__(self, command, count, metrics=None):
+        self.command = command  # arguments of a worker, its number is appended
+        self.metrics = metrics or Metrics()
+        self.ring = HashRing()
+        self.lock = threading.Lock()  # guards the ring
+        self.processes = [None] * count
+        self.pipe_locks = [threading.Lock() for _ in range(count)]
+        self.started = [0] * count
+        self.delays = [1] * count
+        self.due = [0] * count  # when a stopped worker is started again
+        for index in range(count):
+            self.start(index)
+
+    def start(self, index):
+        try:
+            process = subprocess.Popen(
+                self.command + [str(index)], stdin=subprocess.PIPE)
+        except OSError as e:
+            logger.warning("worker {} not started: {}".format(index, e))
+            self.due[index] = monotonic() + 60
+            return
+        self.processes[index] = process
+        self.started[index] = monotonic()
+        with self.lock:
+            self.ring.add(index)
+        logger.info("worker {} started with pid {}".format(index, process.pid))
+
+    def stopped(self, index):
+        """Take a worker off the ring and schedule its restart."""
+        with self.lock:
+            if index not in self.ring:
+                return
+            self.ring.remove(index)
+        process = self.processes[index]
+        if process and process.stdin:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+        # a worker that ran for a while gets the short delay again
+        if monotonic() - self.started[index] > 60:
+            self.delays[index] = 1
+        self.due[index] = monotonic() + self.delays[index]
+        self.delays[index] = min(60, self.delays[index] * 2)
+        self.metrics.add("worker_restarts_total", worker=str(index))
+        logger.warning("worker {} stopped, its rooms go to the other workers, "
+                       "restart in {} seconds".format(index, self.due[index] - monotonic()))
+
+    def send(self, room_id, message):
+        """Hand a message to the worker of a room, returns False if no
+        worker is running.
+        """
+        line = json.dumps(message).encode() + b"\n"
+        while True:
+            with self.lock:
+                index = self.ring.lookup(room_id)
+            if index is None:
+                logger.warning("no worker running, message for {} dropped".format(room_id))
+                return False
+            try:
+                # a worker that does not keep up holds up the sync reader
+                with self.pipe_locks[index]:
+                    self.processes[index].stdin.write(line)
+                    self.processes[index].stdin.flush()
+            except (OSError, ValueError):
+                self.stopped(index)
+                continue
+            self.metrics.add("events_forwarded_total", worker=str(index))
+            return True
+
+    def check(self):
+        """Notice workers that exited and start them again when due."""
+        for index, process in enumerate(self.processes):
+            if process is not None and process.poll() is not None:
+                logger.warning("worker {} exited with {}".format(index, process.returncode))
+                self.stopped(index)
+                self.processes[index] = None
+            if self.processes[index] is None and monotonic() >= self.due[index]:
+                self.start(index)
+
+
+class DeliveryHandler(socketserver.StreamRequestHandler):
+    """This class handles a connection to the local delivery socket.
+    The client sends one JSON line with room, format and message, the
+    message is put into the outbox of the running bot and the client gets
+    one JSON line back with ok and, if not ok, error.
+    """
+
+    def handle(self):
+        bot = self.server.bot
+        try:
+            request = json.loads(self.rfile.readline())
+            room = bot.client.rooms.get(request["room"])
+            message_format = request.get("format", "text")
+            if room is None:
+                response = {"ok": False, "error": "bot is not in room {}".format(request["room"])}
+            elif message_format not in Outbox.SEPARATORS:
+                response = {"ok": False, "error": "unknown format {}".format(message_format)}
+            else:
+                bot.deliver(room, message_format, request["message"])
+                response = {"ok": True}
+        except (ValueError, KeyError, TypeError) as e:
+            response = {"ok": False, "error": "bad request: {}".format(e)}
+        logger.debug("delivery socket request answered with {}".format(response))
+        self.wfile.write(json.dumps(response).encode() + b"\n")
 
 
 class TinyMatrixtBot():
@@ -29,17 +1428,47 @@ class TinyMatrixtBot():
         else:
             config_path = os.path.join(root_path, "tiny-matrix-bot.cfg")
         self.config.read(config_path)
+        self.config_path = os.path.abspath(config_path)
+        # the command line arguments, kept for the worker processes and the
+        # message formats
+        self.pargs = pargs
         self.base_url = self.config.get("tiny-matrix-bot", "base_url")
         self.token = self.config.get("tiny-matrix-bot", "token")
-        self.connect()
+        # metrics are only collected if they are served or dumped
+        self.metrics_port = self.config.getint(
+            "tiny-matrix-bot", "metrics_port", fallback=0)
+        self.metrics_interval = self.config.getfloat(
+            "tiny-matrix-bot", "metrics_interval", fallback=0)
+        # with more than one worker process the rooms are split between them,
+        # see ShardSupervisor, each worker serves its metrics on a port of its own
+        self.worker_processes = self.config.getint(
+            "tiny-matrix-bot", "worker_processes", fallback=1)
+        self.supervisor = None
+        if pargs.worker is not None and self.metrics_port > 0:
+            self.metrics_port += 1 + pargs.worker
+        self.metrics = Metrics(
+            pargs.room is None and (self.metrics_port > 0 or self.metrics_interval > 0))
+        # script output is sent through a queue per room, limited by a global
+        # token bucket instead of fixed sleeps
+        self.outbox = Outbox(
+            TokenBucket(
+                self.config.getfloat("tiny-matrix-bot", "send_rate", fallback=5),
+                self.config.getint("tiny-matrix-bot", "send_burst", fallback=10)),
+            self.config.getint("tiny-matrix-bot", "coalesce_size", fallback=0),
+            self.metrics)
         logger.debug("arguments {}".format(pargs))
-        logger.debug("client rooms {}".format(self.client.rooms))
+        run_path = self.config.get(
+            "tiny-matrix-bot", "run_path",
+            fallback=os.path.join(root_path, "run"))
+        # the running bot accepts messages to send on this socket, e.g. from
+        # the CLI mode below, so they go out over its existing connection
+        self.socket_path = None
+        if self.config.getboolean("tiny-matrix-bot", "socket", fallback=True):
+            self.socket_path = self.config.get(
+                "tiny-matrix-bot", "socket_path",
+                fallback=os.path.join(root_path, run_path, "tiny-matrix-bot.sock"))
 
         if pargs.room:
-            if pargs.room not in self.client.rooms:
-                logger.info(
-                    "Provided room argument is not in client rooms. Exiting ...")
-                sys.exit(1)
             if pargs.message:
                 text = pargs.message
                 logger.debug("Provided message argument \"{}\".".format(text))
@@ -47,45 +1476,146 @@ class TinyMatrixtBot():
                 text = sys.stdin.read()  # read message from stdin
             logger.debug("sending message to {}".format(pargs.room))
             if pargs.code:
-                logger.debug("sending message in format {}".format("code"))
-                self.client.rooms[pargs.room].send_html(
-                    "<pre><code>" + text + "</code></pre>")
+                message_format = "code"
             elif pargs.html:
-                logger.debug("sending message in format {}".format("html"))
-                self.client.rooms[pargs.room].send_html(text)
+                message_format = "html"
             else:
-                logger.debug("sending message in format {}".format("text"))
-                self.client.rooms[pargs.room].send_text(text)
+                message_format = "text"
+            logger.debug("sending message in format {}".format(message_format))
+            # hand the message to a running bot, if there is none send it
+            # directly without the login and initial sync of a full client
+            delivered = self.send_via_socket(pargs.room, message_format, text)
+            if delivered is None:
+                delivered = self.send_direct(pargs.room, message_format, text)
+            if not delivered:
+                logger.info(
+                    "Provided room argument is not in client rooms. Exiting ...")
+                sys.exit(1)
             logger.debug("message sent, now exiting")
             sys.exit(0)
-        run_path = self.config.get(
-            "tiny-matrix-bot", "run_path",
-            fallback=os.path.join(root_path, "run"))
+        # the server only sends what the bot reads, messages and membership
+        # changes, and the members of a room only as far as they sent them
+        self.sync_filter = None
+        if self.config.getboolean("tiny-matrix-bot", "sync_filter", fallback=True):
+            self.sync_filter = json.dumps({
+                "presence": {"types": []},
+                "account_data": {"types": []},
+                "room": {
+                    "state": {"lazy_load_members": True},
+                    "timeline": {
+                        "limit": self.config.getint(
+                            "tiny-matrix-bot", "timeline_limit", fallback=20),
+                        "types": ["m.room.message", "m.room.member"]},
+                    "ephemeral": {"types": []},
+                    "account_data": {"types": []}}})
+        if pargs.worker is None:
+            self.connect()
+            logger.debug("client rooms {}".format(self.client.rooms))
+        else:
+            self.connect_worker()
         os.chdir(run_path)
         scripts_path = self.config.get(
             "tiny-matrix-bot", "scripts_path",
             fallback=os.path.join(root_path, "scripts"))
         enabled_scripts = self.config.get(
             "tiny-matrix-bot", "enabled_scripts", fallback=None)
-        self.scripts = self.load_scripts(scripts_path, enabled_scripts)
+        # the trigger regexes of the scripts are remembered in a manifest,
+        # so only new or changed scripts have to be asked for them again
+        self.manifest_path = None
+        if self.config.getboolean("tiny-matrix-bot", "script_cache", fallback=True):
+            self.manifest_path = os.path.join(run_path, "{}.manifest.json".format(
+                os.path.basename(os.path.normpath(scripts_path))))
+        if pargs.worker is None and self.worker_processes > 1:
+            self.supervise(scripts_path, enabled_scripts)
+        # scripts run on a pool of worker threads, so a slow script does not
+        # hold up the listener thread and with it every other room
+        self.max_workers = self.config.getint(
+            "tiny-matrix-bot", "max_workers", fallback=os.cpu_count() or 1)
+        self.script_timeout = self.config.getfloat(
+            "tiny-matrix-bot", "script_timeout", fallback=300)
+        self.script_concurrency = self.config.getint(
+            "tiny-matrix-bot", "script_concurrency", fallback=self.max_workers)
+        # the workers take the runs round-robin across rooms and senders,
+        # how often a sender or room may start runs is limited by token buckets
+        self.scheduler = Scheduler(
+            self.max_workers,
+            self.config.getint("tiny-matrix-bot", "queue_size", fallback=50),
+            self.metrics)
+        self.limits = self.read_limits("tiny-matrix-bot", None)
+        # runs that are refused are answered with this, at most once per
+        # busy_interval seconds for a sender in a room
+        self.busy_message = self.config.get(
+            "tiny-matrix-bot", "busy_message", fallback="Busy, please try again later.")
+        self.busy_interval = self.config.getfloat(
+            "tiny-matrix-bot", "busy_interval", fallback=60)
+        self.busy_sent = {}  # (room_id, sender) -> time of the last busy reply
+        self.cache = ResultCache(self.config.getint(
+            "tiny-matrix-bot", "cache_size", fallback=256))
+        self.plugins = {}  # path -> handle function of the plugin
+        self.timetable = None
+        self.triggers = None
+        self.room_triggers = {}  # room_id -> TriggerIndex
+        self.dispatch_lock = threading.Lock()
+        self.index_triggers(self.load_scripts(scripts_path, enabled_scripts))
+        # the CPU time of the probes does not belong to any script run
+        self.metrics.children_cpu()
         self.inviter = self.config.get(
             "tiny-matrix-bot", "inviter", fallback=None)
-        self.client.add_invite_listener(self.on_invite)
-        self.client.add_leave_listener(self.on_leave)
-        for room_id in self.client.rooms:
-            self.join_room(room_id)
-        self.client.start_listener_thread(
-            exception_handler=lambda e: self.connect())
+        if pargs.worker is None:
+            self.client.add_invite_listener(self.on_invite)
+            self.client.add_leave_listener(self.on_leave)
+            for room_id in self.client.rooms:
+                self.join_room(room_id)
+            self.start_socket_server()
+        # scripts with a schedule are run by the bot itself instead of cron,
+        # by the first worker of a sharded bot, see Timetable
+        if pargs.worker in (None, 0):
+            self.timetable = Timetable(self.start_job, self.metrics)
+            self.schedule_scripts()
+        self.start_metrics_server()
+        # added, changed and removed scripts and config changes are picked
+        # up without a restart
+        if self.config.getboolean("tiny-matrix-bot", "reload", fallback=True):
+            threading.Thread(
+                target=self.watch, args=(scripts_path,), daemon=True,
+                name="reload").start()
+        if pargs.worker is None:
+            self.client.start_listener_thread(
+                exception_handler=lambda e: self.connect())
+            metrics_path = os.path.join(os.getcwd(), "metrics.json")
+        else:
+            threading.Thread(target=self.read_supervisor, daemon=True,
+                             name="supervisor").start()
+            metrics_path = os.path.join(os.getcwd(), "metrics-{}.json".format(pargs.worker))
+        metrics_due = monotonic() + self.metrics_interval
         while True:
             sleep(0.5)
+            self.reap_resident_scripts()
+            self.scheduler.prune()
+            if self.metrics_interval > 0 and monotonic() >= metrics_due:
+                self.metrics.dump(metrics_path)
+                metrics_due = monotonic() + self.metrics_interval
 
     def connect(self):
+        from matrix_client.client import MatrixClient, CACHE
         try:
             # downgraded this from info to debug, because if this program is used by other
             # automated scripts for sending messages then this extra output is
             # undesirable
             logger.debug("connecting to {}".format(self.base_url))
-            self.client = MatrixClient(self.base_url, token=self.token)
+            if self.sync_filter:
+                # MatrixClient syncs right away when it gets the token, so
+                # the filter is set first and the rest is done here; the
+                # room state the bot never reads is not kept
+                self.client = MatrixClient(self.base_url, cache_level=CACHE.NONE)
+                self.client.sync_filter = self.sync_filter
+                self.client.api.token = self.token
+                self.client.user_id = self.client.api.whoami()["user_id"]
+                self.client._sync()
+            else:
+                self.client = MatrixClient(self.base_url, token=self.token)
+            self.client.api.session.hooks["response"].append(
+                self.outbox.on_response)
             # same here, downgrade from info to debug, to avoid output for normal use
             # cases in other automated scripts
             logger.debug("connection established")
@@ -96,53 +1626,611 @@ class TinyMatrixtBot():
             sleep(5)
             self.connect()
 
-    def load_scripts(self, path, enabled):
-        scripts = []
-        for script_name in os.listdir(path):
+    def connect_worker(self):
+        """Set up a client of a worker process, it only sends, the supervisor
+        syncs and hands the events over, see read_supervisor.
+        """
+        from matrix_client.client import MatrixClient
+        try:
+            logger.debug("connecting to {}".format(self.base_url))
+            self.client = MatrixClient(self.base_url)
+            self.client.api.token = self.token
+            self.client.api.session.hooks["response"].append(
+                self.outbox.on_response)
+            self.client.user_id = self.client.api.whoami()["user_id"]
+            logger.debug("connection established")
+        except Exception:
+            logger.warning(
+                "connection to {} failed".format(self.base_url) +
+                ", retrying in 5 seconds...")
+            sleep(5)
+            self.connect_worker()
+
+    def supervise(self, scripts_path, enabled_scripts):
+        """Sync and hand the events of every room to its worker process,
+        see ShardSupervisor. Does not return.
+        """
+        # the workers find the triggers in the manifest instead of each of
+        # them probing every script
+        self.probe_scripts([
+            p for p in self.list_scripts(scripts_path, enabled_scripts)
+            if os.path.exists(p) and not p.endswith(".py")])
+        command = [sys.executable, os.path.realpath(__file__)]
+        for flag in ("debug", "html", "code"):
+            if getattr(self.pargs, flag):
+                command.append("--" + flag)
+        self.supervisor = ShardSupervisor(
+            command + ["--worker"], self.worker_processes, self.metrics)
+        self.inviter = self.config.get(
+            "tiny-matrix-bot", "inviter", fallback=None)
+        self.client.add_invite_listener(self.on_invite)
+        self.client.add_leave_listener(self.on_leave)
+        for room_id in self.client.rooms:
+            self.join_room(room_id)
+        self.start_socket_server()
+        self.start_metrics_server()
+        self.client.start_listener_thread(
+            exception_handler=lambda e: self.connect())
+        metrics_path = os.path.join(os.getcwd(), "metrics.json")
+        metrics_due = monotonic() + self.metrics_interval
+        while True:
+            sleep(0.5)
+            self.supervisor.check()
+            if self.metrics_interval > 0 and monotonic() >= metrics_due:
+                self.metrics.dump(metrics_path)
+                metrics_due = monotonic() + self.metrics_interval
+
+    def read_supervisor(self):
+        """Handle what the supervisor hands to this worker process on stdin,
+        one JSON line with room_id and either event, leave or format and
+        message each. Exits when the supervisor is gone.
+        """
+        from matrix_client.room import Room
+        rooms = {}  # room_id -> Room
+        for line in sys.stdin.buffer:
+            try:
+                request = json.loads(line)
+                room = rooms.get(request["room_id"])
+                if room is None:
+                    room = rooms[request["room_id"]] = Room(self.client, request["room_id"])
+                if "event" in request:
+                    self.on_room_event(room, request["event"])
+                elif request.get("leave"):
+                    self.room_triggers.pop(room.room_id, None)
+                    del rooms[room.room_id]
+                else:
+                    self.outbox.put(room, request["format"], request["message"])
+            except Exception:
+                logger.exception("request from supervisor failed")
+        logger.info("supervisor is gone, exiting")
+        os._exit(0)
+
+    def forward_event(self, room, event):
+        # the workers only handle messages of others, the rest is not
+        # worth handing over
+        if event["type"] != "m.room.message" or event["sender"] == self.client.user_id:
+            return
+        self.supervisor.send(room.room_id, {"room_id": room.room_id, "event": event})
+
+    def deliver(self, room, message_format, body):
+        """Send a message from the delivery socket, through the worker of
+        the room if the bot is sharded.
+        """
+        if self.supervisor:
+            self.supervisor.send(room.room_id, {
+                "room_id": room.room_id,
+                "format": message_format,
+                "message": body
+            })
+        else:
+            self.outbox.put(room, message_format, body)
+
+    def send_via_socket(self, room_id, message_format, text):
+        """Hand a message to the running bot over its delivery socket.
+        Returns None if no bot is listening, otherwise whether the bot
+        accepted the message.
+        """
+        if not self.socket_path:
+            return None
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(10)
+                sock.connect(self.socket_path)
+                sock.sendall(json.dumps({
+                    "room": room_id,
+                    "format": message_format,
+                    "message": text
+                }).encode() + b"\n")
+                response = json.loads(sock.makefile("rb").readline())
+        except (OSError, ValueError) as e:
+            logger.debug("delivery socket {} not usable: {}".format(self.socket_path, e))
+            return None
+        if not response.get("ok"):
+            logger.debug("bot did not accept message: {}".format(response.get("error")))
+        return bool(response.get("ok"))
+
+    def send_direct(self, room_id, message_format, text):
+        """Send a message with a single request, without syncing first."""
+        from matrix_client.api import MatrixHttpApi
+        from matrix_client.errors import MatrixRequestError
+        if message_format == "code":
+            html = "<pre><code>" + text + "</code></pre>"
+        elif message_format == "html":
+            html = text
+        else:
+            html = None
+        content = {"msgtype": "m.text", "body": text}
+        if html is not None:
+            content["format"] = "org.matrix.custom.html"
+            content["formatted_body"] = html
+            content["body"] = re.sub("<[^<]+?>", "", html)
+        try:
+            MatrixHttpApi(self.base_url, token=self.token).send_message_event(
+                room_id, "m.room.message", content)
+        except MatrixRequestError as e:
+            if e.code in (403, 404):
+                logger.debug("sending to {} refused: {}".format(room_id, e))
+                return False
+            raise
+        return True
+
+    def start_socket_server(self):
+        if not self.socket_path:
+            return
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        # the socket is created by bind(), so other users must not be able
+        # to connect between that and the chmod
+        umask = os.umask(0o077)
+        try:
+            server = socketserver.ThreadingUnixStreamServer(
+                self.socket_path, DeliveryHandler)
+        except OSError as e:
+            logger.warning("delivery socket {} not available: {}".format(self.socket_path, e))
+            return
+        finally:
+            os.umask(umask)
+        os.chmod(self.socket_path, 0o600)
+        server.daemon_threads = True
+        server.bot = self
+        threading.Thread(target=server.serve_forever, daemon=True,
+                         name="delivery-socket").start()
+        logger.info("delivery socket {}".format(self.socket_path))
+
+    def start_metrics_server(self):
+        if self.metrics_port <= 0:
+            return
+        address = self.config.get(
+            "tiny-matrix-bot", "metrics_address", fallback="127.0.0.1")
+        try:
+            server = ThreadingHTTPServer((address, self.metrics_port), MetricsHandler)
+        except OSError as e:
+            logger.warning("metrics endpoint {}:{} not available: {}".format(
+                address, self.metrics_port, e))
+            return
+        server.daemon_threads = True
+        server.metrics = self.metrics
+        threading.Thread(target=server.serve_forever, daemon=True,
+                         name="metrics").start()
+        logger.info("metrics on http://{}:{}/metrics".format(address, self.metrics_port))
+
+    def list_scripts(self, path, enabled, names=None):
+        """Return the paths of the enabled scripts in path, of all files and
+        config sections or only of the given names. Executable files are
+        run, Python modules (*.py) are plugins, see load_plugin, and a config
+        section with a trigger but without a file is a static reply.
+        """
+        if names is None:
+            files = os.listdir(path)
+            names = files + sorted(set(self.config.sections()) - set(files))
+        script_paths = []
+        for script_name in names:
             script_path = os.path.join(path, script_name)
             if enabled:
                 if script_name not in enabled:
                     logger.debug(
                         "script {} is not enabled".format(script_name))
                     continue
-            if (not os.access(script_path, os.R_OK) or
-                    not os.access(script_path, os.X_OK)):
+            if not os.path.exists(script_path):
+                if (script_name != "tiny-matrix-bot" and
+                        self.config.has_option(script_name, "trigger")):
+                    script_paths.append(script_path)
+                continue
+            if (not os.path.isfile(script_path) or
+                    not os.access(script_path, os.R_OK) or
+                    not (script_name.endswith(".py") or os.access(script_path, os.X_OK))):
                 logger.debug("script {} is not executable".format(script_name))
                 continue
-            # the .copy() is extremely important, leaving it out is a major bug
-            # as variables from the config file will then be constantly
-            # overwritten!
-            script_env = os.environ.copy()
-            script_env["CONFIG"] = "1"
-            logger.debug("script {} with script_env {}".format(
-                script_name, script_env))
-            script_regex = subprocess.Popen(
+            script_paths.append(script_path)
+        return script_paths
+
+    def read_script_configs(self, script_paths, unchanged=()):
+        """Return what the scripts print when called with CONFIG set, by
+        path. Plugins and static replies are not run, for them it is made
+        up from their trigger and options. See probe_scripts for unchanged.
+        """
+        configs = {}
+        probe = []
+        for script_path in script_paths:
+            script_name = os.path.basename(script_path)
+            if not os.path.exists(script_path):
+                configs[script_path] = self.config.get(script_name, "trigger") + "\nmode=static"
+            elif script_name.endswith(".py"):
+                configs[script_path] = self.load_plugin(script_path)
+            else:
+                probe.append(script_path)
+        configs.update(self.probe_scripts(probe, unchanged))
+        return configs
+
+    def load_plugin(self, plugin_path):
+        """Import a plugin, a Python module with a TRIGGER regex and a handle
+        function or coroutine function. handle gets the room id, the sender,
+        the arguments and the plugin's config section as a dict and returns
+        the reply. An OPTIONS dict can hold what scripts print after their
+        regex. Returns what a script would print when called with CONFIG
+        set, nothing if the plugin cannot be used.
+        """
+        plugin_name = os.path.basename(plugin_path)
+        self.plugins.pop(plugin_path, None)
+        try:
+            spec = importlib.util.spec_from_file_location(
+                "tiny_matrix_bot_plugin_" + plugin_name[:-3], plugin_path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            self.plugins[plugin_path] = module.handle
+            return "\n".join([module.TRIGGER] + [
+                "{}={}".format(k, v) for k, v in getattr(module, "OPTIONS", {}).items()])
+        except Exception:
+            logger.exception("plugin {} not loaded".format(plugin_name))
+            return ""
+
+    def load_scripts(self, path, enabled):
+        scripts = []
+        script_paths = self.list_scripts(path, enabled)
+        # what the scripts printed when probed, by path, kept for reloads
+        self.script_configs = self.read_script_configs(script_paths)
+        for script_path in script_paths:
+            script = self.make_script(script_path, self.script_configs[script_path])
+            if script:
+                scripts.append(script)
+        logger.debug("all scripts {}".format(scripts))
+        return scripts
+
+    def make_script(self, script_path, script_config):
+        """Return the definition of a script from its probe output and its
+        config section, None if it cannot be used.
+        """
+        script_name = os.path.basename(script_path)
+        script_regex, script_options = self.parse_script_config(script_config)
+        if not script_regex:
+            logger.debug("script {} has no regex".format(script_name))
+            return None
+        # the .copy() is extremely important, leaving it out is a major bug
+        # as variables from the config file will then be constantly
+        # overwritten!
+        script_env = os.environ.copy()
+        # CONFIG may hold the path of the bot's config file, but to a
+        # script it means that it is asked for its regex
+        script_env.pop("CONFIG", None)
+        # a format the script prints after its regex is the default
+        if "format" in script_options:
+            script_env["__format"] = script_options["format"]
+        if self.config.has_section(script_name):
+            for key, value in self.config.items(script_name):
+                script_env["__" + key] = value
+                logger.debug(
+                    "add key-value pair key {} to script_env".format(key))
+                logger.debug(
+                    "add key-value pair value {} to script_env".format(value))
+        try:
+            acl = ScriptAcl(
+                self.config.get(script_name, "whitelist", fallback=None),
+                self.config.get(script_name, "blacklist", fallback=None))
+        except re.error as e:
+            logger.warning("script {} has an invalid whitelist or blacklist ({}), "
+                           "not loading it".format(script_name, e))
+            return None
+        script = {
+            "name": script_name,
+            "path": script_path,
+            "regex": script_regex,
+            "env": script_env,
+            "acl": acl,
+            # 0 or a negative value disables the timeout
+            "timeout": self.config.getfloat(
+                script_name, "timeout", fallback=self.script_timeout),
+            # number of runs of this script allowed at the same time
+            "slots": threading.BoundedSemaphore(self.config.getint(
+                script_name, "concurrency", fallback=self.script_concurrency)),
+            # seconds the output of the script is reused for the same
+            # arguments, 0 disables caching
+            "cache_ttl": self.config.getfloat(
+                script_name, "cache_ttl",
+                fallback=float(script_options.get("cache_ttl", 0))),
+            "cache_per_room": self.config.getboolean(
+                script_name, "cache_per_room",
+                fallback=script_options.get("cache_per_room") in ("1", "true", "yes")),
+            # send every finished message while the script is still
+            # running instead of all of them when it has ended
+            "stream": self.config.getboolean(
+                script_name, "stream",
+                fallback=script_options.get("stream") in ("1", "true", "yes")),
+            # seconds after which a progress message is shown that is
+            # updated until the script ends, 0 disables it
+            "progress": self.config.getfloat(
+                script_name, "progress",
+                fallback=float(script_options.get("progress", 0))),
+            # the script's own limits, on top of the global ones
+            "limits": self.read_limits(script_name, script_name)
+        }
+        schedule = self.config.get(script_name, "schedule", fallback=script_options.get("schedule"))
+        if schedule:
+            # the rooms the output of scheduled runs goes to, by default
+            # those of the [tiny-matrix-bot] section
+            rooms = self.config.get(
+                script_name, "schedule_rooms", fallback=script_options.get(
+                    "schedule_rooms", self.config.get("tiny-matrix-bot", "schedule_rooms", fallback=""))
+            ).replace(",", " ").split()
+            try:
+                if not rooms:
+                    raise ValueError("no schedule_rooms")
+                script["job"] = {
+                    "schedule": Schedule(schedule),
+                    "rooms": rooms,
+                    # the message a scheduled run gets, as if it was sent
+                    "args": self.config.get(
+                        script_name, "schedule_args", fallback=script_options.get("schedule_args", "")),
+                    # seconds a run is delayed by at most, so scripts that
+                    # are due at the same time do not all start at once
+                    "jitter": self.config.getfloat(
+                        script_name, "schedule_jitter",
+                        fallback=float(script_options.get("schedule_jitter", 0)))
+                }
+            except ValueError as e:
+                logger.warning("script {} has an invalid schedule ({}), not scheduling it".format(
+                    script_name, e))
+        mode = self.config.get(script_name, "mode", fallback=script_options.get("mode"))
+        if script_path in self.plugins and script_name.endswith(".py"):
+            script["handler"] = self.plugins[script_path]
+            # the plugin's config section, with its OPTIONS as defaults
+            script["config"] = dict(script_options, **(
+                dict(self.config.items(script_name)) if self.config.has_section(script_name) else {}))
+        elif mode == "static":
+            # answered from the config, nothing is run
+            script["reply"] = self.config.get(
+                script_name, "reply", fallback=script_options.get("reply", ""))
+        elif mode == "resident":
+            script["resident"] = ResidentScript(
+                script,
+                self.config.getint(
+                    script_name, "pool", fallback=int(script_options.get("pool", 1))),
+                self.config.getfloat(
+                    script_name, "idle", fallback=float(script_options.get("idle", 300))))
+        logger.info("script {}".format(script["name"]))
+        return script
+
+    def read_limits(self, section, scope):
+        """Return the sender and room limits set in a config section,
+        see Scheduler.admit. A section only has limits if it sets a rate.
+        """
+        limits = []
+        for per, burst in (("sender", 5), ("room", 10)):
+            if not self.config.has_option(section, per + "_rate"):
+                continue
+            limits.append((
+                scope, per,
+                self.config.getfloat(section, per + "_rate"),
+                self.config.getint(
+                    section, per + "_burst",
+                    fallback=self.config.getint("tiny-matrix-bot", per + "_burst", fallback=burst))))
+        return limits
+
+    def index_triggers(self, scripts):
+        """Swap in a new dispatch table, i.e. the scripts, their triggers and
+        the triggers of every room. Runs in progress keep the definitions
+        of the scripts they were started with.
+        """
+        triggers = TriggerIndex(
+            [(script["regex"], script) for script in scripts], self.triggers)
+        with self.dispatch_lock:
+            self.scripts = scripts
+            self.triggers = triggers
+            # every room gets the triggers of the scripts its ACLs let it use,
+            # rooms that can use the same scripts share one index
+            self.trigger_sets = {
+                tuple(script["name"] for script in scripts): triggers}
+            self.room_triggers = {
+                room_id: self.room_trigger_set(room_id) for room_id in self.room_triggers}
+
+    def schedule_scripts(self):
+        """Hand the schedules of the scripts to the timetable."""
+        if self.timetable:
+            self.timetable.update(
+                {script["name"]: script["job"] for script in self.scripts if "job" in script})
+
+    def watch(self, scripts_path):
+        scripts_path = os.path.abspath(scripts_path)
+        config_dir, config_name = os.path.split(self.config_path)
+        # editors replace files, so the config file's directory is watched
+        watcher = DirectoryWatcher(
+            [scripts_path, config_dir],
+            self.config.getfloat("tiny-matrix-bot", "reload_interval", fallback=2))
+        while True:
+            changes = watcher.wait()
+            names = set()
+            config_changed = False
+            for directory, name in changes:
+                if directory == config_dir and name in (config_name, None):
+                    config_changed = True
+                elif directory == scripts_path:
+                    names.add(name)
+            if None in names:
+                names = set(os.listdir(scripts_path)) | {s["name"] for s in self.scripts}
+            try:
+                self.reload(scripts_path, names, config_changed)
+            except Exception:
+                logger.exception("reload failed")
+
+    def reload(self, scripts_path, names, config_changed):
+        """Probe the scripts with the given file names again, and rebuild the
+        scripts whose config section changed, then swap in the new dispatch
+        table. Scripts that are not affected are left as they are.
+        """
+        started = monotonic()
+        rebuild = set()
+        if config_changed:
+            config = configparser.ConfigParser()
+            config.read(self.config_path)
+            sections = set(config.sections()) | set(self.config.sections())
+            changed = {section for section in sections if
+                       (config.items(section) if config.has_section(section) else None) !=
+                       (self.config.items(section) if self.config.has_section(section) else None)}
+            logger.debug("config sections changed {}".format(changed))
+            self.config = config
+            if "tiny-matrix-bot" in changed:
+                self.reload_settings()
+                # the settings are defaults of every script
+                rebuild = {script["name"] for script in self.scripts}
+                names |= set(os.listdir(scripts_path))
+            rebuild |= changed
+        if not names and not rebuild:
+            return
+        enabled = self.config.get("tiny-matrix-bot", "enabled_scripts", fallback=None)
+        scripts = OrderedDict((script["name"], script) for script in self.scripts)
+        candidates = self.list_scripts(scripts_path, enabled, names | rebuild)
+        # only new and changed scripts are probed, the others keep their
+        # output; static replies cost nothing and their trigger may have changed
+        probe = [p for p in candidates if os.path.basename(p) in names or
+                 p not in self.script_configs or not os.path.exists(p)]
+        self.script_configs.update(self.read_script_configs(
+            probe, [script["path"] for script in self.scripts]))
+        self.metrics.children_cpu()
+        for name in names | rebuild:
+            script_path = os.path.join(scripts_path, name)
+            if name not in scripts and script_path not in candidates:
+                continue
+            old = scripts.pop(name, None)
+            script = None
+            if script_path in candidates:
+                script = self.make_script(script_path, self.script_configs[script_path])
+            if script:
+                scripts[name] = script
+            else:
+                logger.info("script {} removed".format(name))
+            if old and "resident" in old:
+                old["resident"].close()
+        self.index_triggers(list(scripts.values()))
+        self.schedule_scripts()
+        logger.info("reload probed {} scripts and took {:.0f} ms, {} scripts loaded".format(
+            len(probe), (monotonic() - started) * 1000, len(scripts)))
+
+    def reload_settings(self):
+        """Take over the settings that can change while the bot runs."""
+        logger.info("settings changed, connection, workers, sending, socket and "
+                    "metrics settings take effect on the next start")
+        self.script_timeout = self.config.getfloat(
+            "tiny-matrix-bot", "script_timeout", fallback=300)
+        self.script_concurrency = self.config.getint(
+            "tiny-matrix-bot", "script_concurrency", fallback=self.max_workers)
+        self.scheduler.queue_size = self.config.getint(
+            "tiny-matrix-bot", "queue_size", fallback=50)
+        self.limits = self.read_limits("tiny-matrix-bot", None)
+        self.busy_message = self.config.get(
+            "tiny-matrix-bot", "busy_message", fallback="Busy, please try again later.")
+        self.busy_interval = self.config.getfloat(
+            "tiny-matrix-bot", "busy_interval", fallback=60)
+
+    def parse_script_config(self, config):
+        """Split what a script prints when called with CONFIG set into its
+        regex (first line) and options (following "key=value" lines).
+        """
+        lines = config.splitlines()
+        options = {}
+        for line in lines[1:]:
+            key, sep, value = line.partition("=")
+            if sep:
+                options[key.strip()] = value.strip()
+        return (lines[0].strip() if lines else ""), options
+
+    def probe_script(self, script_path):
+        """Run a script with CONFIG set and return what it prints,
+        i.e. the regex that triggers the script and its options. None if
+        the script failed.
+        """
+        script_name = os.path.basename(script_path)
+        script_env = os.environ.copy()
+        script_env["CONFIG"] = "1"
+        logger.debug("script {} with script_env {}".format(
+            script_name, script_env))
+        try:
+            process = subprocess.Popen(
                 [script_path],
                 env=script_env,
                 stdout=subprocess.PIPE,
                 universal_newlines=True
-            ).communicate()[0].strip()
-            if not script_regex:
-                logger.debug("script {} has no regex".format(script_name))
-                continue
-            del script_env["CONFIG"]
-            if self.config.has_section(script_name):
-                for key, value in self.config.items(script_name):
-                    script_env["__" + key] = value
-                    logger.debug(
-                        "add key-value pair key {} to script_env".format(key))
-                    logger.debug(
-                        "add key-value pair value {} to script_env".format(value))
-            script = {
-                "name": script_name,
-                "path": script_path,
-                "regex": script_regex,
-                "env": script_env
+            )
+        except OSError as e:
+            logger.warning("script {} not probed: {}".format(script_name, e))
+            return None
+        output = process.communicate()[0].strip()
+        if process.returncode != 0:
+            logger.warning("script {} exited with {} when probed".format(
+                script_name, process.returncode))
+            return None
+        return output
+
+    def probe_scripts(self, script_paths, unchanged=()):
+        """Return a dict that maps script paths to their CONFIG output.
+        Scripts found unchanged in the manifest are not run again, all
+        others are probed in parallel and the manifest is updated.
+        The manifest entries of the unchanged paths are kept as they are,
+        failed and empty probes get none so they are retried next time.
+        """
+        manifest = {}
+        if self.manifest_path:
+            try:
+                with open(self.manifest_path) as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                logger.debug("no usable manifest {}".format(self.manifest_path))
+        entries = {}
+        misses = []
+        for script_path in script_paths:
+            stat = os.stat(script_path)
+            with open(script_path, "rb") as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            entry = {
+                "mtime": stat.st_mtime_ns,
+                "size": stat.st_size,
+                "sha256": digest
             }
-            scripts.append(script)
-            logger.info("script {}".format(script["name"]))
-            logger.debug("all scripts {}".format(scripts))
-        return scripts
+            cached = manifest.get(script_path, {})
+            if "config" in cached and all(cached.get(k) == v for k, v in entry.items()):
+                entry["config"] = cached["config"]
+            else:
+                misses.append(script_path)
+            entries[script_path] = entry
+        logger.debug("script manifest hits {} misses {}".format(
+            len(script_paths) - len(misses), len(misses)))
+        if misses:
+            # probing mostly waits for fork/exec, so use more threads than CPUs
+            with ThreadPoolExecutor() as executor:
+                for script_path, script_config in zip(
+                        misses, executor.map(self.probe_script, misses)):
+                    entries[script_path]["config"] = script_config or ""
+        written = {k: v for k, v in entries.items() if v["config"]}
+        kept = {k: manifest[k] for k in unchanged if k in manifest and k not in entries}
+        if self.manifest_path and (misses or set(manifest) != set(written) | set(kept)):
+            try:
+                # worker processes of a sharded bot can write at the same time
+                tmp_path = "{}.{}.tmp".format(self.manifest_path, os.getpid())
+                with open(tmp_path, "w") as f:
+                    json.dump(dict(kept, **written), f, indent=1, sort_keys=True)
+                os.replace(tmp_path, self.manifest_path)
+            except OSError as e:
+                logger.warning("manifest {} not written: {}".format(
+                    self.manifest_path, e))
+        return {k: v["config"] for k, v in entries.items()}
 
     def on_invite(self, room_id, state):
         sender = "someone"
@@ -163,8 +2251,32 @@ class TinyMatrixtBot():
     def join_room(self, room_id):
         logger.info("join {}".format(room_id))
         room = self.client.join_room(room_id)
+        if self.sync_filter:
+            # the events of a room are handled as they come, none are looked up later
+            room.event_history_limit = 0
+        if self.supervisor:
+            room.add_listener(self.forward_event)
+            return
+        self.update_room_triggers(room_id)
         room.add_listener(self.on_room_event)
 
+    def update_room_triggers(self, room_id):
+        with self.dispatch_lock:
+            triggers = self.room_triggers[room_id] = self.room_trigger_set(room_id)
+        return triggers
+
+    def room_trigger_set(self, room_id):
+        """Return the triggers of the scripts a room can use, see ScriptAcl."""
+        scripts = [script for script in self.scripts if script["acl"].allows_room(room_id)]
+        names = tuple(script["name"] for script in scripts)
+        triggers = self.trigger_sets.get(names)
+        if triggers is None:
+            triggers = self.trigger_sets[names] = TriggerIndex(
+                [(script["regex"], script) for script in scripts], self.triggers)
+        logger.debug("room {} can use {} of {} scripts".format(
+            room_id, len(scripts), len(self.scripts)))
+        return triggers
+
     def on_leave(self, room_id, state):
         sender = "someone"
         for event in state["timeline"]["events"]:
@@ -172,8 +2284,20 @@ class TinyMatrixtBot():
                 continue
             sender = event["sender"]
         logger.info("kicked from {} by {}".format(room_id, sender))
+        if self.supervisor:
+            # the worker of the room forgets it, the supervisor keeps no
+            # triggers
+            self.supervisor.send(room_id, {"room_id": room_id, "leave": True})
+            return
+        self.room_triggers.pop(room_id, None)
 
     def on_room_event(self, room, event):
+        triggers = self.room_triggers.get(room.room_id)
+        if triggers is None:
+            triggers = self.update_room_triggers(room.room_id)
+        # nothing in this room can trigger a script
+        if not triggers:
+            return
         if event["sender"] == self.client.user_id:
             logger.debug(
                 "event from sender (itself) {}".format(event["sender"]))
@@ -196,50 +2320,284 @@ class TinyMatrixtBot():
             logger.debug("event of msgtype (!=m.text) {}".format(
                 event["content"]["msgtype"]))
             return
+        received = monotonic()
+        self.metrics.add("events_total")
+        if "origin_server_ts" in event:
+            self.metrics.observe(
+                "event_lag_seconds", time() - event["origin_server_ts"] / 1000)
         args = event["content"]["body"].strip()
         logger.debug("args {}".format(args))
-        for script in self.scripts:
-            # multiple scripts can match regex, multiple scripts can be kicked
-            # off
-            if not re.search(script["regex"], args, re.IGNORECASE):
-                continue
-            self.run_script(room, event, script, args)
-
-    def run_script(self, room, event, script, args):
-        script["env"]["__room_id"] = event["room_id"]
-        script["env"]["__sender"] = event["sender"]
-        if "__whitelist" in script["env"]:
-            if not re.search(script["env"]["__whitelist"],
-                             event["room_id"] + event["sender"]):
-                logger.debug(
-                    "script {} not whitelisted".format(script["name"]))
-                return
-        if "__blacklist" in script["env"]:
-            if re.search(script["env"]["__blacklist"],
-                         event["room_id"] + event["sender"]):
-                logger.debug("script {} blacklisted".format(script["name"]))
-                return
-        logger.debug("script {} run with env {}".format(
-            [script["name"], args], script["env"]))
+        # multiple scripts can match regex, multiple scripts can be kicked
+        # off
+        scripts = triggers.match(args)
+        self.metrics.observe("dispatch_seconds", monotonic() - received)
+        for script in scripts:
+            self.run_script(room, event, script, args, received)
+
+    def run_script(self, room, event, script, args, received=None):
+        if not script["acl"].allows(event["room_id"], event["sender"]):
+            logger.debug("script {} not allowed for {} in {}".format(
+                script["name"], event["sender"], event["room_id"]))
+            return
+        # every run gets its own copy of the environment, runs overlap and
+        # must not see each other's room or sender
+        env = script["env"].copy()
+        env["__room_id"] = event["room_id"]
+        env["__sender"] = event["sender"]
+        if not (self.scheduler.admit(self.limits + script["limits"], event["room_id"], event["sender"]) and
+                self.scheduler.submit(
+                    event["room_id"], event["sender"],
+                    lambda: self.execute_script(room, script, args, env, received),
+                    script["slots"])):
+            logger.info("script {} refused for {} in {}, busy".format(
+                script["name"], event["sender"], event["room_id"]))
+            self.reply_busy(room, event["sender"])
+            return
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("script {} queued with env {}".format(
+                [script["name"], args], env))
+
+    def reply_busy(self, room, sender):
+        if not self.busy_message:
+            return
+        now = monotonic()
+        key = (room.room_id, sender)
+        if now - self.busy_sent.get(key, -self.busy_interval) < self.busy_interval:
+            return
+        if len(self.busy_sent) > 1024:
+            self.busy_sent = {k: v for k, v in self.busy_sent.items()
+                              if now - v < self.busy_interval}
+        self.busy_sent[key] = now
+        self.outbox.put(room, "text", self.busy_message)
+
+    def execute_script(self, room, script, args, env, received=None):
+        """Run a script on a worker thread and send its output to the room.
+        The scheduler has taken one of the script's slots for the run.
+        """
+        try:
+            if script["cache_ttl"] > 0:
+                key = (script["name"], " ".join(args.split()))
+                if script["cache_per_room"]:
+                    key += (env["__room_id"],)
+                output = self.cache.get(
+                    key, script["cache_ttl"],
+                    lambda: self.call_cacheable_script(script, args, env))
+            else:
+                def deliver(output):
+                    self.send_output(room, script, output, received)
+                progress = None
+                if script["progress"] > 0:
+                    progress = ProgressMessage(
+                        room, self.outbox.bucket, script["name"], script["progress"])
+                output = self.call_script(
+                    script, args, env, deliver if script["stream"] else None, progress)
+            self.send_output(room, script, output, received)
+        except Exception:
+            logger.exception("script {} failed".format(script["name"]))
+
+    def start_job(self, name, done):
+        """Queue a scheduled run of a script, see Timetable. It waits in the
+        run queue of its first room like a triggered run, but the sender and
+        room limits do not apply. Returns False if the run was refused.
+        """
+        script = next((s for s in self.scripts if s["name"] == name and "job" in s), None)
+        if script is None:
+            return False
+        room_id = script["job"]["rooms"][0]
+        env = script["env"].copy()
+        env["__room_id"] = room_id
+        env["__sender"] = self.client.user_id
+        return self.scheduler.submit(
+            room_id, self.client.user_id, lambda: self.execute_job(script, env, done),
+            script["slots"])
+
+    def execute_job(self, script, env, done):
+        """Run a scheduled script on a worker thread and send its output to
+        every room of its schedule.
+        """
+        from matrix_client.room import Room
+        try:
+            # a worker of a sharded bot knows no rooms, it can still send
+            rooms = [self.client.rooms.get(room_id) or Room(self.client, room_id)
+                     for room_id in script["job"]["rooms"]]
+
+            def deliver(output):
+                for room in rooms:
+                    self.send_output(room, script, output)
+            output = self.call_script(
+                script, script["job"]["args"], env, deliver if script["stream"] else None)
+            deliver(output)
+        except Exception:
+            logger.exception("scheduled run of {} failed".format(script["name"]))
+        finally:
+            done()
+
+    def call_cacheable_script(self, script, args, env):
+        output = self.call_script(script, args, env)
+        # errors and timeouts are not cached
+        return output, not output.startswith("*** Error: script ")
+
+    def call_script(self, script, args, env, deliver=None, progress=None):
+        """Run a script and return its output, or an error message
+        if it failed or did not finish in time.
+        With deliver, the messages the script has finished are passed to
+        it while the script runs and only the rest is returned.
+        Resident scripts, plugins and static replies do not stream and
+        show no progress.
+        """
+        # formatting the whole environment costs more than a static reply
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("script {} run with env {}".format(
+                [script["name"], args], env))
+        self.metrics.add("scripts_in_flight", script=script["name"])
+        started = monotonic()
+        try:
+            if "reply" in script:
+                return script["reply"]
+            if "handler" in script:
+                return self.call_handler(script, args, env)
+            if "resident" in script:
+                return self.call_resident_script(script, args, env)
+            return self.call_script_process(script, args, env, deliver, progress)
+        finally:
+            self.metrics.add("scripts_in_flight", -1, script=script["name"])
+            self.metrics.observe(
+                "script_wall_seconds", monotonic() - started, script=script["name"])
+
+    def call_script_process(self, script, args, env, deliver=None, progress=None):
+        streaming = deliver is not None or progress is not None
         run = subprocess.Popen(
             [script["path"], args],
-            env=script["env"],
+            env=env,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            universal_newlines=True
+            # streamed output is decoded while it is read
+            universal_newlines=not streaming,
+            # own process group, so a timeout also kills the script's children
+            start_new_session=True
         )
-        # output = run.communicate()[0].strip()
-        output, std_err = run.communicate()
+        try:
+            if streaming:
+                output, std_err, timed_out = self.stream_script(
+                    script, run, deliver, progress)
+            else:
+                try:
+                    output, std_err = run.communicate(
+                        timeout=script["timeout"] if script["timeout"] > 0 else None)
+                    timed_out = False
+                except subprocess.TimeoutExpired:
+                    os.killpg(run.pid, signal.SIGKILL)
+                    output, std_err = run.communicate()
+                    timed_out = True
+        finally:
+            self.metrics.add(
+                "script_cpu_seconds_total", self.metrics.children_cpu(), script=script["name"])
+        if timed_out:
+            logger.warning("script {} killed after {} seconds".format(
+                script["name"], script["timeout"]))
+            return ("*** Error: script " + script["name"] + " timed out after " +
+                    "{:g}".format(script["timeout"]) + " seconds. ***\n" +
+                    std_err.strip() + "\n" + output.strip()).strip()
+        return self.script_result(script, run.returncode, output, std_err)
+
+    def stream_script(self, script, run, deliver, progress):
+        """Read the output of a running script while it runs. Every message
+        that is complete, i.e. followed by three newlines, is passed to
+        deliver right away. Returns the rest of the output, stderr and
+        whether the script was killed because of its timeout.
+        """
+        started = monotonic()
+        deadline = started + script["timeout"] if script["timeout"] > 0 else None
+        decoder = io.IncrementalNewlineDecoder(
+            codecs.getincrementaldecoder("utf-8")("replace"), True)
+        output = ""
+        std_err = b""
+        timed_out = False
+        pipes = [run.stdout, run.stderr]
+        while pipes:
+            wakeups = []
+            if deadline is not None and not timed_out:
+                wakeups.append(deadline)
+            if progress:
+                wakeups.append(progress.due)
+            wait = max(0, min(wakeups) - monotonic()) if wakeups else None
+            readable, _, _ = select.select(pipes, [], [], wait)
+            for pipe in readable:
+                data = os.read(pipe.fileno(), 65536)
+                if not data:
+                    pipes.remove(pipe)
+                elif pipe is run.stderr:
+                    std_err += data
+                else:
+                    output += decoder.decode(data)
+                    if deliver and "\n\n\n" in output:
+                        messages, output = output.rsplit("\n\n\n", 1)
+                        deliver(messages)
+            now = monotonic()
+            if deadline is not None and not timed_out and now >= deadline:
+                os.killpg(run.pid, signal.SIGKILL)
+                timed_out = True
+            if progress and now >= progress.due:
+                progress.update(now - started)
+        output += decoder.decode(b"", True)
+        run.wait()
+        if progress:
+            progress.finish(monotonic() - started)
+        return output, std_err.decode(errors="replace"), timed_out
+
+    def call_handler(self, script, args, env):
+        """Call the handler of a plugin, see load_plugin."""
+        try:
+            output = script["handler"](
+                env["__room_id"], env["__sender"], args, script["config"])
+            # a coroutine gets an event loop of its own on this worker thread
+            if inspect.iscoroutine(output):
+                output = asyncio.run(asyncio.wait_for(
+                    output, script["timeout"] if script["timeout"] > 0 else None))
+        except asyncio.TimeoutError:
+            logger.warning("plugin {} cancelled after {} seconds".format(
+                script["name"], script["timeout"]))
+            return ("*** Error: script " + script["name"] + " timed out after " +
+                    "{:g}".format(script["timeout"]) + " seconds. ***")
+        except Exception as e:
+            logger.exception("plugin {} failed".format(script["name"]))
+            return "*** Error: script " + script["name"] + " failed: " + str(e) + " ***"
+        return "" if output is None else str(output).strip()
+
+    def call_resident_script(self, script, args, env):
+        """Hand a request to a resident script, see ResidentScript."""
+        try:
+            response = script["resident"].request(args, env, script["timeout"])
+        except subprocess.TimeoutExpired:
+            logger.warning("resident script {} killed after {} seconds".format(
+                script["name"], script["timeout"]))
+            return ("*** Error: script " + script["name"] + " timed out after " +
+                    "{:g}".format(script["timeout"]) + " seconds. ***")
+        except Exception as e:
+            logger.warning("resident script {} failed: {}".format(script["name"], e))
+            return "*** Error: script " + script["name"] + " failed: " + str(e) + " ***"
+        return self.script_result(
+            script, response.get("returncode", 0),
+            str(response.get("output", "")), str(response.get("stderr", "")))
+
+    def script_result(self, script, returncode, output, std_err):
         output = output.strip()
         std_err = std_err.strip()
-        if run.returncode != 0:
-            logger.debug("script {} exited with return code {} and " +
-                         "stderr as \"{}\" and stdout as \"{}\"".format(
-                             script["name"], run.returncode, std_err, output))
+        if returncode != 0:
+            logger.debug(("script {} exited with return code {} and " +
+                          "stderr as \"{}\" and stdout as \"{}\"").format(
+                              script["name"], returncode, std_err, output))
             output = "*** Error: script " + script["name"] + " returned error code " + str(
-                run.returncode) + ". ***\n" + std_err + "\n" + output
+                returncode) + ". ***\n" + std_err + "\n" + output
             # return # don't return on error, also print any available output
-        sleep(0.1)
+        return output
+
+    def reap_resident_scripts(self):
+        for script in self.scripts:
+            if "resident" in script:
+                script["resident"].reap()
+
+    def send_output(self, room, script, output, received=None):
         # higher up programs or scripts have two options:
         # Text with a single or a double linebreak (i.e. one empty line) stays together
         # in a single messages, allowing one to write longer messages and structure
@@ -256,17 +2614,17 @@ class TinyMatrixtBot():
             # strip again to get get rid of leading/trailing newlines and whitespaces
             # left over from previous split
             if p.strip() != "":
-                if pargs.code:
-                    room.send_html("<pre><code>" + p.strip() + "</code></pre>")
+                if self.pargs.code:
+                    message_format = "code"
                 elif ("__format" in script["env"]) and (script["env"]["__format"] == "code"):
-                    room.send_html("<pre><code>" + p.strip() + "</code></pre>")
-                elif pargs.html:
-                    room.send_html(p.strip())
+                    message_format = "code"
+                elif self.pargs.html:
+                    message_format = "html"
                 elif ("__format" in script["env"]) and (script["env"]["__format"] == "html"):
-                    room.send_html(p.strip())
+                    message_format = "html"
                 else:
-                    room.send_text(p.strip())
-                sleep(0.1)
+                    message_format = "text"
+                self.outbox.put(room, message_format, p.strip(), script["name"], received)
 
 
 if __name__ == "__main__":
@@ -291,11 +2649,12 @@ if __name__ == "__main__":
                     action="store_true", help="Send message(s) as format \"HTML\". If not specified, message will be sent as format \"TEXT\".")
     ap.add_argument("-c", "--code", required=False,
                     action="store_true", help="Send message(s) as format \"CODE\". If not specified, message will be sent as format \"TEXT\". If both --html and --code are specified then --code takes priority.")
+    # started by the supervisor of a sharded bot, see ShardSupervisor
+    ap.add_argument("--worker", required=False, type=int, help=argparse.SUPPRESS)
     pargs = ap.parse_args()
     if pargs.debug:
         logging.getLogger().setLevel(logging.DEBUG)  # set log level on root logger
         logging.getLogger().info("Debug is turned on.")
-    logger = logging.getLogger("tiny-matrix-bot")
     if pargs.message and (not pargs.room):
         logger.error(
             "If you provide a message you must also provide a room as destination for the message.")